@@ -0,0 +1,75 @@
+# SPDX-FileCopyrightText: Copyright (c) 2026 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: MIT
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+# Copyright (c) Kyutai, all rights reserved.
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""
+Writes a fast boot checkpoint of the Moshi LM.
+
+The released checkpoint needs its depformer weights to be patched and every tensor to be cast
+to the inference dtype each time it is loaded. The exported file is already patched and cast,
+and carries a manifest in its safetensors metadata, so `loaders.get_moshi_lm` memory maps it
+straight into the model. Pass it to the server or the offline script with `--moshi-weight`.
+"""
+
+import argparse
+import time
+
+import torch
+from huggingface_hub import hf_hub_download
+
+from .client_utils import make_log
+from .models import loaders
+
+
+def log(level: str, msg: str):
+    print(make_log(level, msg))
+
+
+def main():
+    """Parse CLI args and export the checkpoint."""
+    parser = argparse.ArgumentParser(description="Export a fast boot checkpoint of the Moshi LM.")
+    parser.add_argument("output", type=str, help="Path of the .safetensors file to write.")
+    parser.add_argument("--moshi-weight", type=str, help="Path to a local checkpoint file for Moshi.")
+    parser.add_argument(
+        "--hf-repo",
+        type=str,
+        default=loaders.DEFAULT_REPO,
+        help="HF repo to look into (defaults to pre-trained model repo)",
+    )
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["bfloat16", "float16", "float32"],
+                        help="Dtype of the exported weights, the one used at inference.")
+    args = parser.parse_args()
+
+    if not args.output.endswith(".safetensors"):
+        parser.error("output must be a .safetensors file")
+    if args.moshi_weight is None:
+        args.moshi_weight = hf_hub_download(args.hf_repo, loaders.MOSHI_NAME)
+    begin = time.time()
+    with torch.no_grad():
+        loaders.export_fast_boot_lm(args.moshi_weight, args.output, dtype=getattr(torch, args.dtype))
+    log("info", f"exported {args.moshi_weight} to {args.output} in {time.time() - begin:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -95,7 +95,7 @@ class _MimiState:
     graphed_tr_enc: CUDAGraphed | None
     graphed_tr_dec: CUDAGraphed | None
 
-    def reset(self):
+    def reset(self, reset_mask: torch.Tensor | None = None):
         pass
 
 
@@ -361,7 +361,16 @@ class MimiModel(CompressionModel[_MimiState]):
                 (emb,) = self.encoder_transformer(emb)
             else:
                 assert state.graphed_tr_enc is not None
-                (emb,) = state.graphed_tr_enc(emb)
+                # Several frames given at once still go through the transformer one frame at a time: its KV cache
+                # only holds `context` steps, so the first steps of a longer input would miss some of the keys
+                # they attend to when streaming frame by frame. This also keeps the CUDA Graph input shape.
+                frame_steps = max(1, round(self.encoder_frame_rate / self.frame_rate))
+                frames = emb.split(frame_steps, dim=-1)
+                if len(frames) == 1:
+                    (emb,) = state.graphed_tr_enc(emb)
+                else:
+                    # The output of a CUDA Graph is overwritten by its next call.
+                    emb = torch.cat([state.graphed_tr_enc(frame)[0].clone() for frame in frames], dim=-1)
         emb = self._to_framerate(emb)
         return emb
 
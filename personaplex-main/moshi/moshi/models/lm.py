@@ -29,14 +29,18 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+from collections import OrderedDict
 from collections.abc import Callable
+from contextlib import nullcontext
 from dataclasses import dataclass
 from functools import partial
 from os.path import splitext
+import itertools
 import logging
 import numpy as np
+import os
 import sys
-from typing import Optional, Union, List, Tuple, Callable, Iterator
+from typing import Any, ContextManager, Optional, Union, List, Tuple, Callable, Iterable, Iterator
 import sphn
 import torch
 from tqdm.auto import tqdm
@@ -55,6 +59,8 @@ AUDIO_TOKENS_PER_STREAM = 8
 FRAME_RATE_HZ = 12.5
 SILENCE_TOKENS = np.array([948, 243, 1178, 546, 1736, 1030, 1978, 2008], dtype=np.int64)
 SINE_TOKENS    = np.array([430, 1268, 381, 1611, 1095, 1495, 56, 472], dtype=np.int64)
+# Frames of audio encoded by each Mimi call of `encode_from_sphn`.
+ENCODE_CHUNK_FRAMES = 16
 
 
 @dataclass
@@ -150,42 +156,105 @@ def _iterate_audio(sample_pcm, sample_interval_size, max_len=sys.maxsize, pad=Tr
         yield sample[0:1]  # shape: (1, T)
 
 
-def encode_from_sphn(mimi, samples, max_batch=sys.maxsize):
+def encode_from_sphn(mimi, samples, max_batch=ENCODE_CHUNK_FRAMES):
     """
-    Takes an iterator of samples, batches them, encodes them;
+    Takes an iterator of samples, encodes them `max_batch` at a time;
     and yields the encoded samples one sample at a time in the same order.
+
+    The samples are the consecutive frames of a single stream, so a chunk is concatenated along time, not
+    along the batch: with a streaming `mimi`, this gives the same codes as encoding the frames one by one.
     """
     device = next(mimi.parameters()).device
-    current_batch = []
-    done_flag = False
-    # TO-DO: Fix the batching bug
-    max_batch = 1
-
+    samples = iter(samples)
     while True:
-        try:
-            sample = next(samples)
-            tensor = torch.tensor(sample, dtype=torch.float32, device=device)
-            tensor = tensor.unsqueeze(0)  # shape: (1, C, T)                                                                                                      
-            current_batch.append(tensor)
-        except StopIteration:
-            done_flag = True
-
-        if (not done_flag) and len(current_batch) < max_batch:
-            continue
-        if not current_batch:
+        chunk = list(itertools.islice(samples, max_batch))
+        if not chunk:
             break
+        pcm = np.concatenate(chunk, axis=-1)  # shape: (C, max_batch * T)
+        tensor = torch.as_tensor(pcm, dtype=torch.float32, device=device).unsqueeze(0)
+        encoded = mimi.encode(tensor)  # shape: (1, K, max_batch * F)
+        yield from encoded.chunk(len(chunk), dim=-1)  # shape: (1, K, F)
+
 
-        batch = torch.cat(current_batch, dim=0)  # shape: (B, C, T)
-        encoded = mimi.encode(batch)  # shape: (B, K, F)
-        separated = torch.unbind(encoded, dim=0)  # shape: (K, F)
-        reshaped = [x.unsqueeze(0) for x in separated]  # shape: (1, K, F)
-        detached = [x.detach().clone() for x in reshaped]
+@dataclass
+class VoicePrompt:
+    """A loaded voice prompt, either the normalized audio or the saved embeddings and token cache."""
+    audio: Optional[np.ndarray] = None
+    embeddings: Optional[torch.Tensor] = None
+    cache: Optional[torch.Tensor] = None
+
+    @property
+    def nbytes(self) -> int:
+        nbytes = 0 if self.audio is None else self.audio.nbytes
+        for tensor in (self.embeddings, self.cache):
+            if tensor is not None:
+                nbytes += tensor.numel() * tensor.element_size()
+        return nbytes
 
-        current_batch = []
-        yield from detached  # shape: (1, K, F)
 
-        if done_flag:
-            break
+class LRUCache:
+    """Least recently used cache, bounded by the total size in bytes of its values.
+
+    Args:
+        max_bytes (int): memory budget, 0 disables the cache.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Any, tuple[Any, int]] = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, nbytes: int):
+        self.invalidate(key)
+        if nbytes > self.max_bytes:
+            return
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def invalidate(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+
+def _file_identity(path: str) -> tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+class VoicePromptCache(LRUCache):
+    """LRU cache of loaded voice prompts, bounded by their total size in bytes.
+
+    Entries are keyed by path, and checked against the modification time and size of the file,
+    so that a file written again under the same name is reloaded.
+    """
+    def load(self, path: str, read: Callable[[str], VoicePrompt]) -> tuple[tuple[str, int, int], VoicePrompt]:
+        """Returns the identity of the file, as (path, mtime, size), and the loaded voice prompt."""
+        identity = _file_identity(path)
+        cached = self.entries.get(identity[0])
+        if cached is not None and cached[0][0] == identity:
+            return self.get(identity[0])
+        self.misses += 1
+        entry = (identity, read(path))
+        self.put(identity[0], entry, entry[1].nbytes)
+        return entry
+
+
+def _entry_nbytes(entry: dict[str, dict[str, torch.Tensor]]) -> int:
+    return sum(value.numel() * value.element_size() for state in entry.values() for value in state.values())
 
 
 class ScaledEmbedding(torch.nn.Embedding):
@@ -560,11 +629,34 @@ class _LMGenState:
     graphed_main: CUDAGraphed
     graphed_embeddings: CUDAGraphed
     graphed_depth: CUDAGraphed
-    offset: int = 0
+    # One offset per batch entry (slot), kept on CPU as they drive the indexing into `cache`.
+    offsets: torch.Tensor
+    # Batch entries advanced by the next steps, see `LMGen.set_exec_mask`.
+    exec_mask: torch.Tensor
+    # Device copy of the entries actually running the main transformer, shared with its streaming state.
+    transformer_exec_mask: Optional[torch.Tensor] = None
+
+    def reset(self, reset_mask: Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.offsets.zero_()
+            self.provided[:] = False
+        else:
+            self.offsets.masked_fill_(reset_mask.cpu(), 0)
+            self.provided.masked_fill_(reset_mask.to(self.provided.device).view(-1, 1, 1), False)
 
-    def reset(self):
-        self.offset = 0
-        self.provided[:] = False
+    @property
+    def offset(self) -> int:
+        """Offset of the first batch entry, for the single stream case."""
+        return int(self.offsets[0])
+
+    def get_entry(self, index: int) -> dict[str, torch.Tensor]:
+        return {"cache": self.cache[index].clone(), "provided": self.provided[index].clone(),
+                "offsets": self.offsets[index].clone()}
+
+    def set_entry(self, index: int, entry: dict[str, torch.Tensor]):
+        self.cache[index].copy_(entry["cache"])
+        self.provided[index].copy_(entry["provided"])
+        self.offsets[index].copy_(entry["offsets"])
 
 
 @torch.no_grad()
@@ -661,6 +753,10 @@ class LMGen(StreamingModule[_LMGenState]):
         save_voice_prompt_embeddings: bool = False,
         sample_rate: int = 32000,
         frame_rate: int = FRAME_RATE_HZ,
+        voice_prompt_cache_bytes: int = 256 * 2**20,
+        prompt_snapshot_cache_bytes: int = 0,
+        depformer_codebooks: Optional[int] = None,
+        prefill_chunk_size: int = 1,
     ):
         assert not lm_model.training, "generation shouldn't be used in training mode."
         super().__init__()
@@ -682,22 +778,96 @@ class LMGen(StreamingModule[_LMGenState]):
         duration = self._frame_size / self._sample_rate
         sine = create_sinewave(duration, self._sample_rate)
         self._sine_frame = torch.tensor(sine, device=device).unsqueeze(0).unsqueeze(0)  # (1,1,T)
+        # Tokens of the silence and sine frames, given at each step of the system prompts. Never written to.
+        self._zero_frame_tokens = torch.as_tensor(
+            SILENCE_TOKENS, dtype=torch.long, device=lm_model.device).view(1, 8, 1)
+        self._sine_frame_tokens = torch.as_tensor(
+            SINE_TOKENS, dtype=torch.long, device=lm_model.device).view(1, 8, 1)
         self.check = check
         self.report_loss = report_loss
         if report_loss:
             return_logits = True
         self.return_logits = return_logits
+        # Only the first `depformer_codebooks` codebooks are sampled by the depformer, see `depformer_step`.
+        if depformer_codebooks is None:
+            depformer_codebooks = lm_model.dep_q
+        if not 0 < depformer_codebooks <= lm_model.dep_q:
+            raise ValueError(f"depformer_codebooks should be in [1, {lm_model.dep_q}], got {depformer_codebooks}.")
+        if depformer_codebooks < lm_model.dep_q and return_logits:
+            raise ValueError("The logits of all the codebooks are needed to return logits or report the loss.")
+        self.depformer_codebooks = depformer_codebooks
+        # Prompt steps run through the main transformer at once by the system prompts, see `_prefill_core`.
+        self.prefill_chunk_size = prefill_chunk_size
         self.max_delay = max(
             lm_model.delays
         )  # with delays, we need to generate a few more time steps.
         self.delays_cuda = torch.tensor(
             lm_model.delays, device=lm_model.device, dtype=torch.long
         )
+        # Cache codebooks written by `prepare_step_input` for the moshi and user audio streams, with their delays.
+        needed_tokens = lm_model.num_codebooks - AUDIO_TOKENS_PER_STREAM - 1
+        moshi_codebooks = torch.arange(1, 1 + needed_tokens, device=lm_model.device)
+        user_codebooks = torch.arange(
+            AUDIO_TOKENS_PER_STREAM + 1, AUDIO_TOKENS_PER_STREAM + 1 + needed_tokens, device=lm_model.device)
+        self._moshi_codebooks = (moshi_codebooks, self.delays_cuda[moshi_codebooks])
+        self._user_codebooks = (user_codebooks, self.delays_cuda[user_codebooks])
         self.save_voice_prompt_embeddings = save_voice_prompt_embeddings
         self.voice_prompt_audio: Optional[torch.Tensor] = None
         self.voice_prompt_cache: Optional[torch.Tensor] = None
         self.voice_prompt_embeddings: Optional[torch.Tensor] = None
+        # Loaded voice prompts, kept on device so that switching between voices is free.
+        self.voice_prompts = VoicePromptCache(voice_prompt_cache_bytes)
+        # File identity and content of the voice prompt loaded by `load_voice_prompt[_embeddings]`.
+        self._loaded_voice_prompt: Optional[tuple[tuple[str, int, int], VoicePrompt]] = None
+        # Streaming state of a batch entry right after its system prompts, see `iter_system_prompts`.
+        self.prompt_snapshots = LRUCache(prompt_snapshot_cache_bytes)
         #self.voice_prompt_mimi_streaming_state: Optional[StreamingStateDict] = None
+        # Optional callable returning a context manager timing the given stage, "lm_main" or "lm_depformer",
+        # see `moshi.utils.metrics.StageTimer`.
+        self.stage_timer: Optional[Callable[[str], ContextManager]] = None
+        # Streaming sub-modules of the depformer with their states, kept across frames, see `_start_depformer`.
+        self._depformer_states: list[tuple[StreamingModule, Any]] = []
+        self._depformer_batch_size = 0
+
+    def _stage(self, stage: str) -> ContextManager:
+        if self.stage_timer is None:
+            return nullcontext()
+        return self.stage_timer(stage)
+
+    def _start_depformer(self, batch_size: int):
+        """Give the depformer a fresh streaming state for the `dep_q` steps of a frame.
+
+        The state is allocated on the first frame, then reset in place: zeroing the offsets is enough
+        as the KV cache positions past them are never attended to. Allocating it again on each frame
+        walked the whole depformer and created new KV caches for all its layers.
+        """
+        states = self._depformer_states
+        if self._owns_depformer() and self._depformer_batch_size == batch_size:
+            for _, state in states:
+                state.reset()
+            return
+        # First frame, or the batch size changed.
+        depformer = self.lm_model.depformer
+        depformer.streaming_forever(batch_size)
+        states.clear()
+        depformer._apply_named_streaming(lambda name, module: states.append((module, module._streaming_state)))
+        self._depformer_batch_size = batch_size
+
+    def _owns_depformer(self) -> bool:
+        # The depformer does not propagate streaming from its parents, its sub-modules hold the states.
+        if not self._depformer_states:
+            return False
+        module, state = self._depformer_states[0]
+        return module._streaming_state is state
+
+    def _stop_depformer(self):
+        if self._owns_depformer():
+            self.lm_model.depformer._stop_streaming()
+        self._depformer_states.clear()
+
+    def _stop_streaming(self):
+        super()._stop_streaming()
+        self._stop_depformer()
 
     def _init_streaming_state(self, batch_size: int) -> _LMGenState:
         lm_model = self.lm_model
@@ -714,6 +884,8 @@ class LMGen(StreamingModule[_LMGenState]):
             device=lm_model.device,
             dtype=torch.bool
         )
+        offsets = torch.zeros(batch_size, dtype=torch.long)
+        exec_mask = torch.ones(batch_size, dtype=torch.bool)
 
         disable = lm_model.device.type != 'cuda'
         # disable = True # DEBUG
@@ -721,8 +893,59 @@ class LMGen(StreamingModule[_LMGenState]):
         graphed_embeddings = CUDAGraphed(lm_model.forward_embeddings, disable=disable)
         graphed_depth = CUDAGraphed(self.depformer_step, disable=disable)
 
-        return _LMGenState(cache, provided, initial, graphed_main, graphed_embeddings, graphed_depth)
-    
+        return _LMGenState(cache, provided, initial, graphed_main, graphed_embeddings, graphed_depth,
+                           offsets, exec_mask)
+
+    def set_exec_mask(self, exec_mask: Optional[torch.Tensor] = None):
+        """Select the batch entries (slots) advanced by the next calls to `step`.
+
+        Entries outside of the mask keep their cache, offset and KV cache untouched,
+        which allows running the prompt of a joining slot while other slots are live.
+        Pass None to advance all the entries.
+        """
+        state = self._streaming_state
+        if state is None:
+            raise RuntimeError(
+                "You should wrap those calls with a `with lm_gen.streaming(): ...`."
+            )
+        if exec_mask is None:
+            state.exec_mask.fill_(True)
+        else:
+            state.exec_mask.copy_(exec_mask)
+
+    def ready_mask(self) -> torch.Tensor:
+        """Batch entries for which the next call to `step` returns valid tokens."""
+        state = self._streaming_state
+        assert state is not None
+        return state.exec_mask & (state.offsets > self.max_delay)
+
+    def _set_transformer_exec_mask(self, run_mask: torch.Tensor):
+        state = self._streaming_state
+        if state.transformer_exec_mask is None:
+            # Single device tensor shared by all the layers, updated in place at each step.
+            state.transformer_exec_mask = torch.ones(
+                len(run_mask), dtype=torch.bool, device=self.lm_model.device)
+            self.lm_model.transformer.set_exec_mask(state.transformer_exec_mask)
+        state.transformer_exec_mask.copy_(run_mask)
+
+    @staticmethod
+    def _batch_tokens(tokens, rows: torch.Tensor) -> torch.Tensor:
+        # Tokens given for a single stream are shared by all the executed rows.
+        if tokens.shape[0] == 1:
+            return tokens.expand(len(rows), *tokens.shape[1:])
+        return tokens[rows]
+
+    @staticmethod
+    def _write_stream(state: _LMGenState, rows: torch.Tensor, offsets: torch.Tensor,
+                      codebooks: tuple[torch.Tensor, torch.Tensor], tokens: torch.Tensor):
+        # Writes the [R, K] `tokens` of all the codebooks of a stream at their delayed positions, in one scatter.
+        codebook_ids, delays = codebooks
+        CT = state.cache.shape[2]
+        positions = (offsets.view(-1, 1) + delays.view(1, -1)) % CT
+        index = (rows.view(-1, 1), codebook_ids.view(1, -1), positions)
+        state.cache[index] = tokens
+        state.provided[index] = True
+
     @torch.no_grad()
     def prepare_step_input(self,
                            input_tokens: torch.Tensor=None,
@@ -735,88 +958,103 @@ class LMGen(StreamingModule[_LMGenState]):
                 "You should wrap those calls with a `with lm_gen.streaming(): ...`."
             )
         lm_model = self.lm_model
+        device = state.cache.device
 
         # audio_tokens_per_stream = lm_model.dep_q//2
         needed_tokens = lm_model.num_codebooks - AUDIO_TOKENS_PER_STREAM - 1
-        CT = state.cache.shape[2]
+        B, _, CT = state.cache.shape
+
+        # Only the batch entries in `exec_mask` are written to and advanced.
+        exec_rows = state.exec_mask.nonzero()[:, 0]
+        if len(exec_rows) == 0:
+            return None
+        offsets = state.offsets[exec_rows]
+        rows = exec_rows.to(device)
+        device_offsets = offsets.to(device)
 
         ####
         # Fill Cache with provided tokens at state.offset (target) + delays
 
         if input_tokens is not None:
             assert input_tokens.dim() == 3, "Shape should be [B, K, T]."
-            B, Ki, S = input_tokens.shape
+            _, Ki, S = input_tokens.shape
             assert S == 1, "Only support being given steps one by one."
             assert (
                 Ki == needed_tokens
             ), f"We expect {needed_tokens} tokens from the user stream, got {Ki}."
-
-            for q_other in range(input_tokens.shape[1]):
-                k = AUDIO_TOKENS_PER_STREAM + 1 + q_other
-                delay = lm_model.delays[k]
-                write_position = (state.offset + delay) % CT
-                state.cache[:, k, write_position : write_position + 1] = input_tokens[:, q_other]
-                state.provided[:, k, write_position : write_position + 1] = True
+            input_tokens = self._batch_tokens(input_tokens, rows)
+            self._write_stream(state, rows, device_offsets, self._user_codebooks, input_tokens[:, :, 0])
 
         if moshi_tokens is not None:
             assert moshi_tokens.dim() == 3, "Shape should be [B, K, T]."
-            B, Ki, S = moshi_tokens.shape
+            _, Ki, S = moshi_tokens.shape
             assert S == 1, "Only support being given steps one by one."
             assert (
                 Ki == needed_tokens
             ), f"We expect {needed_tokens} tokens from the moshi stream, got {Ki}."
-
-            for q_moshi in range(moshi_tokens.shape[1]):
-                k = 1 + q_moshi
-                delay = lm_model.delays[k]
-                write_position = (state.offset + delay) % CT
-                state.cache[:, k, write_position : write_position + 1] = moshi_tokens[:, q_moshi]
-                state.provided[:, k, write_position : write_position + 1] = True
+            moshi_tokens = self._batch_tokens(moshi_tokens, rows)
+            self._write_stream(state, rows, device_offsets, self._moshi_codebooks, moshi_tokens[:, :, 0])
 
         if text_token is not None:
-            write_position = (state.offset + lm_model.delays[0]) % CT
-            state.cache[:, 0, write_position] = text_token
-            state.provided[:, 0, write_position] = True
-
-        for k, delay in enumerate(lm_model.delays):
-            # Only for the very beginning, we extend the initial token for the acoustic
-            # token that are delayed, and thus have no good value to take.
-            if state.offset <= delay:
-                state.cache[:, k, state.offset % CT] = state.initial[:, k, 0]
-                state.provided[:, k, state.offset % CT] = True
+            if isinstance(text_token, torch.Tensor) and text_token.dim() > 0:
+                text_token = self._batch_tokens(text_token, rows)
+            write_positions = (device_offsets + lm_model.delays[0]) % CT
+            state.cache[rows, 0, write_positions] = text_token
+            state.provided[rows, 0, write_positions] = True
+
+        # Only for the very beginning, we extend the initial token for the acoustic
+        # token that are delayed, and thus have no good value to take.
+        if int(offsets.min()) <= self.max_delay:
+            starting = device_offsets.view(-1, 1) <= self.delays_cuda.view(1, -1)
+            positions = device_offsets % CT
+            state.cache[rows, :, positions] = torch.where(
+                starting, state.initial[0, :, 0].view(1, -1), state.cache[rows, :, positions])
+            state.provided[rows, :, positions] |= starting
 
         ####
         # Perform inference at state.offset - 1 (model_input); forcing with tokens at state.offset (target) when provided
 
-        if state.offset == 0:
+        fresh = offsets == 0
+        if fresh.any():
             # We can't report loss or force depth tranformer tokens until we're at step 2
             # And we need to initialize the delay-0 cache where it's not provided for step 2
-            state.cache[:, :, 0] = state.initial[:, :, 0] # torch.where(state.provided[:, :, 0], state.cache[:, :, 0], state.initial[:, :, 0])
-            state.offset += 1
-            return None
-
-        model_input_position = (state.offset-1) % CT
-        target_position = state.offset % CT
-        input_ = state.cache[:, :, model_input_position : model_input_position + 1]
-        target_ = state.cache[:, :, target_position : target_position + 1]
-        provided_ = state.provided[:, :, target_position : target_position + 1]
+            state.cache[exec_rows[fresh].to(device), :, 0] = state.initial[0, :, 0] # torch.where(state.provided[:, :, 0], state.cache[:, :, 0], state.initial[:, :, 0])
+            state.offsets[exec_rows[fresh]] += 1
+            exec_rows = exec_rows[~fresh]
+            if len(exec_rows) == 0:
+                return None
+            offsets = offsets[~fresh]
+            rows = exec_rows.to(device)
+
+        run_mask = torch.zeros(B, dtype=torch.bool)
+        run_mask[exec_rows] = True
+        if B > 1:
+            self._set_transformer_exec_mask(run_mask)
+
+        # Rows that are not executed read from their own (ignored) positions.
+        all_offsets = state.offsets.clone()
+        all_offsets[exec_rows] = offsets
+        model_input_position = ((all_offsets - 1) % CT).to(device)
+        target_position = (all_offsets % CT).to(device)
+        input_ = state.cache.gather(2, model_input_position.view(-1, 1, 1).expand(-1, lm_model.num_codebooks, 1))
+        target_ = state.cache.gather(2, target_position.view(-1, 1, 1).expand(-1, lm_model.num_codebooks, 1))
+        provided_ = state.provided.gather(2, target_position.view(-1, 1, 1).expand(-1, lm_model.num_codebooks, 1))
 
         if self.check:
             # Check that we are not feeding in any value that is not generated yet.
-            assert not (input_ == lm_model.ungenerated_token_id).any(), (
-                state.offset,
+            assert not (input_[rows] == lm_model.ungenerated_token_id).any(), (
+                state.offsets,
                 input_,
             )
-            assert (input_[:, lm_model.audio_offset :] <= lm_model.card).all(), input_
-            assert (input_[:, :1] <= lm_model.text_card).all()
-        return input_, provided_, target_, model_input_position, target_position
+            assert (input_[rows, lm_model.audio_offset :] <= lm_model.card).all(), input_
+            assert (input_[rows, :1] <= lm_model.text_card).all()
+        return input_, provided_, target_, model_input_position, target_position, run_mask
 
     @torch.no_grad()
     def step(self, input_tokens: torch.Tensor=None, moshi_tokens:torch.Tensor=None, text_token:torch.Tensor=None,
              return_embeddings: bool=False) \
         -> torch.Tensor | tuple[torch.Tensor, torch.Tensor] | tuple[torch.Tensor, dict[str, torch.Tensor]]:
         state = self._streaming_state
-        lm_model = self.lm_model
         prepared_inputs = self.prepare_step_input(
             input_tokens, moshi_tokens, text_token,
         )
@@ -824,19 +1062,15 @@ class LMGen(StreamingModule[_LMGenState]):
         # print("MOSHI:", None if moshi_tokens is None else moshi_tokens.squeeze().cpu().tolist()) # DEBUG
         if prepared_inputs is None:
             return (None, None) if self.report_loss or self.return_logits else None
-        input_, provided_, target_, model_input_position, target_position = prepared_inputs
-        if self.check:
-            # Check that we are not feeding in any value that is not generated yet.
-            assert not (input_ == lm_model.ungenerated_token_id).any(), (
-                state.offset,
-                input_,
-            )
-            assert (input_[:, lm_model.audio_offset :] <= lm_model.card).all(), input_
-            assert (input_[:, :1] <= lm_model.text_card).all()
+        input_, provided_, target_, model_input_position, target_position, run_mask = prepared_inputs
+        # Only steps given all their input tokens, as in the system prompts, can be fully forced.
+        forced = (input_tokens is not None and moshi_tokens is not None and text_token is not None
+                  and self._is_forced(provided_, run_mask))
         embeddings = None
         if return_embeddings:
             embeddings = self.lm_model.embed_codes(input_)
-        transformer_out, text_logits = state.graphed_main(input_)
+        with self._stage("lm_main"):
+            transformer_out, text_logits = state.graphed_main(input_)
         output = self.process_transformer_output(
             transformer_out,
             text_logits,
@@ -844,6 +1078,8 @@ class LMGen(StreamingModule[_LMGenState]):
             target_,
             model_input_position,
             target_position,
+            run_mask,
+            forced=forced,
         )
         if return_embeddings:
             return output, embeddings
@@ -852,17 +1088,19 @@ class LMGen(StreamingModule[_LMGenState]):
     @torch.no_grad()
     def step_embeddings(self, embeddings: torch.Tensor):
         state = self._streaming_state
-        lm_model = self.lm_model
-        needed_input_tokens = lm_model.num_codebooks - AUDIO_TOKENS_PER_STREAM - 1
-        _dummy_audio_token = lm_model._get_initial_token()
-        while True:
-            prepared_inputs = self.prepare_step_input(
-                input_tokens=_dummy_audio_token[:, 1:1+needed_input_tokens], moshi_tokens=_dummy_audio_token[:, 1+needed_input_tokens:], text_token=self.zero_text_code,
-            )
-            if prepared_inputs is not None:
-                break
-        _, provided_, target_, model_input_position, target_position = prepared_inputs
-        transformer_out, text_logits = state.graphed_embeddings(embeddings)
+        dummy_tokens = self._dummy_step_tokens()
+        prepared_inputs = self.prepare_step_input(**dummy_tokens)
+        if prepared_inputs is None and state.exec_mask.any():
+            # The executed entries were all fresh, they have now started and can take the embeddings.
+            prepared_inputs = self.prepare_step_input(**dummy_tokens)
+        if prepared_inputs is None:
+            raise RuntimeError("No batch entry is executed, see `set_exec_mask`.")
+        _, provided_, target_, model_input_position, target_position, run_mask = prepared_inputs
+        B = state.cache.shape[0]
+        if embeddings.shape[0] != B:
+            embeddings = embeddings.expand(B, *embeddings.shape[1:])
+        with self._stage("lm_main"):
+            transformer_out, text_logits = state.graphed_embeddings(embeddings)
         return self.process_transformer_output(
             transformer_out,
             text_logits,
@@ -870,46 +1108,72 @@ class LMGen(StreamingModule[_LMGenState]):
             target_,
             model_input_position,
             target_position,
+            run_mask,
+            forced=self._is_forced(provided_, run_mask),
         )
 
+    def _is_forced(self, provided_: torch.Tensor, run_mask: torch.Tensor) -> bool:
+        """Whether all the target tokens of the executed entries are provided, see `process_transformer_output`."""
+        if self.return_logits:
+            # The logits are still needed, so the step must be run in full.
+            return False
+        rows = run_mask.nonzero()[:, 0].to(provided_.device)
+        return bool(provided_[rows].all())
+
     @torch.no_grad()
-    def process_transformer_output(self, transformer_out, text_logits, provided_, target_, model_input_position, target_position):
+    def process_transformer_output(self, transformer_out, text_logits, provided_, target_, model_input_position,
+                                   target_position, run_mask, forced: bool = False):
+        """Sample the tokens of the step and advance the executed entries.
+
+        With `forced`, all the target tokens are provided (see `_is_forced`): every sampled token would be
+        discarded, so neither the text token nor the depformer are sampled, and no random number is drawn.
+        """
         state = self._streaming_state
         lm_model = self.lm_model
 
-        # Shape of text_logits should be [B, K_text=1, T=1, Card_text]
-        sampled_text_token = sample_token(
-            text_logits.float(),
-            self.use_sampling,
-            self.temp_text,
-            self.top_k_text,
-        )
-        assert sampled_text_token.dim() == 3, sampled_text_token.shape
-        assert sampled_text_token.shape[2] == 1
-        assert sampled_text_token.shape[1] == 1, "Only one text stream supported."
-        sampled_text_token = sampled_text_token[:, 0, 0]  # shape is [B]
+        B = state.cache.shape[0]
+        run_rows = run_mask.nonzero()[:, 0]
+        rows = run_rows.to(state.cache.device)
+        if not forced:
+            # Shape of text_logits should be [B, K_text=1, T=1, Card_text]
+            sampled_text_token = sample_token(
+                text_logits.float(),
+                self.use_sampling,
+                self.temp_text,
+                self.top_k_text,
+            )
+            assert sampled_text_token.dim() == 3, sampled_text_token.shape
+            assert sampled_text_token.shape[2] == 1
+            assert sampled_text_token.shape[1] == 1, "Only one text stream supported."
+            sampled_text_token = sampled_text_token[:, 0, 0]  # shape is [B]
 
-        next_text_token = torch.where(provided_[:, 0, 0], target_[:, 0, 0], sampled_text_token)
+            next_text_token = torch.where(provided_[:, 0, 0], target_[:, 0, 0], sampled_text_token)
 
-        if self.return_logits:
-            sampled_audio_tokens, audio_logits = state.graphed_depth(next_text_token, transformer_out, target_[:,lm_model.audio_offset:,0], provided_[:,lm_model.audio_offset:,0]) # [B, K_audio, Card_audio]
-        else:
-            sampled_audio_tokens = state.graphed_depth(next_text_token, transformer_out, target_[:,lm_model.audio_offset:,0], provided_[:,lm_model.audio_offset:,0])
+            with self._stage("lm_depformer"):
+                if self.return_logits:
+                    sampled_audio_tokens, audio_logits = state.graphed_depth(next_text_token, transformer_out, target_[:,lm_model.audio_offset:,0], provided_[:,lm_model.audio_offset:,0]) # [B, K_audio, Card_audio]
+                else:
+                    sampled_audio_tokens = state.graphed_depth(next_text_token, transformer_out, target_[:,lm_model.audio_offset:,0], provided_[:,lm_model.audio_offset:,0])
 
-        state.provided[:, :, model_input_position] = False
+        model_input_position = model_input_position[rows]
+        target_position = target_position[rows]
+        state.provided[rows, :, model_input_position] = False
         ####
         # Fill cache with generated tokens at state.offset (where not provided)
 
-        state.cache[:, 0, target_position] = torch.where(
-            ~state.provided[:, 0, target_position],
-            sampled_text_token,
-            state.cache[:, 0, target_position],
-        )
-        state.cache[:, 1 : lm_model.dep_q + 1, target_position] = torch.where(
-            ~state.provided[:, 1 : lm_model.dep_q + 1, target_position],
-            sampled_audio_tokens,
-            state.cache[:, 1 : lm_model.dep_q + 1, target_position],
-        )
+        if not forced:
+            state.cache[rows, 0, target_position] = torch.where(
+                ~state.provided[rows, 0, target_position],
+                sampled_text_token[rows],
+                state.cache[rows, 0, target_position],
+            )
+            audio_positions = target_position.view(-1, 1)
+            audio_codebooks = torch.arange(1, lm_model.dep_q + 1, device=rows.device).view(1, -1)
+            state.cache[rows.view(-1, 1), audio_codebooks, audio_positions] = torch.where(
+                ~state.provided[rows.view(-1, 1), audio_codebooks, audio_positions],
+                sampled_audio_tokens[rows],
+                state.cache[rows.view(-1, 1), audio_codebooks, audio_positions],
+            )
 
         ####
         # Calculate loss of model logits (based on state.offset - 1) compared to target (state.offset)
@@ -924,32 +1188,35 @@ class LMGen(StreamingModule[_LMGenState]):
                 target=target_,
                 sampled_text_token=sampled_text_token,
                 sampled_audio_tokens=sampled_audio_tokens,
-                target_position=target_position,
+                target_position=int(target_position[0]),
             )
 
         ####
         # Collect outputs for state.offset - max_delay
 
-        if state.offset <= self.max_delay:
-            state.offset += 1
+        offsets = state.offsets[run_rows]
+        state.offsets[run_rows] += 1
+        if not (offsets > self.max_delay).any():
             if self.report_loss:
                 return None, report
             if self.return_logits:
                 return None, None
             else:
                 return None
-        
-        B = state.cache.shape[0]
+
         CT = state.cache.shape[2]
         gen_delays_cuda = self.delays_cuda[: lm_model.dep_q + 1]
+        all_offsets = state.offsets - run_mask.long()
         index = (
-            ((state.offset - self.max_delay + gen_delays_cuda) % CT)
-            .view(1, -1, 1)
-            .expand(B, -1, 1)
+            ((all_offsets.to(state.cache.device).view(-1, 1) - self.max_delay + gen_delays_cuda.view(1, -1)) % CT)
+            .view(B, -1, 1)
         )
         out = state.cache.gather(dim=2, index=index)
+        if B > 1:
+            # Rows that are not ready (see `ready_mask`) are zeroed, so that the whole batch can still be decoded.
+            ready = run_mask & (all_offsets > self.max_delay)
+            out = out.masked_fill(~ready.to(out.device).view(-1, 1, 1), 0)
 
-        state.offset += 1
         if self.report_loss:
             return out, report
         elif self.return_logits and not self.report_loss:
@@ -957,8 +1224,7 @@ class LMGen(StreamingModule[_LMGenState]):
         else:
             return out
 
-    def load_voice_prompt(self, voice_prompt: str):
-        self.voice_prompt = voice_prompt
+    def _read_voice_prompt(self, voice_prompt: str) -> VoicePrompt:
         raw_audio = load_audio(
             voice_prompt, self._sample_rate,
         )  # shape: (1, T) for mono
@@ -969,32 +1235,34 @@ class LMGen(StreamingModule[_LMGenState]):
         # Keep shape (1, T) because your encoder expects channels-first
         if raw_audio.ndim == 1:
             raw_audio = raw_audio[None, :]
+        return VoicePrompt(audio=raw_audio)
 
-        self.voice_prompt_audio = raw_audio
+    def _read_voice_prompt_embeddings(self, path: str) -> VoicePrompt:
+        state = torch.load(path)
+        return VoicePrompt(embeddings=state["embeddings"].to(self.lm_model.device),
+                           cache=state["cache"].to(self.lm_model.device))
+
+    def load_voice_prompt(self, voice_prompt: str):
+        self.voice_prompt = voice_prompt
+        self._loaded_voice_prompt = self.voice_prompts.load(voice_prompt, self._read_voice_prompt)
+        prompt = self._loaded_voice_prompt[1]
+        self.voice_prompt_audio = prompt.audio
         self.voice_prompt_cache: Optional[torch.Tensor] = None
         self.voice_prompt_embeddings: Optional[torch.Tensor] = None
 
     def load_voice_prompt_embeddings(self, path: str):
         self.voice_prompt = path
-        state = torch.load(path)
-
+        self._loaded_voice_prompt = self.voice_prompts.load(path, self._read_voice_prompt_embeddings)
+        prompt = self._loaded_voice_prompt[1]
         self.voice_prompt_audio = None
-        self.voice_prompt_embeddings = state["embeddings"].to(self.lm_model.device)
-        self.voice_prompt_cache = state["cache"].to(self.lm_model.device)
+        self.voice_prompt_embeddings = prompt.embeddings
+        self.voice_prompt_cache = prompt.cache
 
     def _encode_zero_frame(self) -> torch.Tensor:
-        return torch.as_tensor(
-            SILENCE_TOKENS,
-            dtype=torch.long,
-            device=self.lm_model.device,
-        ).view(1, 8, 1)
+        return self._zero_frame_tokens
 
     def _encode_sine_frame(self) -> torch.Tensor:
-        return torch.as_tensor(
-            SINE_TOKENS,
-            dtype=torch.long,
-            device=self.lm_model.device,
-        ).view(1, 8, 1)
+        return self._sine_frame_tokens
 
     def _encode_voice_prompt_frames(self, mimi):
         return encode_from_sphn(
@@ -1004,7 +1272,6 @@ class LMGen(StreamingModule[_LMGenState]):
                 sample_interval_size=self._frame_size,
                 pad=True,
             ),
-            max_batch=1,
         )
 
     def _step_voice_prompt_frame(self,
@@ -1016,30 +1283,44 @@ class LMGen(StreamingModule[_LMGenState]):
             moshi_tokens=voice_prompt_frame_tokens,
             text_token=self.zero_text_code,
             input_tokens=self._encode_sine_frame(),
-            return_embeddings=self.save_voice_prompt_embeddings,
+            return_embeddings=saved_embeddings is not None,
         )
-        if out is not None and self.save_voice_prompt_embeddings:
+        if out is not None and saved_embeddings is not None:
             _, embeddings = out
             saved_embeddings.append(embeddings)
 
-    def _step_voice_prompt_core(self, mimi) -> Iterator[None]:
+    def _step_voice_prompt_core(self, mimi, save_embeddings: Optional[bool] = None) -> Iterator[None]:
         """Shared core for stepping through the voice prompt.
 
         This generator yields at each *checkpoint* where the async wrapper may want to
         consult `is_alive`. The core itself is intentionally unaware of connection state.
+        `save_embeddings` defaults to `save_voice_prompt_embeddings`.
         """
+        if save_embeddings is None:
+            save_embeddings = self.save_voice_prompt_embeddings
+        state = self._streaming_state
+        exec_rows = state.exec_mask.nonzero()[:, 0].to(state.cache.device)
         if self.voice_prompt_embeddings is not None:
             # Replay stored voice prompt embeddings
-            for next_embed in self.voice_prompt_embeddings:
-                yield
-                self.step_embeddings(next_embed)
+            if self.prefill_chunk_size > 1:
+                dummy = self._dummy_step_tokens()
+                yield from self._prefill_core({**dummy, "embeddings": next_embed}
+                                              for next_embed in self.voice_prompt_embeddings)
+            else:
+                for next_embed in self.voice_prompt_embeddings:
+                    yield
+                    self.step_embeddings(next_embed)
 
-            state = self._streaming_state
-            state.cache.copy_(self.voice_prompt_cache)
+            state.cache[exec_rows] = self.voice_prompt_cache
             return
 
+        elif self.voice_prompt_audio is not None and self.prefill_chunk_size > 1 and not save_embeddings:
+            yield from self._prefill_core(
+                dict(moshi_tokens=voice_prompt_frame_tokens, text_token=self.zero_text_code,
+                     input_tokens=self._encode_sine_frame())
+                for voice_prompt_frame_tokens in self._encode_voice_prompt_frames(mimi))
         elif self.voice_prompt_audio is not None:
-            saved_embeddings = []
+            saved_embeddings = [] if save_embeddings else None
             for voice_prompt_frame_tokens in self._encode_voice_prompt_frames(mimi):
                 yield
                 self._step_voice_prompt_frame(
@@ -1049,16 +1330,21 @@ class LMGen(StreamingModule[_LMGenState]):
             # One last checkpoint before any optional save (nice-to-have for async disconnect)
             yield
 
-            if self.save_voice_prompt_embeddings:
+            if save_embeddings:
                 # Offset int(self._streaming_state.offset) is not needed since calling step() for len(voice_prompt_frame_tokens)
                 # and calling step_embeddings() for len(voice_prompt_embeddings) will increment offset by the same amount
+                # Only the first executed batch entry is saved, so that the file can be replayed with any batch size.
+                row = exec_rows[:1]
+                path = splitext(self.voice_prompt)[0] + ".pt"
+                # Written under a temporary name first, the file might be picked up as soon as it exists.
                 torch.save(
                     {
-                        "embeddings": torch.stack(saved_embeddings, dim=0).detach().cpu(),
-                        "cache": self._streaming_state.cache
+                        "embeddings": torch.stack([e[row] for e in saved_embeddings], dim=0).detach().cpu(),
+                        "cache": state.cache[row].clone()
                     },
-                    splitext(self.voice_prompt)[0] + ".pt",
+                    path + ".tmp",
                 )
+                os.replace(path + ".tmp", path)
         print('Done loading voice prompt.')
 
     def _step_voice_prompt(self, mimi):
@@ -1074,13 +1360,14 @@ class LMGen(StreamingModule[_LMGenState]):
     def _step_audio_silence_core(self) -> Iterator[None]:
         # For slots of silence (default 0.5s) after voice/text prompts
         # (agent text, user audio, agent audio) : (PADs, silence, sine)
-        for _ in range(self.audio_silence_frame_cnt):
-            yield
-            self.step(
+        yield from self._prompt_steps_core(
+            dict(
                 moshi_tokens=self._encode_zero_frame(),
                 text_token=self.zero_text_code,
                 input_tokens=self._encode_sine_frame(),
             )
+            for _ in range(self.audio_silence_frame_cnt)
+        )
         print('Done loading audio silence.')
 
     def _step_audio_silence(self):
@@ -1094,15 +1381,106 @@ class LMGen(StreamingModule[_LMGenState]):
                 break
 
     def _step_text_prompt_core(self) -> Iterator[None]:
-        for text_prompt_token in self.text_prompt_tokens:
-            yield
-            self.step(
+        yield from self._prompt_steps_core(
+            dict(
                 moshi_tokens=self._encode_zero_frame(),
                 text_token=text_prompt_token,
                 input_tokens=self._encode_sine_frame(),
             )
+            for text_prompt_token in self.text_prompt_tokens
+        )
         print('Done loading text prompt.')
 
+    def _prompt_steps_core(self, steps: Iterable[dict[str, Any]]) -> Iterator[None]:
+        """Run the given `step` arguments, yielding before each step, or each chunk when prefilling."""
+        if self.prefill_chunk_size > 1:
+            yield from self._prefill_core(steps)
+            return
+        for step_kwargs in steps:
+            yield
+            self.step(**step_kwargs)
+
+    def _dummy_step_tokens(self) -> dict[str, Any]:
+        # Tokens forced by `step_embeddings`, whose input is given as embeddings.
+        needed_input_tokens = self.lm_model.num_codebooks - AUDIO_TOKENS_PER_STREAM - 1
+        _dummy_audio_token = self.lm_model._get_initial_token()
+        return dict(input_tokens=_dummy_audio_token[:, 1:1+needed_input_tokens],
+                    moshi_tokens=_dummy_audio_token[:, 1+needed_input_tokens:], text_token=self.zero_text_code)
+
+    def _prefill_core(self, steps: Iterable[dict[str, Any]]) -> Iterator[None]:
+        """Same as calling `step` (or `step_embeddings` when the steps have an `embeddings` entry, either all
+        of them or none) for each of the `steps`, but runs the main transformer over `prefill_chunk_size` steps at
+        once, yielding before each chunk.
+
+        Only valid when all the tokens are provided, as in the system prompts: the sampled tokens would then all
+        be discarded, so the token cache is filled step by step without running the model, and the transformer
+        is only run for its KV cache.
+        """
+        state = self._streaming_state
+        lm_model = self.lm_model
+        device = state.cache.device
+        B = state.cache.shape[0]
+        # A chunk must fit in the ring KV cache without wrapping, otherwise its keys would overwrite ones still
+        # attended to by its earlier queries: once the cache is full, steps go one by one.
+        capacity = lm_model.context
+        steps = iter(steps)
+        step_kwargs = next(steps, None)
+        while step_kwargs is not None:
+            yield
+            # The step at offset `o` writes the key of position `o - 1`, the one at offset 0 none.
+            max_offset = int(state.offsets[state.exec_mask].max()) if state.exec_mask.any() else 0
+            chunk_size = max(1, min(self.prefill_chunk_size, capacity - max(max_offset, 1)))
+            inputs: list[torch.Tensor] = []
+            run_mask: Optional[torch.Tensor] = None
+            all_provided = torch.ones((), dtype=torch.bool, device=device)
+            while step_kwargs is not None and len(inputs) < chunk_size:
+                embeddings = step_kwargs.get("embeddings")
+                prepared = self.prepare_step_input(
+                    **{key: value for key, value in step_kwargs.items() if key != "embeddings"})
+                if prepared is None:
+                    # Only fresh entries, or none: the step is consumed without running the model,
+                    # except for `step_embeddings` which tries again with the same embeddings.
+                    if embeddings is None:
+                        step_kwargs = next(steps, None)
+                    elif not state.exec_mask.any():
+                        raise RuntimeError("No batch entry is executed, see `set_exec_mask`.")
+                    continue
+                input_, provided_, _, model_input_position, _, step_run_mask = prepared
+                if run_mask is not None and not torch.equal(run_mask, step_run_mask):
+                    # Different entries are run, this step starts the next chunk.
+                    self._prefill_chunk(inputs, embeddings is not None, run_mask, all_provided)
+                    inputs = []
+                    all_provided = torch.ones((), dtype=torch.bool, device=device)
+                run_mask = step_run_mask
+                rows = run_mask.nonzero()[:, 0]
+                device_rows = rows.to(device)
+                all_provided &= provided_[device_rows].all()
+                # Bookkeeping of `process_transformer_output`, the cache only keeps provided tokens.
+                state.provided[device_rows, :, model_input_position[device_rows]] = False
+                state.offsets[rows] += 1
+                if embeddings is None:
+                    inputs.append(input_)
+                else:
+                    inputs.append(embeddings.expand(B, *embeddings.shape[1:]))
+                step_kwargs = next(steps, None)
+            if inputs:
+                self._prefill_chunk(inputs, embeddings is not None, run_mask, all_provided)
+
+    @torch.no_grad()
+    def _prefill_chunk(self, inputs: list[torch.Tensor], embeddings: bool, run_mask: torch.Tensor,
+                       all_provided: torch.Tensor):
+        lm_model = self.lm_model
+        if not bool(all_provided):
+            raise RuntimeError("Prefill requires all the tokens to be provided.")
+        if len(run_mask) > 1:
+            self._set_transformer_exec_mask(run_mask)
+        # Only the KV cache is needed, not the text logits of `forward_codes` / `forward_embeddings`.
+        with self._stage("lm_main"):
+            if embeddings:
+                lm_model.transformer(torch.cat(inputs, dim=1))
+            else:
+                lm_model.transformer(lm_model.embed_codes(torch.cat(inputs, dim=2)))
+
 
     def _step_text_prompt(self):
         # Sync path intentionally does not support `is_alive` / disconnect checks.
@@ -1114,6 +1492,55 @@ class LMGen(StreamingModule[_LMGenState]):
             if is_alive is not None and not await is_alive():
                 break
 
+    def iter_save_voice_prompt_embeddings(self, mimi) -> Iterator[None]:
+        """Step through the voice prompt loaded with `load_voice_prompt`, yielding before each step,
+        and save its embeddings and token cache next to the audio file, as a .pt file that can then
+        be loaded with `load_voice_prompt_embeddings`."""
+        assert self.voice_prompt_audio is not None, "Load a voice prompt audio file first."
+        yield from self._step_voice_prompt_core(mimi, save_embeddings=True)
+
+    def _system_prompt_key(self) -> Optional[tuple]:
+        """Key identifying the system prompts for `prompt_snapshots`, None if they cannot be identified."""
+        if self.save_voice_prompt_embeddings:
+            return None
+        voice_key = None
+        if self.voice_prompt_audio is not None or self.voice_prompt_embeddings is not None:
+            if self._loaded_voice_prompt is None:
+                return None
+            identity, prompt = self._loaded_voice_prompt
+            # The voice prompt might have been set directly rather than loaded from a file.
+            if prompt.audio is not self.voice_prompt_audio or prompt.embeddings is not self.voice_prompt_embeddings:
+                return None
+            voice_key = identity
+        return voice_key, tuple(self.text_prompt_tokens or ()), self.audio_silence_frame_cnt
+
+    def iter_system_prompts(self, mimi) -> Iterator[None]:
+        """Step through all the system prompts, yielding before each step.
+
+        This lets the caller interleave other work between prompt steps, e.g. the live
+        frames of other batch entries when serving several sessions at once.
+
+        All the tokens are provided during the system prompts, so the resulting state only depends
+        on the prompts. It is kept in `prompt_snapshots` and restored directly, without any step,
+        when the same prompts are used again.
+        """
+        state = self._streaming_state
+        rows = state.exec_mask.nonzero()[:, 0].tolist()
+        key = self._system_prompt_key() if self.prompt_snapshots.max_bytes > 0 else None
+        if key is not None:
+            snapshot = self.prompt_snapshots.get(key)
+            if snapshot is not None:
+                for row in rows:
+                    self.set_streaming_state_entry(row, snapshot)
+                return
+        yield from self._step_voice_prompt_core(mimi)
+        yield from self._step_audio_silence_core()
+        yield from self._step_text_prompt_core()
+        yield from self._step_audio_silence_core()
+        if key is not None:
+            snapshot = self.get_streaming_state_entry(rows[0])
+            self.prompt_snapshots.put(key, snapshot, _entry_nbytes(snapshot))
+
     async def step_system_prompts_async(self, mimi, is_alive: Optional[Callable]=None):
         await self._step_voice_prompt_async(mimi, is_alive)
         await self._step_audio_silence_async(is_alive)
@@ -1138,30 +1565,33 @@ class LMGen(StreamingModule[_LMGenState]):
         lm_model = self.lm_model
         depformer_tokens: list[torch.Tensor] = []
         depformer_logits: list[torch.Tensor] = []
-        assert not lm_model.depformer.is_streaming
-        with lm_model.depformer.streaming(B):
-            for cb_index in range(lm_model.dep_q):
-                input_ = prev_token[:, None, None]
-                logits = lm_model.forward_depformer(cb_index, input_, transformer_out)
-                if self.return_logits:
-                    assert logits.shape == (B, 1, 1, lm_model.card), logits.shape
-                    ret_logits = logits.squeeze(dim=1).squeeze(dim=1)
-                    assert ret_logits.shape == (B, lm_model.card), ret_logits.shape
-                    depformer_logits.append(ret_logits.float())
-                next_token = sample_token(
-                    logits.float(),
-                    self.use_sampling,
-                    self.temp,
-                    self.top_k,
-                )
-                assert next_token.shape == (B, 1, 1)
-                next_token = next_token[:, 0, 0]  # shape is B
-                prev_token = torch.where(
-                    audio_provided[:, cb_index],
-                    audio_tokens[:, cb_index],
-                    next_token,
-                )
-                depformer_tokens.append(next_token)
+        self._start_depformer(B)
+        for cb_index in range(self.depformer_codebooks):
+            input_ = prev_token[:, None, None]
+            logits = lm_model.forward_depformer(cb_index, input_, transformer_out)
+            if self.return_logits:
+                assert logits.shape == (B, 1, 1, lm_model.card), logits.shape
+                ret_logits = logits.squeeze(dim=1).squeeze(dim=1)
+                assert ret_logits.shape == (B, lm_model.card), ret_logits.shape
+                depformer_logits.append(ret_logits.float())
+            next_token = sample_token(
+                logits.float(),
+                self.use_sampling,
+                self.temp,
+                self.top_k,
+            )
+            assert next_token.shape == (B, 1, 1)
+            next_token = next_token[:, 0, 0]  # shape is B
+            prev_token = torch.where(
+                audio_provided[:, cb_index],
+                audio_tokens[:, cb_index],
+                next_token,
+            )
+            depformer_tokens.append(next_token)
+        if self.depformer_codebooks < lm_model.dep_q:
+            # The codebooks that are not sampled take the target tokens, which are left untouched in the cache.
+            # Those are the user stream codebooks, always provided: sampling them is wasted work.
+            depformer_tokens.extend(audio_tokens[:, self.depformer_codebooks:].unbind(dim=1))
 
         assert len(depformer_tokens) == lm_model.dep_q, (
             len(depformer_tokens),
@@ -24,9 +24,12 @@
 # LICENSE file in the root directory of this source tree.
 """Retrieves the pretrained models for Moshi and Mimi."""
 from pathlib import Path
+import json
 import logging
+import os
 
-from safetensors.torch import load_model, load_file
+from safetensors import safe_open
+from safetensors.torch import load_model, load_file, save_file
 import torch
 
 logger = logging.getLogger(__name__)
@@ -43,6 +46,9 @@ TEXT_TOKENIZER_NAME = 'tokenizer_spm_32k_3.model'
 MOSHI_NAME = 'model.safetensors'
 MIMI_NAME = 'tokenizer-e351c8d8-checkpoint125.safetensors'
 DEFAULT_REPO = 'nvidia/personaplex-7b-v1'
+# Metadata `format` of the checkpoints written by `export_fast_boot_lm`.
+FAST_BOOT_FORMAT = 'moshi-fast-boot'
+FAST_BOOT_VERSION = '1'
 
 
 _seanet_kwargs = {
@@ -163,6 +169,145 @@ def get_mimi(filename: str | Path,
     return model
 
 
+def _expand_depformer_weight(name: str, tensor: torch.Tensor, expected: torch.Tensor,
+                             copy_missing_weights: bool) -> torch.Tensor:
+    # Patch 1: expand depformer self_attn weights if needed
+    if "depformer" in name and "self_attn" in name and tensor.shape != expected.shape:
+        logger.info(f"Expanding {name}")
+        missing = tensor if copy_missing_weights else expected[tensor.shape[0]:]
+        tensor = torch.concat([tensor, missing], dim=0)
+    return tensor
+
+
+def _missing_weight_source(name: str, available) -> str | None:
+    # Patch 2: fill missing keys by copying 0..7 -> 8..15 for certain groups
+    to_replace = ["gating", "linears", "depformer_in", "depformer_emb"]
+    for old, new in zip(range(8), range(8, 16)):
+        for rep in to_replace:
+            needle = f"{rep}.{new}."
+            if needle in name:
+                src = name.replace(needle, f"{rep}.{old}.")
+                return src if src in available else None
+    return None
+
+
+def _patch_lm_state_dict(model: LMModel, state_dict: dict[str, torch.Tensor], copy_missing_weights: bool):
+    """Adapt in place a released checkpoint to the 16 codebooks depformer of `model`."""
+    model_sd = model.state_dict()
+    for name, tensor in list(state_dict.items()):
+        if name in model_sd:
+            state_dict[name] = _expand_depformer_weight(name, tensor, model_sd[name], copy_missing_weights)
+
+    if copy_missing_weights:
+        for name in model_sd.keys():
+            if name in state_dict:
+                continue
+            src = _missing_weight_source(name, state_dict)
+            if src is None:
+                logger.warning(f"Missing {name}")
+                continue
+            logger.info(f"Replacing {name} <- {src}")
+            state_dict[name] = state_dict[src]
+
+
+def _stream_lm_state_dict(model: LMModel, filename: str, copy_missing_weights: bool,
+                          device: torch.device | str, dtype: torch.dtype) -> dict[str, torch.Tensor]:
+    """Same as `load_file` followed by `_patch_lm_state_dict` and the cast to `device` and `dtype`,
+    but one tensor at a time: each weight is read from the memory mapped file, patched and converted
+    before the next one is read, so that the peak memory stays close to the size of the model.
+    Weights filled by Patch 2 share the converted tensor of their source, as `_patch_lm_state_dict` does.
+    """
+    dev = torch.device(device) if isinstance(device, str) else device
+    # safetensors does not support mps directly
+    read_device = "cpu" if dev.type == "mps" else str(dev)
+    model_sd = model.state_dict()
+    state_dict: dict[str, torch.Tensor] = {}
+    with safe_open(filename, framework="pt", device=read_device) as f:
+        available = set(f.keys())
+        for name, expected in model_sd.items():
+            if name in available:
+                tensor = _expand_depformer_weight(name, f.get_tensor(name), expected, copy_missing_weights)
+                state_dict[name] = tensor.to(device=dev, dtype=dtype)
+                del tensor
+    if copy_missing_weights:
+        for name in model_sd.keys():
+            if name in state_dict:
+                continue
+            src = _missing_weight_source(name, state_dict)
+            if src is None:
+                logger.warning(f"Missing {name}")
+                continue
+            logger.info(f"Replacing {name} <- {src}")
+            state_dict[name] = state_dict[src]
+    return state_dict
+
+
+def _read_fast_boot_manifest(filename: str) -> dict[str, str] | None:
+    """Return the manifest of a checkpoint written by `export_fast_boot_lm`, None for any other file.
+    Only the header of the file is read."""
+    if not _is_safetensors(filename):
+        return None
+    with safe_open(filename, framework="pt") as f:
+        metadata = f.metadata()
+    if not metadata or metadata.get("format") != FAST_BOOT_FORMAT:
+        return None
+    if metadata.get("version") != FAST_BOOT_VERSION:
+        raise ValueError(f"Unsupported fast boot checkpoint version {metadata.get('version')} in {filename}, "
+                         f"export it again.")
+    return metadata
+
+
+def _load_fast_boot_lm(model: LMModel, filename: str, manifest: dict[str, str],
+                       device: torch.device | str, dtype: torch.dtype) -> LMModel:
+    dev = torch.device(device) if isinstance(device, str) else device
+    # Memory mapped on the CPU, read straight into the device memory otherwise.
+    state_dict = load_file(filename, device="cpu" if dev.type == "mps" else str(dev))
+    if manifest["dtype"] != str(dtype):
+        logger.warning(f"{filename} was exported as {manifest['dtype']}, casting to {dtype}")
+        state_dict = {key: value.to(dtype=dtype) for key, value in state_dict.items()}
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    model.eval()
+    return model.to(device=device)
+
+
+def export_fast_boot_lm(
+    filename: str | Path,
+    output: str | Path,
+    copy_missing_weights: bool = True,
+    dtype: torch.dtype = torch.bfloat16,
+    delays=None,
+):
+    """Write the Moshi LM weights of `filename` as a checkpoint that `get_moshi_lm` loads without
+    any patching or casting: already patched, in `dtype`, one contiguous tensor per parameter.
+    The manifest is stored in the safetensors metadata.
+    """
+    model = get_moshi_lm(filename, copy_missing_weights=copy_missing_weights, device="cpu",
+                         dtype=dtype, delays=delays)
+    state_dict = {}
+    storages = set()
+    for name, tensor in model.state_dict().items():
+        if tensor.is_meta:
+            raise ValueError(f"{name} is missing from {filename}.")
+        tensor = tensor.contiguous()
+        # Weights copied by the patches share their storage, which safetensors does not support.
+        if tensor.untyped_storage().data_ptr() in storages:
+            tensor = tensor.clone()
+        storages.add(tensor.untyped_storage().data_ptr())
+        state_dict[name] = tensor
+    manifest = {
+        "format": FAST_BOOT_FORMAT,
+        "version": FAST_BOOT_VERSION,
+        "dtype": str(dtype),
+        "dep_q": str(model.dep_q),
+        "delays": json.dumps(list(model.delays)),
+        "source": os.path.basename(str(filename)),
+    }
+    tmp = f"{output}.tmp"
+    save_file(state_dict, tmp, metadata=manifest)
+    os.replace(tmp, output)
+    logger.info(f"exported {len(state_dict)} tensors to {output}")
+
+
 def get_moshi_lm(
     filename: str | Path | None,
     copy_missing_weights: bool = True,
@@ -188,6 +333,16 @@ def get_moshi_lm(
     if delays is not None:
         lm_kwargs["delays"] = delays
 
+    # Checkpoints from `export_fast_boot_lm` are already patched and cast.
+    manifest = _read_fast_boot_manifest(str(filename)) if filename is not None and not cpu_offload else None
+    if manifest is not None:
+        if delays is None:
+            lm_kwargs["delays"] = json.loads(manifest["delays"])
+        if int(manifest["dep_q"]) != lm_kwargs["dep_q"]:
+            raise ValueError(f"{filename} was exported with dep_q={manifest['dep_q']}.")
+        model = LMModel(device="meta", dtype=dtype, **lm_kwargs)
+        return _load_fast_boot_lm(model, str(filename), manifest, device, dtype)
+
     if cpu_offload and filename is not None:
         return _get_moshi_lm_with_offload(
             filename, copy_missing_weights, device, dtype, lm_kwargs
@@ -205,56 +360,18 @@ def get_moshi_lm(
 
     # Load state_dict
     if filename.endswith(".safetensors"):
-        # safetensors does not support mps directly
-        dev = torch.device(device) if isinstance(device, str) else device
-        if dev.type == "mps":
-            state_dict = load_file(filename, device="cpu")
-        else:
-            state_dict = load_file(filename, device=dev.type)
+        state_dict = _stream_lm_state_dict(model, filename, copy_missing_weights, device, dtype)
     else:
         # torch checkpoint
         with open(filename, "rb") as f:
             state_dict = torch.load(f, map_location="cpu")
-    # Patch 1: expand depformer self_attn weights if needed
-    model_sd = model.state_dict()
-    for name, tensor in list(state_dict.items()):
-        if "depformer" in name and "self_attn" in name and name in model_sd:
-            if tensor.shape != model_sd[name].shape:
-                print("Expanding %s", name)
-                missing = (
-                    tensor
-                    if copy_missing_weights
-                    else model_sd[name][tensor.shape[0] :]
-                )
-                state_dict[name] = torch.concat([tensor, missing], dim=0)
+        _patch_lm_state_dict(model, state_dict, copy_missing_weights)
+
+        # Assign weights to target device
+        dev = torch.device(device) if isinstance(device, str) else device
+        for key in state_dict:
+            state_dict[key] = state_dict[key].to(device=dev, dtype=dtype)
 
-    # Patch 2: fill missing keys by copying 0..7 -> 8..15 for certain groups
-    if copy_missing_weights:
-        to_replace = ["gating", "linears", "depformer_in", "depformer_emb"]
-        for name in model_sd.keys():
-            if name in state_dict:
-                continue
-            replaced = False
-            for old, new in zip(range(8), range(8, 16)):
-                for rep in to_replace:
-                    needle = f"{rep}.{new}."
-                    if needle in name:
-                        src = name.replace(needle, f"{rep}.{old}.")
-                        if src in state_dict:
-                            print("Replacing %s <- %s", name, src)
-                            state_dict[name] = state_dict[src]
-                            replaced = True
-                        break
-                if replaced:
-                    break
-            if not replaced:
-                print("Missing %s", name)
-
-    # Assign weights to target device
-    dev = torch.device(device) if isinstance(device, str) else device
-    for key in state_dict:
-        state_dict[key] = state_dict[key].to(device=dev, dtype=dtype)
-    
     model.load_state_dict(state_dict, strict=False, assign=True)
     model.eval()
     return model.to(device=device, dtype=dtype)
@@ -284,51 +401,18 @@ def _get_moshi_lm_with_offload(
     filename = str(filename)
     logger.info("Loading model with CPU offloading enabled")
 
-    # First, create model on CPU to get the architecture
-    model = LMModel(device="cpu", dtype=dtype, **lm_kwargs)
-
-    # Load state_dict to CPU
+    # Load state_dict to CPU, the weights are assigned to a meta model to avoid holding two copies
     if filename.endswith(".safetensors"):
-        state_dict = load_file(filename, device="cpu")
+        model = LMModel(device="meta", dtype=dtype, **lm_kwargs)
+        state_dict = _stream_lm_state_dict(model, filename, copy_missing_weights, "cpu", dtype)
     else:
+        model = LMModel(device="cpu", dtype=dtype, **lm_kwargs)
         with open(filename, "rb") as f:
             state_dict = torch.load(f, map_location="cpu")
-
-    # Apply weight patches (same as non-offload path)
-    model_sd = model.state_dict()
-    for name, tensor in list(state_dict.items()):
-        if "depformer" in name and "self_attn" in name and name in model_sd:
-            if tensor.shape != model_sd[name].shape:
-                logger.info(f"Expanding {name}")
-                missing = (
-                    tensor
-                    if copy_missing_weights
-                    else model_sd[name][tensor.shape[0]:]
-                )
-                state_dict[name] = torch.concat([tensor, missing], dim=0)
-
-    if copy_missing_weights:
-        to_replace = ["gating", "linears", "depformer_in", "depformer_emb"]
-        for name in model_sd.keys():
-            if name in state_dict:
-                continue
-            replaced = False
-            for old, new in zip(range(8), range(8, 16)):
-                for rep in to_replace:
-                    needle = f"{rep}.{new}."
-                    if needle in name:
-                        src = name.replace(needle, f"{rep}.{old}.")
-                        if src in state_dict:
-                            logger.info(f"Replacing {name} <- {src}")
-                            state_dict[name] = state_dict[src]
-                            replaced = True
-                        break
-                if replaced:
-                    break
-            if not replaced:
-                logger.warning(f"Missing {name}")
+        _patch_lm_state_dict(model, state_dict, copy_missing_weights)
 
     model.load_state_dict(state_dict, strict=False, assign=True)
+    del state_dict
 
     # Determine target device
     dev = torch.device(device) if isinstance(device, str) else device
@@ -181,9 +181,18 @@ class NormConvTranspose1d(nn.Module):
 class _StreamingConv1dState:
     padding_to_add: int
     original_padding_to_add: int
+    # Batch entries reset since the last call, whose left padding must be rebuilt
+    # from the next input, see `StreamingConv1d.forward`.
+    pending_reset: torch.Tensor | None = None
 
-    def reset(self):
-        self.padding_to_add = self.original_padding_to_add
+    def reset(self, reset_mask: tp.Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.padding_to_add = self.original_padding_to_add
+            self.pending_reset = None
+        elif self.padding_to_add == 0:
+            if self.pending_reset is not None:
+                reset_mask = reset_mask.to(self.pending_reset.device) | self.pending_reset
+            self.pending_reset = reset_mask.to(torch.bool)
 
 
 class StreamingConv1d(StreamingModule[_StreamingConv1dState]):
@@ -272,6 +281,16 @@ class StreamingConv1d(StreamingModule[_StreamingConv1dState]):
             if state.padding_to_add > 0 and x.shape[-1] > 0:
                 x = pad1d(x, (state.padding_to_add, 0), mode=self.pad_mode)
                 state.padding_to_add = 0
+            elif state.pending_reset is not None and x.shape[-1] > 0:
+                # Some batch entries were reset mid-stream: replace what the inner conv
+                # kept from the previous steps with the padding a fresh stream would get.
+                conv_state = self.conv.conv._streaming_state
+                previous = conv_state.previous
+                if previous is not None and previous.shape[-1] == padding_total:
+                    padding = pad1d(x, (padding_total, 0), mode=self.pad_mode)[..., :padding_total]
+                    mask = state.pending_reset.to(x.device).view(-1, 1, 1)
+                    conv_state.previous = torch.where(mask, padding, previous)
+                state.pending_reset = None
         return self.conv(x)
 
 
@@ -279,7 +298,7 @@ class StreamingConv1d(StreamingModule[_StreamingConv1dState]):
 class _StreamingConvTr1dState:
     pass
 
-    def reset(self):
+    def reset(self, reset_mask: tp.Optional[torch.Tensor] = None):
         pass
 
 
@@ -35,6 +35,7 @@ Streaming module API that should be implemented by all Streaming components,
 
 import abc
 from contextlib import contextmanager
+import copy
 from dataclasses import dataclass, fields, is_dataclass
 import itertools
 import math
@@ -45,7 +46,7 @@ from safetensors.torch import save_file, load_file
 
 
 class Resetable(Protocol):
-    def reset(self) -> None:
+    def reset(self, reset_mask: Optional[torch.Tensor] = None) -> None:
         pass
 
 
@@ -259,6 +260,12 @@ def load_streaming_state(path: str,
     return state_dict
 
 
+def _batch_mask(reset_mask: torch.Tensor, value: torch.Tensor) -> torch.Tensor:
+    """Reshape a `[B]` boolean mask so that it broadcasts over `value`, whose first dim is the batch."""
+    reset_mask = reset_mask.to(device=value.device, dtype=torch.bool)
+    return reset_mask.view(-1, *([1] * (value.dim() - 1)))
+
+
 class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
     """Common API for streaming components.
 
@@ -278,6 +285,10 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
     This will automatically reset the streaming state when exiting the context manager.
     This also automatically propagates to all streaming children module.
 
+    When streaming with a batch size larger than 1, each batch entry can be reset on its
+    own by passing a boolean `reset_mask` of shape `[B]` to `reset_streaming`, which lets
+    independent streams join and leave a shared batch.
+
     Some module might also implement the `StreamingModule.flush` method, although
     this one is trickier, as all parents module must be StreamingModule and implement
     it as well for it to work properly. See `StreamingSequential` after.
@@ -341,8 +352,26 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
         finally:
             self._stop_streaming()
 
-    def reset_streaming(self):
-        """Reset the streaming state."""
+    def shared_copy(self):
+        """Return a copy of this module sharing its parameters and buffers, but with its own streaming
+        state. Several streams can then be run in lockstep with a single copy of the weights in memory.
+        The copy is not streaming, whatever the state of this module.
+        """
+        memo: dict[int, Any] = {id(tensor): tensor for tensor in itertools.chain(self.parameters(), self.buffers())}
+
+        def _skip_state(name: str, module: StreamingModule):
+            memo[id(module._streaming_state)] = None
+
+        self._apply_named_streaming(_skip_state)
+        return copy.deepcopy(self, memo)
+
+    def reset_streaming(self, reset_mask: Optional[torch.Tensor] = None):
+        """Reset the streaming state.
+
+        Args:
+            reset_mask (torch.Tensor, optional): boolean tensor of shape `[B]`. If provided,
+                only the batch entries for which it is True are reset, the others are left untouched.
+        """
 
         def _reset(name: str, module: StreamingModule):
             state = module._streaming_state
@@ -350,7 +379,7 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
                 raise ValueError(
                     f"Trying to reset streaming, but {name} wasn't streaming."
                 )
-            state.reset()
+            state.reset(reset_mask)
 
         self._apply_named_streaming(_reset)
 
@@ -402,6 +431,37 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
         if state:
             raise RuntimeError(f"Some states were not consumed: {list(state.keys())}")
 
+    def get_streaming_state_entry(self, index: int) -> dict[str, dict[str, torch.Tensor]]:
+        """Return a copy of the streaming state of the batch entry `index`, including that of sub-modules.
+
+        Only supported by states implementing `get_entry(index)` and `set_entry(index, entry)`,
+        see `set_streaming_state_entry`.
+        """
+        entry: dict[str, dict[str, torch.Tensor]] = {}
+
+        def _add(name: str, module: StreamingModule):
+            state = module._streaming_state
+            if not hasattr(state, "get_entry"):
+                raise TypeError(f"Streaming state of {name} does not support batch entries.")
+            entry[name] = state.get_entry(index)
+
+        self._apply_named_streaming(_add)
+        return entry
+
+    def set_streaming_state_entry(self, index: int, entry: dict[str, dict[str, torch.Tensor]]):
+        """Set in-place the streaming state of the batch entry `index`, including that of sub-modules,
+        from a copy returned by `get_streaming_state_entry`. The other batch entries are left untouched."""
+        entry = dict(entry)
+
+        def _set(name: str, module: StreamingModule):
+            if name not in entry:
+                raise RuntimeError(f"Expected to find a streaming state for {name}.")
+            module._streaming_state.set_entry(index, entry.pop(name))
+
+        self._apply_named_streaming(_set)
+        if entry:
+            raise RuntimeError(f"Some states were not consumed: {list(entry.keys())}")
+
     def set_streaming_state(self, state: dict[str, Any]):
         """Set the streaming state, including that of sub-modules."""
         state = dict(state)
@@ -422,7 +482,13 @@ class StreamingModule(abc.ABC, torch.nn.Module, Generic[State]):
 class _NullState:
     pass
 
-    def reset(self) -> None:
+    def reset(self, reset_mask: Optional[torch.Tensor] = None) -> None:
+        pass
+
+    def get_entry(self, index: int) -> dict[str, torch.Tensor]:
+        return {}
+
+    def set_entry(self, index: int, entry: dict[str, torch.Tensor]) -> None:
         pass
 
 
@@ -436,9 +502,15 @@ class _StreamingAddState:
     previous_x: torch.Tensor | None = None
     previous_y: torch.Tensor | None = None
 
-    def reset(self):
-        self.previous_x = None
-        self.previous_y = None
+    def reset(self, reset_mask: Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.previous_x = None
+            self.previous_y = None
+            return
+        if self.previous_x is not None:
+            self.previous_x = self.previous_x.masked_fill(_batch_mask(reset_mask, self.previous_x), 0)
+        if self.previous_y is not None:
+            self.previous_y = self.previous_y.masked_fill(_batch_mask(reset_mask, self.previous_y), 0)
 
 
 class StreamingAdd(StreamingModule[_StreamingAddState]):
@@ -465,8 +537,13 @@ class StreamingAdd(StreamingModule[_StreamingAddState]):
 class _StreamingConvState:
     previous: torch.Tensor | None = None
 
-    def reset(self):
-        self.previous = None
+    def reset(self, reset_mask: Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.previous = None
+        elif self.previous is not None:
+            # Zeros are what a fresh stream sees with constant padding, see `StreamingConv1d`
+            # for the other padding modes.
+            self.previous = self.previous.masked_fill(_batch_mask(reset_mask, self.previous), 0)
 
 
 class RawStreamingConv1d(torch.nn.Conv1d, StreamingModule[_StreamingConvState]):
@@ -513,10 +590,15 @@ class RawStreamingConv1d(torch.nn.Conv1d, StreamingModule[_StreamingConvState]):
 
 @dataclass
 class _StreamingConvTrState:
+    # Pending contribution to the next output frames, with the bias already removed,
+    # so that a fresh stream corresponds to all zeros.
     partial: torch.Tensor | None = None
 
-    def reset(self):
-        self.partial = None
+    def reset(self, reset_mask: Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.partial = None
+        elif self.partial is not None:
+            self.partial = self.partial.masked_fill(_batch_mask(reset_mask, self.partial), 0)
 
 
 class RawStreamingConvTranspose1d(
@@ -555,10 +637,7 @@ class RawStreamingConvTranspose1d(
                 # of the `partial` tensor corresponds to the first time step of `out` as anything
                 # coming before the first time step of `out` would have been already flushed.
                 PT = partial.shape[-1]
-                if self.bias is not None:
-                    out[..., :PT] += partial - self.bias[:, None]
-                else:
-                    out[..., :PT] += partial
+                out[..., :PT] += partial
             # The input is T, the output is S * (T - 1) + K.
             # The offset of the left of the next frame will be S * T
             # so everything between 0 and S * T is ready to be output, and we need
@@ -566,6 +645,8 @@ class RawStreamingConvTranspose1d(
             invalid_steps = kernel - stride
             partial = out[..., OT - invalid_steps :]
             out = out[..., : OT - invalid_steps]
+            if self.bias is not None:
+                partial = partial - self.bias[:, None]
             self._streaming_state.partial = partial
             return out
 
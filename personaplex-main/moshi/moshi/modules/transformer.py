@@ -232,6 +232,9 @@ class KVCacheResult(tp.NamedTuple):
 class RingKVCache:
     """Efficient streaming KVCache to be compatible with Cuda Graph.
 
+    Each batch entry keeps its own end offset, so that entries can be reset
+    independently when several streams share the same batch.
+
     Args:
         batch_size (int): Batch size.
         num_heads (int): Number of heads in the attention.
@@ -255,29 +258,42 @@ class RingKVCache:
             device=device,
             dtype=dtype,
         )
-        self.end_offset = torch.zeros(1, device=device, dtype=torch.long)
+        self.end_offset = torch.zeros(batch_size, device=device, dtype=torch.long)
 
-    def reset(self):
-        self.end_offset.zero_()
+    def reset(self, reset_mask: tp.Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.end_offset.zero_()
+        else:
+            self.end_offset.masked_fill_(reset_mask.to(self.end_offset.device), 0)
 
-    def complete(self, k: torch.Tensor, v: torch.Tensor) -> KVCacheResult:
+    def complete(self, k: torch.Tensor, v: torch.Tensor,
+                 exec_mask: tp.Optional[torch.Tensor] = None) -> KVCacheResult:
         assert k.shape[:-1] == v.shape[:-1], (k.shape, v.shape)
         B, H, T, D = k.shape
-        indexes = torch.arange(T, device=self.end_offset.device, dtype=self.end_offset.dtype) + self.end_offset
-        indexes = indexes % self.capacity
-        self.cache[0].index_copy_(2, indexes, k)
-        self.cache[1].index_copy_(2, indexes, v)
-        self.end_offset.add_(T)
+        indexes = torch.arange(T, device=self.end_offset.device, dtype=self.end_offset.dtype)
+        indexes = (indexes + self.end_offset.view(-1, 1)) % self.capacity
+        indexes = indexes.view(B, 1, T, 1).expand(-1, H, -1, D)
+        if exec_mask is not None:
+            # Batch entries that are not executed keep their previous content.
+            keep = ~exec_mask.view(-1, 1, 1, 1)
+            k = torch.where(keep, self.cache[0].gather(2, indexes), k)
+            v = torch.where(keep, self.cache[1].gather(2, indexes), v)
+            self.end_offset.add_(exec_mask.to(self.end_offset.dtype) * T)
+        else:
+            self.end_offset.add_(T)
+        self.cache[0].scatter_(2, indexes, k)
+        self.cache[1].scatter_(2, indexes, v)
 
         keys = self.cache[0]
         values = self.cache[1]
 
         indexes = torch.arange(
             self.capacity, device=self.end_offset.device, dtype=torch.long
-        )
-        invalid = indexes >= self.end_offset
+        ).view(1, -1)
+        end_offset = self.end_offset.view(-1, 1)
+        invalid = indexes >= end_offset
 
-        end_index = self.end_offset % self.capacity
+        end_index = end_offset % self.capacity
         delta = indexes - end_index
 
         # If last key is for step S, and capacity is C, last key was written at index S % C.
@@ -291,8 +307,8 @@ class RingKVCache:
 
         positions = torch.where(
             delta <= 0,
-            self.end_offset + delta,
-            self.end_offset + delta - self.capacity,
+            end_offset + delta,
+            end_offset + delta - self.capacity,
         )
         positions = torch.where(invalid, torch.full_like(positions, -1), positions)
 
@@ -301,17 +317,41 @@ class RingKVCache:
     def asdict(self):
         return {"cache": self.cache, "end_offset": self.end_offset}
 
+    def get_entry(self, index: int) -> dict[str, torch.Tensor]:
+        end_offset = self.end_offset[index].clone()
+        # Positions past `end_offset` are never attended to, only the filled part is copied.
+        filled = min(int(end_offset), self.capacity)
+        return {"cache": self.cache[:, index, :, :filled].clone(), "end_offset": end_offset}
+
+    def set_entry(self, index: int, entry: dict[str, torch.Tensor]):
+        filled = entry["cache"].shape[2]
+        self.cache[:, index, :, :filled].copy_(entry["cache"])
+        self.end_offset[index].copy_(entry["end_offset"])
+
 
 @dataclass
 class _MHAState:
     kv_cache: RingKVCache
     offset: torch.Tensor
     offset_cpu: int
+    exec_mask: tp.Optional[torch.Tensor] = None
+
+    def reset(self, reset_mask: tp.Optional[torch.Tensor] = None):
+        self.kv_cache.reset(reset_mask)
+        if reset_mask is None:
+            self.offset.zero_()
+            self.offset_cpu = 0
+        else:
+            self.offset.masked_fill_(reset_mask.to(self.offset.device), 0)
 
-    def reset(self):
-        self.kv_cache.reset()
-        self.offset.zero_()
-        self.offset_cpu = 0
+    def get_entry(self, index: int) -> dict[str, torch.Tensor]:
+        entry = {f"kv_cache.{key}": value for key, value in self.kv_cache.get_entry(index).items()}
+        entry["offset"] = self.offset[index].clone()
+        return entry
+
+    def set_entry(self, index: int, entry: dict[str, torch.Tensor]):
+        self.kv_cache.set_entry(index, {key: entry[f"kv_cache.{key}"] for key in ("cache", "end_offset")})
+        self.offset[index].copy_(entry["offset"])
 
 
 class StreamingMultiheadAttention(StreamingModule[_MHAState]):
@@ -386,7 +426,7 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
         )
         return _MHAState(
             kv_cache,
-            offset=torch.zeros(1, device=device, dtype=torch.long),
+            offset=torch.zeros(batch_size, device=device, dtype=torch.long),
             offset_cpu=0,
         )
 
@@ -395,7 +435,7 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
         if state is None:
             return KVCacheResult.from_kv(k, v)
         else:
-            return state.kv_cache.complete(k, v)
+            return state.kv_cache.complete(k, v, state.exec_mask)
 
     def forward(self, query: torch.Tensor, key: torch.Tensor, value: torch.Tensor):
         state = self._streaming_state
@@ -424,14 +464,16 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
 
         k, v, pos_k = self._complete_kv(k, v)
         if self.causal:
-            pos_k = pos_k.view(1, -1)
-            pos_q = offset + torch.arange(T, device=q.device, dtype=torch.long).view(
-                -1, 1
+            # pos_k is [S] when not streaming, and [B, S] with one set of positions per batch entry otherwise.
+            pos_k = pos_k.view(-1, 1, pos_k.shape[-1])
+            pos_q = offset.view(-1, 1, 1) + torch.arange(T, device=q.device, dtype=torch.long).view(
+                1, -1, 1
             )
             delta = pos_q - pos_k
             attn_bias = (pos_k >= 0) & (delta >= 0)
             if self.context is not None:
                 attn_bias = attn_bias & (delta < self.context)
+            attn_bias = attn_bias[:, None]
         else:
             attn_bias = None
         x = F.scaled_dot_product_attention(q, k, v, attn_bias, dropout_p=0.0)
@@ -442,7 +484,10 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
         else:
             x = self.out_proj(x)
         if state is not None:
-            state.offset.add_(T)
+            if state.exec_mask is None:
+                state.offset.add_(T)
+            else:
+                state.offset.add_(state.exec_mask.to(state.offset.dtype) * T)
             state.offset_cpu += T
         return x
 
@@ -451,8 +496,16 @@ class StreamingMultiheadAttention(StreamingModule[_MHAState]):
 class _LayerState:
     offset_cpu: int
 
-    def reset(self):
-        self.offset_cpu = 0
+    def reset(self, reset_mask: tp.Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.offset_cpu = 0
+
+    # `offset_cpu` is shared by the whole batch, there is nothing specific to a batch entry.
+    def get_entry(self, index: int) -> dict[str, torch.Tensor]:
+        return {}
+
+    def set_entry(self, index: int, entry: dict[str, torch.Tensor]):
+        pass
 
 
 class StreamingTransformerLayer(StreamingModule[_LayerState]):
@@ -619,9 +672,19 @@ class StreamingTransformerLayer(StreamingModule[_LayerState]):
 @dataclass
 class _TransformerState:
     offset: torch.Tensor
+    exec_mask: tp.Optional[torch.Tensor] = None
 
-    def reset(self):
-        self.offset.zero_()
+    def reset(self, reset_mask: tp.Optional[torch.Tensor] = None):
+        if reset_mask is None:
+            self.offset.zero_()
+        else:
+            self.offset.masked_fill_(reset_mask.to(self.offset.device), 0)
+
+    def get_entry(self, index: int) -> dict[str, torch.Tensor]:
+        return {"offset": self.offset[index].clone()}
+
+    def set_entry(self, index: int, entry: dict[str, torch.Tensor]):
+        self.offset[index].copy_(entry["offset"])
 
 
 class StreamingTransformer(StreamingModule[_TransformerState]):
@@ -693,7 +756,22 @@ class StreamingTransformer(StreamingModule[_TransformerState]):
 
     def _init_streaming_state(self, batch_size: int) -> _TransformerState:
         device = next(self.parameters()).device
-        return _TransformerState(offset=torch.zeros(1, device=device, dtype=torch.long))
+        return _TransformerState(offset=torch.zeros(batch_size, device=device, dtype=torch.long))
+
+    def set_exec_mask(self, exec_mask: tp.Optional[torch.Tensor]):
+        """Restrict the next streaming steps to the batch entries where `exec_mask` is True.
+        The other entries still go through the computation, but their KV caches and offsets are
+        left untouched. The same tensor is shared by all the layers, so it can be updated in place
+        between steps, e.g. when CUDA Graphed. Pass None to execute all the entries again.
+        """
+        def _set(name: str, module: StreamingModule):
+            state = module._streaming_state
+            if state is None:
+                raise ValueError(f"Trying to set the exec mask, but {name} isn't streaming.")
+            if hasattr(state, "exec_mask"):
+                state.exec_mask = exec_mask
+
+        self._apply_named_streaming(_set)
 
     def forward(self, x: torch.Tensor, *args, **kwargs):
         B, T, C = x.shape
@@ -716,7 +794,10 @@ class StreamingTransformer(StreamingModule[_TransformerState]):
             x = layer(x, *args, **kwargs)
 
         if state is not None:
-            state.offset.add_(T)
+            if state.exec_mask is None:
+                state.offset.add_(T)
+            else:
+                state.offset.add_(state.exec_mask.to(state.offset.dtype) * T)
         return x
 
 
@@ -90,7 +90,7 @@ def wrap_with_system_tags(text: str) -> str:
     return f"<system> {cleaned} <system>"
 
 
-def warmup(mimi: MimiModel, other_mimi: MimiModel, lm_gen: LMGen, device: str, frame_size: int):
+def warmup(mimi: MimiModel, other_mimi: Optional[MimiModel], lm_gen: LMGen, device: str, frame_size: int):
     """Run a short warmup loop to initialize CUDA graphs and streaming state.
 
     Replicates the same warmup behavior as server.py: zeros → encode → LMGen.step → decode.
@@ -98,26 +98,30 @@ def warmup(mimi: MimiModel, other_mimi: MimiModel, lm_gen: LMGen, device: str, f
     for _ in range(4):
         chunk = torch.zeros(1, 1, frame_size, dtype=torch.float32, device=device)
         codes = mimi.encode(chunk)
-        _ = other_mimi.encode(chunk)
+        if other_mimi is not None:
+            _ = other_mimi.encode(chunk)
         for c in range(codes.shape[-1]):
             tokens = lm_gen.step(codes[:, :, c : c + 1])
             if tokens is None:
                 continue
             # Decode agent audio channels to ensure decode graphs/states are primed
             _ = mimi.decode(tokens[:, 1:9])
-            _ = other_mimi.decode(tokens[:, 1:9])
+            if other_mimi is not None:
+                _ = other_mimi.decode(tokens[:, 1:9])
     if torch.cuda.is_available():
         torch.cuda.synchronize()
 
 
-def decode_tokens_to_pcm(mimi: MimiModel, other_mimi: MimiModel, lm_gen: LMGen, tokens: torch.Tensor) -> np.ndarray:
+def decode_tokens_to_pcm(mimi: MimiModel, other_mimi: Optional[MimiModel], lm_gen: LMGen, tokens: torch.Tensor) -> np.ndarray:
     """Decode a single step of model tokens to PCM using Mimi.
 
     tokens is shaped [B, dep_q+1, 1]; channels 1..dep_q are the agent audio codebooks.
     Returns a 1D float32 numpy array (mono) for the current frame.
     """
     pcm = mimi.decode(tokens[:, 1:9])
-    _ = other_mimi.decode(tokens[:, 1:9])
+    if other_mimi is not None:
+        # Mirror codec kept in lockstep, its output is not used.
+        _ = other_mimi.decode(tokens[:, 1:9])
     pcm = pcm.detach().cpu().numpy()[0, 0]
     return pcm
 
@@ -169,6 +173,9 @@ def run_inference(
     greedy: bool,
     save_voice_prompt_embeddings: bool,
     cpu_offload: bool = False,
+    other_mimi: bool = True,
+    depformer_codebooks: Optional[int] = None,
+    prefill_chunk_size: int = 1,
 ):
     """Run offline inference using an input WAV as the user-side stream.
 
@@ -191,7 +198,8 @@ def run_inference(
     if mimi_weight is None:
         mimi_weight = hf_hub_download(hf_repo, loaders.MIMI_NAME)  # type: ignore
     mimi = loaders.get_mimi(mimi_weight, device)
-    other_mimi = loaders.get_mimi(mimi_weight, device)
+    # Same weights, its own streaming state. Its outputs are not used, the agent audio is the same without it.
+    other_mimi = mimi.shared_copy() if other_mimi else None
     log("info", "mimi loaded")
 
     # 2) Load tokenizer
@@ -221,10 +229,13 @@ def run_inference(
         temp_text=temp_text,
         top_k=topk_audio,
         top_k_text=topk_text,
+        depformer_codebooks=depformer_codebooks,
+        prefill_chunk_size=prefill_chunk_size,
     )
     # Keep models in streaming mode similar to the server
     mimi.streaming_forever(1)
-    other_mimi.streaming_forever(1)
+    if other_mimi is not None:
+        other_mimi.streaming_forever(1)
     lm_gen.streaming_forever(1)
 
     # 5) Warmup
@@ -248,7 +259,8 @@ def run_inference(
     #    - Text prompt injection
     #    - Final audio silence
     mimi.reset_streaming()
-    other_mimi.reset_streaming()
+    if other_mimi is not None:
+        other_mimi.reset_streaming()
     lm_gen.reset_streaming()
     lm_gen.step_system_prompts(mimi)
     # Reset mimi streaming after voice prompt encoding
@@ -269,7 +281,6 @@ def run_inference(
         lm_iterate_audio(
             user_audio, sample_interval_size=lm_gen._frame_size, pad=True
         ),
-        max_batch=1,
     ):
         # user_encoded: [1, K, T]. Feed one step at a time (usually T==1)
         steps = user_encoded.shape[-1]
@@ -381,6 +392,14 @@ def main():
                         help="Offload LM model layers to CPU when GPU memory is insufficient. "
                              "Requires 'accelerate' package.")
     parser.add_argument("--seed", type=int, default=-1, help="Seed for reproducibility (-1 disables)")
+    parser.add_argument("--no-other-mimi", action="store_true",
+                        help="Do not run the mirror Mimi codec, whose outputs are not used.")
+    parser.add_argument("--depformer-codebooks", type=int,
+                        help="Codebooks sampled by the depformer at each step, all of them by default. "
+                             "8 skips the user stream ones, which are always overwritten by the input audio.")
+    parser.add_argument("--prefill-chunk", type=int, default=1,
+                        help="System prompt steps run through the transformer at once, e.g. 16. Faster, but the "
+                             "batched matmuls round differently, so outputs may differ slightly from step by step.")
 
     args = parser.parse_args()
 
@@ -424,6 +443,9 @@ def main():
             greedy=greedy,
             save_voice_prompt_embeddings=False,
             cpu_offload=args.cpu_offload,
+            other_mimi=not args.no_other_mimi,
+            depformer_codebooks=args.depformer_codebooks,
+            prefill_chunk_size=args.prefill_chunk,
         )
 
 
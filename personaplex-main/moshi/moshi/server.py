@@ -26,17 +26,23 @@
 
 import argparse
 import asyncio
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 import random
+import json
+import math
 import os
 from pathlib import Path
 import tarfile
+import threading
 import time
 import secrets
 import sys
 import re
 import shutil
-from typing import Literal, Optional
+from typing import Awaitable, Iterator, Literal, Optional
 
 import aiohttp
 from aiohttp import web
@@ -49,12 +55,16 @@ import random
 
 from .client_utils import make_log, colorize
 from .models import loaders, MimiModel, LMModel, LMGen
+from .models.lm import AUDIO_TOKENS_PER_STREAM
 from .utils.connection import create_ssl_context, get_lan_ip
 from .utils.logging import setup_logger, ColorizedLog
+from .utils.metrics import Metrics, StageTimer
 
 
 logger = setup_logger(__name__)
 DeviceString = Literal["cuda"] | Literal["cpu"] #| Literal["mps"]
+CatchUpPolicy = Literal["drop", "silence", "batch"]
+OtherMimiMode = Literal["off", "sync", "async"]
 
 def torch_auto_device(requested: Optional[DeviceString] = None) -> torch.device:
     """Return a torch.device based on the requested string or availability."""
@@ -78,6 +88,45 @@ def seed_all(seed):
     torch.backends.cudnn.benchmark = False
 
 
+def _init_stage_thread(stream: Optional[torch.cuda.Stream] = None):
+    """Initializer of the threads running the model stages. Grad mode and the current CUDA stream
+    are thread local, with their own `stream` the stages of consecutive frames can overlap on the GPU."""
+    torch.set_grad_enabled(False)
+    if stream is not None:
+        torch.cuda.set_stream(stream)
+
+
+def _stage_executor(name: str, stream: Optional[torch.cuda.Stream] = None) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix=name,
+                              initializer=_init_stage_thread, initargs=(stream,))
+
+
+class BootTimeline:
+    """Phases of the server startup, some of them running concurrently, with their start and end
+    in seconds since the beginning of the startup. Used for the logs and to report readiness."""
+    def __init__(self):
+        self.started = time.time()
+        self.phases: dict[str, dict] = {}
+
+    def run(self, name: str, fn, *args):
+        phase = {"status": "running", "start": round(time.time() - self.started, 2)}
+        self.phases[name] = phase
+        try:
+            result = fn(*args)
+        except Exception:
+            phase["status"] = "failed"
+            logger.exception(f"startup phase {name} failed")
+            raise
+        phase["end"] = round(time.time() - self.started, 2)
+        phase["status"] = "done"
+        logger.info(f"startup phase {name} done in {phase['end'] - phase['start']:.1f}s")
+        return result
+
+    def summary(self) -> str:
+        return ", ".join(f"{name} {phase['start']:.1f}-{phase.get('end', float('nan')):.1f}s"
+                         for name, phase in sorted(self.phases.items(), key=lambda item: item[1]["start"]))
+
+
 def wrap_with_system_tags(text: str) -> str:
     """Add system tags as the model expects if they are missing.
     Example: "<system> You enjoy having a good conversation. Have a deep conversation about technology. Your name is Jane. <system>"
@@ -90,7 +139,7 @@ def wrap_with_system_tags(text: str) -> str:
 def _cors_headers():
     return {
         "Access-Control-Allow-Origin": "*",
-        "Access-Control-Allow-Methods": "POST, OPTIONS",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
         "Access-Control-Allow-Headers": "Content-Type, X-Upload-Token",
         "Access-Control-Max-Age": "86400",
     }
@@ -112,6 +161,94 @@ def _unique_path(directory: str, filename: str) -> tuple[str, str]:
         counter += 1
     return os.path.join(directory, candidate), candidate
 
+@dataclass
+class VoicePromptEntry:
+    name: str  # Path relative to the voice prompt directory, as requested by the clients.
+    path: str
+    kind: Literal["wav", "pt"]
+    size: int
+    # For a .wav prompt, whether the matching .pt embeddings are available too.
+    has_embeddings: bool = False
+
+
+class VoicePromptIndex:
+    """In-memory index of the voice prompts found under `directory`, by name.
+
+    The directory is scanned once at startup, uploads are added as they complete, and `watch`
+    rescans it periodically in a worker thread to pick up files added by other means.
+    """
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        self.entries: dict[str, VoicePromptEntry] = {}
+        self.fallback_entry: Optional[VoicePromptEntry] = None
+        self._set_entries(self._scan())
+
+    def _set_entries(self, entries: dict[str, VoicePromptEntry]):
+        self.entries = entries
+        self.fallback_entry = next((entry for _, entry in sorted(entries.items()) if entry.kind == "pt"), None)
+
+    def _entry(self, path: str) -> Optional[VoicePromptEntry]:
+        kind = os.path.splitext(path)[1].lower()[1:]
+        if kind not in ("wav", "pt") or not os.path.isfile(path):
+            return None
+        name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        return VoicePromptEntry(name=name, path=path, kind=kind, size=os.path.getsize(path),
+                                has_embeddings=kind == "wav" and os.path.isfile(os.path.splitext(path)[0] + ".pt"))
+
+    def _scan(self) -> dict[str, VoicePromptEntry]:
+        entries = {}
+        for root, _dirs, files in os.walk(self.directory):
+            for filename in sorted(files):
+                entry = self._entry(os.path.join(root, filename))
+                if entry is not None:
+                    entries[entry.name] = entry
+        return entries
+
+    async def watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self._set_entries(await asyncio.to_thread(self._scan))
+            except OSError:
+                logger.warning("Failed to rescan %s", self.directory, exc_info=True)
+
+    def add(self, path: str):
+        entry = self._entry(os.path.abspath(path))
+        if entry is None:
+            return
+        self.entries[entry.name] = entry
+        if entry.kind == "pt":
+            if self.fallback_entry is None or entry.name < self.fallback_entry.name:
+                self.fallback_entry = entry
+            wav = self.entries.get(os.path.splitext(entry.name)[0] + ".wav")
+            if wav is not None:
+                wav.has_embeddings = True
+
+    def lookup(self, name: str) -> Optional[VoicePromptEntry]:
+        entry = self.entries.get(name)
+        if entry is None and name:
+            # Files added since the last scan, a single stat rather than a listing.
+            path = os.path.abspath(os.path.join(self.directory, name))
+            if path.startswith(self.directory + os.sep):
+                self.add(path)
+                entry = self.entries.get(name)
+        return entry
+
+    def fallback(self) -> Optional[VoicePromptEntry]:
+        """First .pt voice prompt by name, used when the requested one is missing."""
+        return self.fallback_entry
+
+
+async def handle_voice_prompt_list(request):
+    voice_index = request.app.get("voice_index")
+    if voice_index is None:
+        return _cors_json_response({"error": "voice_prompt_dir not configured"}, status=500)
+    voices = [
+        {"name": entry.name, "kind": entry.kind, "bytes": entry.size, "has_embeddings": entry.has_embeddings}
+        for _, entry in sorted(voice_index.entries.items())
+    ]
+    return _cors_json_response({"voices": voices})
+
 async def handle_voice_prompt_options(_request):
     return web.Response(status=204, headers=_cors_headers())
 
@@ -174,71 +311,272 @@ async def handle_voice_prompt_upload(request):
         logger.exception("Upload failed")
         return _cors_json_response({"error": "Upload failed"}, status=500)
 
+    voice_index = request.app.get("voice_index")
+    if voice_index is not None:
+        voice_index.add(dest_path)
+
+    # The embeddings are computed in the background, later sessions pick up the .pt file.
+    submit_voice_job = request.app.get("submit_voice_job")
+    job = submit_voice_job(dest_path) if submit_voice_job is not None else None
+    if job is not None:
+        return _cors_json_response({"filename": final_name, "bytes": size, "job_id": job.id,
+                                    "status_url": f"/api/voice_prompt/jobs/{job.id}"})
+
     return _cors_json_response({"filename": final_name, "bytes": size})
 
 
 class PcmStreamReader:
-    def __init__(self, sample_rate):
+    """Buffers the incoming PCM16 bytes into a float32 ring buffer and hands them out frame by frame.
+
+    `on_frame` is called each time a frame of `frame_size` samples is complete, so that consumers
+    are woken up once per frame rather than polling the buffer. The samples are converted in place
+    into the ring, which is only reallocated when the backlog outgrows it.
+    """
+    def __init__(self, sample_rate, frame_size, on_frame=None, capacity_frames: int = 8):
         self.sample_rate = sample_rate
-        self.buffer = bytearray()
-    
+        self.frame_size = frame_size
+        self.on_frame = on_frame
+        self.ring = np.zeros(capacity_frames * frame_size, dtype=np.float32)
+        self.start = 0
+        self.size = 0
+        # Trailing byte of a message that ended in the middle of a sample.
+        self.odd_byte = b""
+
+    @property
+    def pending_frames(self) -> int:
+        return self.size // self.frame_size
+
+    def _grow(self, size: int):
+        capacity = len(self.ring)
+        while capacity < size:
+            capacity *= 2
+        ring = np.zeros(capacity, dtype=np.float32)
+        self._copy_out(ring[:self.size])
+        self.ring = ring
+        self.start = 0
+
+    def _copy_out(self, out: np.ndarray):
+        n = len(out)
+        first = min(n, len(self.ring) - self.start)
+        out[:first] = self.ring[self.start: self.start + first]
+        out[first:] = self.ring[: n - first]
+
     def append_bytes(self, data):
-        self.buffer.extend(data)
-        
-    def read_pcm(self):
-        # We need at least 2 bytes for one 16-bit sample
-        if len(self.buffer) < 2:
-            return None
-            
-        # Extract all available even-byte data
-        available = len(self.buffer)
-        if available % 2 != 0:
-            available -= 1
-        
-        data = self.buffer[:available]
-        self.buffer = self.buffer[available:]
-        
-        # Convert PCM16 (bytes) to float32 numpy array [-1, 1]
-        raw_np = np.frombuffer(data, dtype=np.int16)
-        float_np = raw_np.astype(np.float32) / 32768.0
-        
-        # Return as (1, samples) mono
-        return float_np.reshape(1, -1)
+        if self.odd_byte:
+            data = self.odd_byte + bytes(data)
+            self.odd_byte = b""
+        if len(data) % 2:
+            self.odd_byte = bytes(data[-1:])
+        # Converts PCM16 to float32 [-1, 1] while copying into the ring.
+        self._append_samples(np.frombuffer(data, dtype=np.int16, count=len(data) // 2), np.float32(1 / 32768))
+
+    def _append_samples(self, samples: np.ndarray, scale):
+        if self.size + len(samples) > len(self.ring):
+            self._grow(self.size + len(samples))
+        frames_before = self.pending_frames
+        end = (self.start + self.size) % len(self.ring)
+        first = min(len(samples), len(self.ring) - end)
+        np.multiply(samples[:first], scale, out=self.ring[end: end + first])
+        np.multiply(samples[first:], scale, out=self.ring[: len(samples) - first])
+        self.size += len(samples)
+        if self.on_frame is not None:
+            for _ in range(self.pending_frames - frames_before):
+                self.on_frame()
+
+    def read_frame(self, out: np.ndarray):
+        """Copies the oldest complete frame into `out`, of shape [frame_size]."""
+        assert self.size >= self.frame_size
+        self._copy_out(out)
+        self.start = (self.start + self.frame_size) % len(self.ring)
+        self.size -= self.frame_size
+
+    def skip_frames(self, count: int):
+        """Drops the `count` oldest complete frames."""
+        assert self.size >= count * self.frame_size
+        self.start = (self.start + count * self.frame_size) % len(self.ring)
+        self.size -= count * self.frame_size
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+        self.odd_byte = b""
+
 
 class PcmStreamWriter:
+    """Buffers the decoded PCM as PCM16 bytes, `wait_bytes` wakes up as soon as some is available.
+
+    Samples are written straight into a preallocated message that already starts with the audio
+    message kind. Two messages are used in turn, so that one can be sent while the engine
+    writes the next one.
+    """
+    def __init__(self, sample_rate, capacity: int = 8 * 1920):
+        self.messages = [self._new_message(capacity), self._new_message(capacity)]
+        self.current = 0
+        self.size = 0
+        self.scratch = np.empty(1920, dtype=np.float32)
+        self.ready = asyncio.Event()
+
+    @staticmethod
+    def _new_message(capacity: int) -> bytearray:
+        message = bytearray(1 + 2 * capacity)
+        message[0] = 1
+        return message
+
+    def append_pcm(self, pcm_np):
+        message = self.messages[self.current]
+        needed = 1 + 2 * (self.size + len(pcm_np))
+        if needed > len(message):
+            grown = self._new_message(max(needed, 2 * len(message)) // 2)
+            grown[: 1 + 2 * self.size] = message[: 1 + 2 * self.size]
+            self.messages[self.current] = message = grown
+        out = np.frombuffer(message, dtype=np.int16, offset=1 + 2 * self.size, count=len(pcm_np))
+        if len(self.scratch) < len(pcm_np):
+            self.scratch = np.empty(len(pcm_np), dtype=np.float32)
+        scratch = self.scratch[: len(pcm_np)]
+        # pcm_np is float32. Clip to [-1, 1] and scale to Int16 directly into the message.
+        np.clip(pcm_np, -1.0, 1.0, out=scratch)
+        np.multiply(scratch, 32767, out=scratch)
+        np.copyto(out, scratch, casting="unsafe")
+        self.size += len(pcm_np)
+        self.ready.set()
+
+    def read_message(self) -> memoryview:
+        """Returns the pending audio message, valid until the next call."""
+        message = memoryview(self.messages[self.current])[: 1 + 2 * self.size]
+        self.current = 1 - self.current
+        self.size = 0
+        self.ready.clear()
+        return message
+
+    async def wait_message(self) -> memoryview:
+        await self.ready.wait()
+        return self.read_message()
+
+
+class OpusStreamReader(PcmStreamReader):
+    """Same as `PcmStreamReader` for an Ogg/Opus stream, decoded with sphn as the bytes come in."""
+    def __init__(self, sample_rate, frame_size, on_frame=None, capacity_frames: int = 8):
+        super().__init__(sample_rate, frame_size, on_frame, capacity_frames)
+        self.decoder = sphn.OpusStreamReader(sample_rate)
+
+    def append_bytes(self, data):
+        self.decoder.append_bytes(bytes(data))
+        pcm = self.decoder.read_pcm()
+        if pcm is not None and pcm.shape[-1] > 0:
+            self._append_samples(pcm, np.float32(1))
+
+    def clear(self):
+        super().clear()
+        self.decoder.read_pcm()
+
+
+class OpusStreamWriter:
+    """Same as `PcmStreamWriter` for an Ogg/Opus stream, encoded with sphn frame by frame."""
     def __init__(self, sample_rate):
-        self.buffer = bytearray()
-        
+        self.encoder = sphn.OpusStreamWriter(sample_rate)
+        self.ready = asyncio.Event()
+
     def append_pcm(self, pcm_np):
-        # pcm_np is float32. Convert to Int16 PCM.
-        # Clip to [-1, 1]
-        pcm_np = np.clip(pcm_np, -1.0, 1.0)
-        # Scale to Int16
-        pcm_int16 = (pcm_np * 32767).astype(np.int16)
-        # Append bytes
-        self.buffer.extend(pcm_int16.tobytes())
-        
-    def read_bytes(self):
-        data = bytes(self.buffer)
-        self.buffer.clear()
-        return data
+        self.encoder.append_pcm(np.clip(pcm_np, -1.0, 1.0))
+        self.ready.set()
+
+    def read_message(self) -> bytes:
+        self.ready.clear()
+        return b"\x01" + self.encoder.read_bytes()
+
+    async def wait_message(self) -> bytes:
+        await self.ready.wait()
+        return self.read_message()
+
+
+_STREAM_CODECS = {
+    "pcm": (PcmStreamReader, PcmStreamWriter),
+    "opus": (OpusStreamReader, OpusStreamWriter),
+}
+
+
+@dataclass
+class _Slot:
+    """One connection served by the batch engine, bound to one batch entry of the models."""
+    index: int
+    clog: ColorizedLog
+    reader: PcmStreamReader | OpusStreamReader
+    writer: PcmStreamWriter | OpusStreamWriter
+    text_prompt_tokens: list[int]
+    voice_prompt_path: Optional[str]
+    seed: Optional[int]
+    prompt_done: asyncio.Future
+    # Reception times of the frames pending in `reader`, consumed by the batch engine.
+    frames: deque = field(default_factory=deque)
+    # Time from the reception of an input frame to the output of its step, in seconds.
+    latency: list[float] = field(default_factory=list)
+    # Input frames discarded by the catch-up policy.
+    dropped_frames: int = 0
+    text_messages: deque = field(default_factory=deque)
+    waiting_since: Optional[float] = None
+    # Reception time of the last input frame, to tell a late frame from a gap in the input.
+    last_frame_at: float = field(default_factory=time.time)
+    prompt_started: float = 0.
+    started: float = field(default_factory=time.time)
+    live_since: Optional[float] = None
+    live: bool = False
+    closed: bool = False
+
+
+@dataclass
+class _VoiceJob:
+    """Background computation of the .pt embeddings of an uploaded voice prompt, run by the batch engine
+    in a free slot, in between the frames of the live slots."""
+    id: str
+    path: str
+    status: Literal["queued", "running", "done", "failed"] = "queued"
+    error: Optional[str] = None
+    index: int = -1
+    prompt_done: Optional[asyncio.Future] = None
+    prompt_started: float = 0.
+    closed: bool = False
+    # Prompt steps of the job, one per frame of the voice prompt and one to save it, and those done so far.
+    steps: int = 1
+    steps_done: int = 0
+
+    def asdict(self) -> dict:
+        return {"job_id": self.id, "filename": os.path.basename(self.path), "status": self.status,
+                "error": self.error}
+
+    def remaining_seconds(self, now: float, step_seconds: float) -> float:
+        """Estimated time left, at the pace of the steps done so far or `step_seconds` per step before."""
+        if self.steps_done:
+            step_seconds = (now - self.prompt_started) / self.steps_done
+        return max(self.steps - self.steps_done, 1) * step_seconds
+
 
 @dataclass
 class ServerState:
     mimi: MimiModel
-    other_mimi: MimiModel
+    other_mimi: Optional[MimiModel]
     text_tokenizer: sentencepiece.SentencePieceProcessor
     lm_gen: LMGen
-    lock: asyncio.Lock
+    batch_size: int
+    PIPELINE_DEPTH = 3
+    MIRROR_BACKLOG = 16
+    MAX_QUEUED_VOICE_JOBS = 32
 
-    def __init__(self, mimi: MimiModel, other_mimi: MimiModel, text_tokenizer: sentencepiece.SentencePieceProcessor,
+    def __init__(self, mimi: MimiModel, other_mimi: Optional[MimiModel], text_tokenizer: sentencepiece.SentencePieceProcessor,
                  lm: LMModel, device: str | torch.device, voice_prompt_dir: str | None = None,
-                 save_voice_prompt_embeddings: bool = False):
+                 save_voice_prompt_embeddings: bool = False, batch_size: int = 1,
+                 voice_prompt_cache_bytes: int = 256 * 2**20,
+                 prompt_snapshot_cache_bytes: int = 1024 * 2**20, max_queue: int = 8,
+                 max_input_backlog: int = 12, catch_up: CatchUpPolicy = "drop", pipeline: bool = False,
+                 other_mimi_mode: OtherMimiMode = "sync", voice_index: Optional[VoicePromptIndex] = None,
+                 depformer_codebooks: Optional[int] = None, prefill_chunk_size: int = 1):
         self.mimi = mimi
         self.other_mimi = other_mimi
         self.text_tokenizer = text_tokenizer
-        self.device = device
+        self.device = torch.device(device)
         self.voice_prompt_dir = voice_prompt_dir
+        if voice_index is None and voice_prompt_dir is not None:
+            voice_index = VoicePromptIndex(voice_prompt_dir)
+        self.voice_index = voice_index
         self.frame_size = int(self.mimi.sample_rate / self.mimi.frame_rate)
         self.lm_gen = LMGen(lm,
                             audio_silence_frame_cnt=int(0.5 * self.mimi.frame_rate),
@@ -246,30 +584,658 @@ class ServerState:
                             device=device,
                             frame_rate=self.mimi.frame_rate,
                             save_voice_prompt_embeddings=save_voice_prompt_embeddings,
+                            voice_prompt_cache_bytes=voice_prompt_cache_bytes,
+                            prompt_snapshot_cache_bytes=prompt_snapshot_cache_bytes,
+                            depformer_codebooks=depformer_codebooks,
+                            prefill_chunk_size=prefill_chunk_size,
         )
-        
-        self.lock = asyncio.Lock()
+
+        # Each connection gets one batch entry (slot), and one `LMGen.step` advances all the live slots.
+        self.batch_size = batch_size
+        # Input frames a live slot can have pending when compute falls behind real time, and what is
+        # done with the ones over that limit, see `_catch_up`. Also how many frame periods the live slots
+        # wait for a slot whose input stopped before feeding it silence, see `_frame_wait`.
+        self.max_input_backlog = max_input_backlog
+        self.catch_up = catch_up
+        self.slots: list[Optional[_Slot]] = [None] * batch_size
+        # Admission: free slot indices, and a bounded FIFO of the callers waiting for one.
+        self.free_slots: list[int] = list(range(batch_size))
+        self.waiters: deque[asyncio.Future] = deque()
+        self.max_queue = max_queue
+        # Running mean of the duration of the sessions, to estimate the wait in the queue.
+        self.mean_session_duration = 120.
+        self.pending_prompts: deque = deque()
+        # With `pipeline`, the Mimi encoding, the LM step and the Mimi decoding of a frame run on their own
+        # threads, so that up to `PIPELINE_DEPTH` consecutive frames are in flight, one per stage.
+        self.pipeline = pipeline
+        self.in_flight: deque[asyncio.Task] = deque()
+        # Input frames of all the slots, pinned so that the copy to the GPU can be asynchronous.
+        # One buffer per frame in flight, a buffer is only filled again once its frame is done.
+        self.input_chunks = [
+            torch.zeros(batch_size, 1, self.frame_size, dtype=torch.float32,
+                        pin_memory=self.device.type == 'cuda').numpy()
+            for _ in range(self.PIPELINE_DEPTH if pipeline else 1)]
+        self.input_chunk_index = 0
+        self.prompting: Optional[_Slot] = None
+        self.prompt_steps: Optional[Iterator[None]] = None
+        self.engine_task: Optional[asyncio.Task] = None
+        self.voice_jobs: OrderedDict[str, _VoiceJob] = OrderedDict()
+        # Voice jobs waiting for a slot, in their own bounded FIFO: they only get a slot that no connection
+        # is waiting for, see `_free_index`. Running jobs are referenced until they are done.
+        self.voice_waiters: deque[asyncio.Future] = deque()
+        self.voice_tasks: set[asyncio.Task] = set()
+        # The models are only ever used from this thread, so that the event loop keeps serving
+        # the network while a frame is computing. Grad mode is thread local.
+        self.metrics = Metrics()
+        self.stage_timer = StageTimer({
+            "encode": self.metrics.histogram("encode_seconds", "Mimi encoding of one batch step."),
+            "lm_main": self.metrics.histogram("lm_main_seconds", "Main transformer of one LM step."),
+            "lm_depformer": self.metrics.histogram("lm_depformer_seconds", "Depformer of one LM step."),
+            "decode": self.metrics.histogram("decode_seconds", "Mimi decoding of one LM step."),
+        }, device)
+        self.lm_gen.stage_timer = self.stage_timer
+        self.queue_wait = self.metrics.histogram(
+            "queue_wait_seconds", "Time from the reception of an input frame to the start of its step.")
+        self.send_time = self.metrics.histogram("ws_send_seconds", "Sending one audio message on the websocket.")
+        self.frame_latency = self.metrics.histogram(
+            "frame_latency_seconds", "Time from the reception of an input frame to the output of its step.")
+        self.frames_total = self.metrics.counter("frames_total", "Input frames processed.")
+        self.frames_over_budget = self.metrics.counter(
+            "frames_over_budget_total", "Input frames whose latency exceeded the duration of a frame.")
+        self.input_dropped = self.metrics.counter(
+            "input_frames_dropped_total", "Input frames discarded because the backlog of their slot was full.")
+        self.catch_up_steps = self.metrics.counter(
+            "catch_up_steps_total", "Steps that encoded several backlogged input frames at once.")
+        self.metrics.gauge(
+            "input_drift_seconds", "Age of the oldest input frame pending in any live slot.").set_function(
+            self._input_drift)
+        self.active_sessions = self.metrics.gauge("active_sessions", "Connections holding a slot.")
+        self.prompt_time = self.metrics.histogram(
+            "prompt_seconds", "Duration of the system prompts phase of a connection.",
+            buckets=(0.5, 1., 2., 3., 5., 7.5, 10., 15., 20., 30., 60.))
+        voice_prompts = self.lm_gen.voice_prompts
+        self.metrics.counter("voice_prompt_cache_hits_total", "Voice prompts found in the cache.").set_function(
+            lambda: voice_prompts.hits)
+        self.metrics.counter("voice_prompt_cache_misses_total", "Voice prompts loaded from disk.").set_function(
+            lambda: voice_prompts.misses)
+        self.metrics.gauge("voice_prompt_cache_bytes", "Memory used by the cached voice prompts.").set_function(
+            lambda: voice_prompts.nbytes)
+        self.queue_length = self.metrics.gauge("queue_length", "Connections waiting for a free slot.")
+        self.rejected = self.metrics.counter("rejected_total", "Connections rejected because the queue was full.")
+        self.admission_wait = self.metrics.histogram(
+            "admission_wait_seconds", "Time spent by a connection waiting for a free slot.",
+            buckets=(0.1, 1., 5., 10., 30., 60., 120., 300., 600.))
+        self.session_time = self.metrics.histogram(
+            "session_seconds", "Duration of the sessions, from the handshake to the disconnection.",
+            buckets=(10., 30., 60., 120., 300., 600., 1200., 3600.))
+        prompt_snapshots = self.lm_gen.prompt_snapshots
+        self.metrics.counter("prompt_snapshot_hits_total", "System prompts restored from a snapshot.").set_function(
+            lambda: prompt_snapshots.hits)
+        self.metrics.counter("prompt_snapshot_misses_total", "System prompts stepped through.").set_function(
+            lambda: prompt_snapshots.misses)
+        self.metrics.gauge("prompt_snapshot_bytes", "Memory used by the system prompt snapshots.").set_function(
+            lambda: prompt_snapshots.nbytes)
+        cuda = self.device.type == "cuda"
+        if pipeline:
+            self.executor = _stage_executor("inference", torch.cuda.Stream(self.device) if cuda else None)
+            self.encode_executor = _stage_executor("encode", torch.cuda.Stream(self.device) if cuda else None)
+            self.decode_executor = _stage_executor("decode", torch.cuda.Stream(self.device) if cuda else None)
+        else:
+            self.executor = self.encode_executor = self.decode_executor = _stage_executor("inference")
+        # The mirror codec `other_mimi` only runs to keep its state in lockstep with `mimi`, its outputs are
+        # not used. "off" skips it, "sync" runs it with the frames and "async" on a thread of its own.
+        self.other_mimi_mode = other_mimi_mode if other_mimi is not None else "off"
+        self.mirror_stream = torch.cuda.Stream(self.device) if cuda and self.other_mimi_mode == "async" else None
+        self.mirror_executor = _stage_executor("mirror", self.mirror_stream)
+        # Frames the mirror codec can lag behind, further frames are skipped rather than queued.
+        self.mirror_slots = threading.BoundedSemaphore(self.MIRROR_BACKLOG)
+        self.mirror_skipped = self.metrics.counter(
+            "other_mimi_skipped_total", "Mirror codec calls skipped because it was too far behind.")
+        # Set whenever the engine might have some work to do: a new frame or a new slot.
+        self.engine_wakeup = asyncio.Event()
+
+        # Voice prompts are encoded with a single stream Mimi state, swapped in while a slot runs its prompt.
         self.mimi.streaming_forever(1)
-        self.other_mimi.streaming_forever(1)
-        self.lm_gen.streaming_forever(1)
-    
+        self.prompt_mimi_state = self.mimi.get_streaming_state()
+        self.mimi.streaming_forever(batch_size)
+        if self.other_mimi_mode != "off":
+            self.other_mimi.streaming_forever(batch_size)
+        self.lm_gen.streaming_forever(batch_size)
+
     def warmup(self):
+        # CUDA graphs are captured on the thread of each stage, which is the one replaying them.
+        # Warmup steps are not part of the served traffic.
+        stage_timer, self.stage_timer = self.stage_timer, StageTimer({}, self.device)
+        self.lm_gen.stage_timer = None
+        chunk = np.zeros((self.batch_size, 1, self.frame_size), dtype=np.float32)
         for _ in range(4):
-            chunk = torch.zeros(1, 1, self.frame_size, dtype=torch.float32, device=self.device)
-            codes = self.mimi.encode(chunk)
-            _ = self.other_mimi.encode(chunk)
-            for c in range(codes.shape[-1]):
-                tokens = self.lm_gen.step(codes[:, :, c: c + 1])
-                if tokens is None:
-                    continue
-                _ = self.mimi.decode(tokens[:, 1:9])
-                _ = self.other_mimi.decode(tokens[:, 1:9])
-
+            codes = self.encode_executor.submit(self._encode_frame, chunk).result()
+            steps = self.executor.submit(self._lm_frame, codes, None).result()
+            self.decode_executor.submit(self._decode_frame, steps).result()
+        self.mirror_executor.submit(lambda: None).result()
         if self.device.type == 'cuda':
             torch.cuda.synchronize()
+        self.stage_timer = stage_timer
+        self.lm_gen.stage_timer = stage_timer
+
+    def _slot_mask(self, slots) -> torch.Tensor:
+        mask = torch.zeros(self.batch_size, dtype=torch.bool)
+        for slot in slots:
+            mask[slot.index] = True
+        return mask
+
+    @contextmanager
+    def _prompt_mimi(self):
+        batch_state = self.mimi.get_streaming_state()
+        self.mimi.set_streaming_state(self.prompt_mimi_state)
+        try:
+            yield
+        finally:
+            self.mimi.set_streaming_state(batch_state)
+
+    def _enqueue(self) -> asyncio.Future:
+        """Returns a future resolved with the index of a free slot, in the order of the calls."""
+        waiter = asyncio.get_running_loop().create_future()
+        if self.free_slots and not self.waiters:
+            waiter.set_result(self.free_slots.pop(0))
+        else:
+            self.waiters.append(waiter)
+            self.queue_length.set(len(self.waiters))
+        return waiter
+
+    def _cancel_waiter(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            self._free_index(waiter.result())
+        else:
+            waiter.cancel()
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+        self.queue_length.set(len(self.waiters))
+
+    def _enqueue_voice_job(self) -> asyncio.Future:
+        """Same as `_enqueue` for a voice job, which waits until no connection is waiting."""
+        waiter = asyncio.get_running_loop().create_future()
+        if self.free_slots and not self.waiters and not self.voice_waiters:
+            waiter.set_result(self.free_slots.pop(0))
+        else:
+            self.voice_waiters.append(waiter)
+        return waiter
+
+    def _free_index(self, index: int):
+        # Connections first, then voice jobs.
+        for waiters in (self.waiters, self.voice_waiters):
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(index)
+                    self.queue_length.set(len(self.waiters))
+                    return
+        self.free_slots.append(index)
+        self.queue_length.set(len(self.waiters))
+
+    def _estimated_wait(self, position: int) -> float:
+        """Estimated wait in seconds for the given 1-based position in the queue, from the time
+        left to the sessions in progress assuming they last `mean_session_duration`, and to the
+        voice jobs in progress from their remaining steps."""
+        if self.free_slots:
+            return 0.
+        now = time.time()
+        jobs = {job.index: job for job in self.voice_jobs.values() if job.index >= 0 and not job.closed}
+
+        def remaining(index: int) -> float:
+            slot = self.slots[index]
+            if slot is not None:
+                return max(self.mean_session_duration - (now - slot.started), 1.)
+            if index in jobs:
+                # Until a job has run some steps, assume that they go at the pace of the frames.
+                return jobs[index].remaining_seconds(now, 1 / self.mimi.frame_rate)
+            return 1.
+
+        remaining = sorted(remaining(index) for index in range(self.batch_size))
+        rounds, rank = divmod(position - 1, self.batch_size)
+        return remaining[rank] + rounds * self.mean_session_duration
+
+    def queue_status(self) -> dict:
+        return {
+            "capacity": self.batch_size,
+            "free": len(self.free_slots),
+            "queue_length": len(self.waiters),
+            "max_queue": self.max_queue,
+            "eta_seconds": round(self._estimated_wait(len(self.waiters) + 1), 1),
+        }
+
+    def _start_slot(self, index: int, **kwargs) -> _Slot:
+        slot = _Slot(index=index, prompt_done=asyncio.get_running_loop().create_future(), **kwargs)
+        self.slots[index] = slot
+        self.active_sessions.inc()
+        self.pending_prompts.append(slot)
+        self.engine_wakeup.set()
+        if self.engine_task is None or self.engine_task.done():
+            self.engine_task = asyncio.create_task(self._engine_loop())
+        return slot
+
+    def submit_voice_job(self, path: str) -> Optional[_VoiceJob]:
+        """Schedule the computation of the .pt embeddings for the uploaded voice prompt at `path`.
+        Returns None when too many jobs are already waiting, sessions then use the audio file."""
+        if len(self.voice_waiters) >= self.MAX_QUEUED_VOICE_JOBS:
+            logger.warning(f"{len(self.voice_waiters)} voice prompt jobs waiting, not scheduling one for {path}")
+            return None
+        duration = sphn.durations([path])[0] or 0.
+        job = _VoiceJob(id=secrets.token_hex(8), path=path, steps=math.ceil(duration * self.mimi.frame_rate) + 1)
+        self.voice_jobs[job.id] = job
+        # Only the most recent jobs are kept for the status endpoint.
+        while len(self.voice_jobs) > 256:
+            self.voice_jobs.popitem(last=False)
+        # The event loop only keeps a weak reference to its tasks.
+        task = asyncio.create_task(self._run_voice_job(job))
+        self.voice_tasks.add(task)
+        task.add_done_callback(self.voice_tasks.discard)
+        return job
+
+    async def _run_voice_job(self, job: _VoiceJob):
+        job.index = await self._enqueue_voice_job()
+        job.prompt_done = asyncio.get_running_loop().create_future()
+        self.pending_prompts.append(job)
+        self.engine_wakeup.set()
+        if self.engine_task is None or self.engine_task.done():
+            self.engine_task = asyncio.create_task(self._engine_loop())
+        try:
+            await job.prompt_done
+        except asyncio.CancelledError:
+            job.status = "failed"
+            job.error = "engine stopped"
+        finally:
+            job.closed = True
+            self._free_index(job.index)
+            self.engine_wakeup.set()
+        if job.status == "done" and self.voice_index is not None:
+            self.voice_index.add(os.path.splitext(job.path)[0] + ".pt")
+        logger.info(f"voice prompt job {job.id} for {job.path}: {job.status}")
+
+    def _push_frame(self, slot: _Slot):
+        received = time.time()
+        if not slot.frames:
+            slot.waiting_since = received
+        slot.frames.append(received)
+        slot.last_frame_at = received
+        self.engine_wakeup.set()
+
+    def _release_slot(self, slot: _Slot):
+        slot.closed = True
+        slot.live = False
+        if self.slots[slot.index] is slot:
+            self.slots[slot.index] = None
+            self._free_index(slot.index)
+            self.active_sessions.dec()
+            if slot.live_since is not None:
+                duration = time.time() - slot.live_since
+                self.session_time.observe(duration)
+                self.mean_session_duration = 0.9 * self.mean_session_duration + 0.1 * duration
+        self.engine_wakeup.set()
+
+    async def _run_in_worker(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def _start_prompt(self, slot: _Slot | _VoiceJob):
+        """Reset the batch entry of the slot and prepare its system prompts. Runs on the inference thread."""
+        if isinstance(slot, _VoiceJob):
+            self.lm_gen.load_voice_prompt(slot.path)
+            self.lm_gen.reset_streaming(self._slot_mask([slot]))
+            with self._prompt_mimi():
+                self.mimi.reset_streaming()
+            self.prompt_steps = self.lm_gen.iter_save_voice_prompt_embeddings(self.mimi)
+            return
+        if slot.seed is not None and slot.seed != -1:
+            seed_all(slot.seed)
+        # The voice and text prompts live on the shared LMGen, prompts are run one slot at a time.
+        self.lm_gen.text_prompt_tokens = slot.text_prompt_tokens
+        # Loaded voice prompts are cached by LMGen, which reloads a file that has been written again.
+        if slot.voice_prompt_path is None:
+            pass
+        elif slot.voice_prompt_path.endswith('.pt'):
+            # Load pre-saved voice prompt embeddings
+            self.lm_gen.load_voice_prompt_embeddings(slot.voice_prompt_path)
+        else:
+            self.lm_gen.load_voice_prompt(slot.voice_prompt_path)
+        self.lm_gen.reset_streaming(self._slot_mask([slot]))
+        with self._prompt_mimi():
+            self.mimi.reset_streaming()
+        self.prompt_steps = self.lm_gen.iter_system_prompts(self.mimi)
 
+    def _compute_prompt_step(self, slot: _Slot | _VoiceJob) -> bool:
+        """Run one system prompt step for the given slot, leaving the other slots untouched.
+        Runs on the inference thread and returns True once the system prompts are done."""
+        mask = self._slot_mask([slot])
+        self.lm_gen.set_exec_mask(mask)
+        try:
+            with self._prompt_mimi():
+                next(self.prompt_steps)
+            self.stage_timer.flush()
+        except StopIteration:
+            self.prompt_steps = None
+            self.mimi.reset_streaming(mask)
+            self._mirror("reset_streaming", mask)
+            return True
+        return False
+
+    async def _step_prompt(self):
+        slot = self.prompting
+        if slot.closed:
+            self.prompting = None
+            self.prompt_steps = None
+            return
+        if isinstance(slot, _VoiceJob):
+            await self._step_voice_job(slot)
+            return
+        if not await self._run_in_worker(self._compute_prompt_step, slot):
+            return
+        self.prompting = None
+        self.prompt_time.observe(time.time() - slot.prompt_started)
+        # Audio received during the system prompts is kept, up to the backlog limit.
+        excess = len(slot.frames) - self.max_input_backlog
+        if excess > 0:
+            slot.reader.skip_frames(excess)
+            for _ in range(excess):
+                slot.frames.popleft()
+        slot.waiting_since = slot.frames[0] if slot.frames else None
+        slot.live = True
+        slot.live_since = time.time()
+        slot.clog.log("info", "done with system prompts")
+        if not slot.prompt_done.done():
+            slot.prompt_done.set_result(None)
+
+    async def _step_voice_job(self, job: _VoiceJob):
+        # A bad upload fails its job, not the engine and the live sessions.
+        try:
+            if job.status == "queued":
+                job.status = "running"
+                job.prompt_started = time.time()
+                await self._run_in_worker(self._start_prompt, job)
+            elif not await self._run_in_worker(self._compute_prompt_step, job):
+                job.steps_done += 1
+                return
+            else:
+                job.status = "done"
+        except Exception as exc:
+            logger.exception(f"voice prompt job {job.id} failed")
+            job.status = "failed"
+            job.error = str(exc)
+        if job.status in ("done", "failed"):
+            self.prompting = None
+            self.prompt_steps = None
+            job.prompt_done.set_result(None)
+
+    def _frame_wait(self, live: list[_Slot]) -> Optional[float]:
+        """Returns how long to wait before stepping the live slots, or None if no frame is pending.
+
+        The slots without a pending frame are waited for, so that the jitter of their connection does not
+        insert silence in their input. They are only fed silence once their input has stopped for
+        `max_input_backlog` frame periods, by then the other slots hold as many frames as they can keep.
+        """
+        if not any(slot.frames for slot in live):
+            return None
+        late = [slot.last_frame_at for slot in live if not slot.frames]
+        if not late:
+            return 0.
+        gap = self.max_input_backlog / self.mimi.frame_rate
+        return max(0., max(late) + gap - time.time())
+
+    def _input_drift(self) -> float:
+        oldest = [slot.frames[0] for slot in self.slots if slot is not None and slot.live and slot.frames]
+        return time.time() - min(oldest) if oldest else 0.
+
+    def _drop_frames(self, slot: _Slot, count: int):
+        slot.reader.skip_frames(count)
+        for _ in range(count):
+            slot.frames.popleft()
+        slot.dropped_frames += count
+        self.input_dropped.inc(count)
+
+    def _catch_up(self, live: list[_Slot]) -> int:
+        """Bring the backlog of the live slots back under `max_input_backlog` and returns how many frames
+        the next step takes from each slot.
+
+        - "drop" discards the oldest frames over the limit, the slot keeps a backlog of at most the limit.
+        - "silence" discards the whole backlog of a slot over the limit, which is fed silence for the next
+          step and is back to real time.
+        - "batch" encodes the backlog in one Mimi call: the step takes as many frames as every live slot
+          has pending, up to the limit, so that no slot is padded. What is still over the limit is dropped.
+        """
+        frames = 1
+        if self.catch_up == "batch":
+            frames = max(1, min(self.max_input_backlog, *(len(slot.frames) for slot in live)))
+        for slot in live:
+            excess = len(slot.frames) - self.max_input_backlog
+            if self.catch_up == "batch":
+                excess -= frames - 1
+            if excess <= 0:
+                continue
+            if self.catch_up == "silence":
+                excess = len(slot.frames)
+            self._drop_frames(slot, excess)
+        return frames
+
+    def _mirror(self, method: str, *args):
+        """Call `method` of the mirror codec according to `other_mimi_mode`."""
+        if self.other_mimi_mode == "off":
+            return
+        fn = getattr(self.other_mimi, method)
+        if self.other_mimi_mode == "sync":
+            fn(*args)
+            return
+        if not self.mirror_slots.acquire(blocking=False):
+            self.mirror_skipped.inc()
+            return
+        # The arguments are copied so that the caller can reuse its buffers, and the copies are only
+        # used on the mirror stream once they are ready.
+        args = tuple(arg.clone() if isinstance(arg, torch.Tensor) else arg for arg in args)
+        ready = None
+        if self.mirror_stream is not None:
+            ready = torch.cuda.Event()
+            ready.record()
+            for arg in args:
+                if isinstance(arg, torch.Tensor) and arg.is_cuda:
+                    arg.record_stream(self.mirror_stream)
+        self.mirror_executor.submit(self._run_mirror, fn, ready, *args)
+
+    def _run_mirror(self, fn, ready: Optional[torch.cuda.Event], *args):
+        try:
+            if ready is not None:
+                torch.cuda.current_stream().wait_event(ready)
+            fn(*args)
+        except Exception:
+            logger.exception("mirror codec failed")
+        finally:
+            self.mirror_slots.release()
+
+    def _stage_done(self):
+        # Results handed to the stage of another thread must be ready on its stream.
+        if self.pipeline and self.device.type == 'cuda':
+            torch.cuda.current_stream().synchronize()
+
+    def _flush_stage_timer(self):
+        # Each thread drains the timings it recorded. Without the pipeline, all the stages run on the
+        # inference thread and `_decode_frame` flushes them once the frame is done.
+        if self.pipeline:
+            self.stage_timer.flush()
+
+    def _encode_frame(self, chunk: np.ndarray) -> torch.Tensor:
+        """Encode one frame per batch entry with Mimi. Runs on the encode thread."""
+        chunk = torch.from_numpy(chunk).to(device=self.device, non_blocking=True)
+        with self.stage_timer("encode"):
+            codes = self.mimi.encode(chunk)
+            self._mirror("encode", chunk)
+        self._stage_done()
+        self._flush_stage_timer()
+        return codes
+
+    def _lm_frame(self, codes: torch.Tensor, live_mask: Optional[torch.Tensor]) -> list:
+        """Step the LM once per code frame for the live entries. Runs on the inference thread,
+        returns a list of `(ready, tokens)`."""
+        self.lm_gen.set_exec_mask(live_mask)
+        steps = []
+        for c in range(codes.shape[-1]):
+            ready = self.lm_gen.ready_mask()
+            tokens = self.lm_gen.step(codes[:, :, c: c + 1])
+            if tokens is None:
+                continue
+            assert tokens.shape[1] == self.lm_gen.lm_model.dep_q + 1
+            steps.append((ready, tokens))
+        self._stage_done()
+        self._flush_stage_timer()
+        return steps
+
+    def _decode_frame(self, steps: list) -> list:
+        """Decode the output of the LM steps with Mimi. Runs on the decode thread, returns a list
+        of `(ready, pcm, text_tokens)` on the CPU."""
+        outputs = []
+        for ready, tokens in steps:
+            with self.stage_timer("decode"):
+                main_pcm = self.mimi.decode(tokens[:, 1:9])
+                self._mirror("decode", tokens[:, 1:9])
+            outputs.append((ready, main_pcm.cpu(), tokens[:, 0, 0].cpu()))
+        self.stage_timer.flush()
+        return outputs
+
+    def _compute_frame(self, chunk: np.ndarray, live_mask: torch.Tensor) -> list:
+        """Encode, step and decode one frame in sequence. Runs on the inference thread."""
+        return self._decode_frame(self._lm_frame(self._encode_frame(chunk), live_mask))
+
+    async def _pipeline_frame(self, chunk: np.ndarray, live_mask: torch.Tensor) -> list:
+        # Each stage runs on a single thread, in the order of the frames: the encoding of a frame only waits
+        # for the encoding of the previous one, not for its LM step.
+        loop = asyncio.get_running_loop()
+        codes = await loop.run_in_executor(self.encode_executor, self._encode_frame, chunk)
+        steps = await loop.run_in_executor(self.executor, self._lm_frame, codes, live_mask)
+        return await loop.run_in_executor(self.decode_executor, self._decode_frame, steps)
+
+    async def _drain(self):
+        """Wait for the frames in flight, before running anything else on the models."""
+        while self.in_flight:
+            await self.in_flight.popleft()
+
+    async def _step_frame(self, live: list[_Slot]):
+        frames = self._catch_up(live)
+        # The input buffers are reused, a buffer is only filled again once its previous frame is done.
+        if len(self.in_flight) >= self.PIPELINE_DEPTH:
+            await self.in_flight.popleft()
+        chunk = self.input_chunks[self.input_chunk_index]
+        self.input_chunk_index = (self.input_chunk_index + 1) % len(self.input_chunks)
+        if frames > 1:
+            chunk = np.zeros((self.batch_size, 1, frames * self.frame_size), dtype=np.float32)
+            self.catch_up_steps.inc()
+        received: dict[int, list[float]] = {}
+        for slot in live:
+            received_at = []
+            for offset in range(0, frames * self.frame_size, self.frame_size):
+                if slot.frames:
+                    received_at.append(slot.frames.popleft())
+                    slot.reader.read_frame(chunk[slot.index, 0, offset: offset + self.frame_size])
+                else:
+                    chunk[slot.index, 0, offset: offset + self.frame_size] = 0
+            if received_at:
+                received[slot.index] = received_at
+            slot.waiting_since = slot.frames[0] if slot.frames else None
+        start = time.time()
+        for received_at in received.values():
+            for frame_received_at in received_at:
+                self.queue_wait.observe(start - frame_received_at)
+        if self.pipeline:
+            task = asyncio.create_task(self._deliver_frame(live, received, self._pipeline_frame(
+                chunk, self._slot_mask(live))))
+            self.in_flight.append(task)
+        else:
+            await self._deliver_frame(live, received, self._run_in_worker(
+                self._compute_frame, chunk, self._slot_mask(live)))
+
+    async def _deliver_frame(self, live: list[_Slot], received: dict[int, list[float]], compute: Awaitable[list]):
+        outputs = await compute
+        now = time.time()
+        for ready, main_pcm, text_tokens in outputs:
+            for slot in live:
+                if not ready[slot.index] or slot.closed:
+                    continue
+                slot.writer.append_pcm(main_pcm[slot.index, 0].numpy())
+                text_token = text_tokens[slot.index].item()
+                if text_token not in (0, 3):
+                    _text = self.text_tokenizer.id_to_piece(text_token)  # type: ignore
+                    _text = _text.replace("▁", " ")
+                    slot.text_messages.append(b"\x02" + bytes(_text, encoding="utf8"))
+        for slot in live:
+            for frame_received_at in received.get(slot.index, ()):
+                self.frames_total.inc()
+                if not outputs:
+                    continue
+                latency = now - frame_received_at
+                slot.latency.append(latency)
+                self.frame_latency.observe(latency)
+                if latency > 1 / self.mimi.frame_rate:
+                    self.frames_over_budget.inc()
+
+    async def _engine_loop(self):
+        """Drive all the slots: live frames first, system prompts of joining slots in between."""
+        try:
+            while True:
+                # Frames and slots are only added while this task is awaiting, so clearing before
+                # looking for work cannot lose a wakeup.
+                self.engine_wakeup.clear()
+                live = [slot for slot in self.slots if slot is not None and slot.live and not slot.closed]
+                frame_wait = self._frame_wait(live)
+                if frame_wait == 0.:
+                    await self._step_frame(live)
+                    continue
+                if self.in_flight and (self.prompting is not None or self.pending_prompts or not live):
+                    # The system prompts use the models outside of the pipeline.
+                    await self._drain()
+                    continue
+                if self.prompting is None:
+                    while self.pending_prompts and self.prompting is None:
+                        slot = self.pending_prompts.popleft()
+                        if isinstance(slot, _VoiceJob):
+                            # Started by its first step, so that a failure only affects the job.
+                            self.prompting = slot
+                        elif not slot.closed:
+                            slot.prompt_started = time.time()
+                            await self._run_in_worker(self._start_prompt, slot)
+                            self.prompting = slot
+                if self.prompting is not None:
+                    await self._step_prompt()
+                    continue
+                if not live and not self.pending_prompts:
+                    return
+                try:
+                    await asyncio.wait_for(self.engine_wakeup.wait(), timeout=frame_wait)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception:
+            logger.exception("batch engine failed")
+            for task in self.in_flight:
+                task.cancel()
+            for slot in [*self.slots, *self.pending_prompts, self.prompting]:
+                if slot is not None and slot.prompt_done is not None and not slot.prompt_done.done():
+                    slot.prompt_done.cancel()
+            raise
+
+    async def handle_voice_job(self, request):
+        job = self.voice_jobs.get(request.match_info["job_id"])
+        if job is None:
+            return _cors_json_response({"error": "Unknown job"}, status=404)
+        return _cors_json_response(job.asdict())
+
+    async def handle_metrics(self, _request):
+        return web.Response(text=self.metrics.render(), content_type="text/plain",
+                            headers={"Cache-Control": "no-store"})
+
+    async def handle_status(self, _request):
+        return _cors_json_response({"ready": True, **self.queue_status()})
 
     async def handle_chat(self, request):
+        if not self.free_slots and len(self.waiters) >= self.max_queue:
+            # Saturated: reject before the websocket upgrade so that the caller can go elsewhere.
+            self.rejected.inc()
+            status = self.queue_status()
+            return web.json_response({"error": "Server is at capacity", **status}, status=503,
+                                     headers={"Retry-After": str(max(1, int(status["eta_seconds"])))})
         ws = web.WebSocketResponse()
         await ws.prepare(request)
         clog = ColorizedLog.randomize()
@@ -277,64 +1243,64 @@ class ServerState:
         peer_port = request.transport.get_extra_info("peername")[1]  # Port
         clog.log("info", f"Incoming connection from {peer}:{peer_port}")
 
+        # The sampling parameters of the shared LMGen and the global RNGs apply to all the slots of the batch:
+        # with several slots, a connection setting them would change the sampling of every live session.
+        shared_sampling = self.batch_size > 1
+        sampling_params = [key for key in ("audio_temperature", "text_temperature", "text_topk", "audio_topk", "seed")
+                           if key in request.query]
+        if shared_sampling and sampling_params:
+            clog.log("warning", f"Ignoring {', '.join(sampling_params)}: sampling is shared by the "
+                                f"{self.batch_size} slots of the batch")
+
         # Enable dynamic temperature control
-        if "audio_temperature" in request.query:
-            self.lm_gen.temp = float(request.query["audio_temperature"])
-        if "text_temperature" in request.query:
-            self.lm_gen.temp_text = float(request.query["text_temperature"])
-        if "text_topk" in request.query:
-            try:
-                self.lm_gen.top_k_text = max(1, int(request.query["text_topk"]))
-            except ValueError:
-                clog.log("warning", f"Invalid text_topk: {request.query['text_topk']}")
-        if "audio_topk" in request.query:
-            try:
-                self.lm_gen.top_k = max(1, int(request.query["audio_topk"]))
-            except ValueError:
-                clog.log("warning", f"Invalid audio_topk: {request.query['audio_topk']}")
+        if not shared_sampling:
+            if "audio_temperature" in request.query:
+                self.lm_gen.temp = float(request.query["audio_temperature"])
+            if "text_temperature" in request.query:
+                self.lm_gen.temp_text = float(request.query["text_temperature"])
+            if "text_topk" in request.query:
+                try:
+                    self.lm_gen.top_k_text = max(1, int(request.query["text_topk"]))
+                except ValueError:
+                    clog.log("warning", f"Invalid text_topk: {request.query['text_topk']}")
+            if "audio_topk" in request.query:
+                try:
+                    self.lm_gen.top_k = max(1, int(request.query["audio_topk"]))
+                except ValueError:
+                    clog.log("warning", f"Invalid audio_topk: {request.query['audio_topk']}")
         
         # Construct full voice prompt path
         requested_voice_prompt_path = None
         voice_prompt_path = None
-        if self.voice_prompt_dir is not None:
+        if self.voice_index is not None:
             voice_prompt_filename = request.query.get("voice_prompt", "")
-            requested_voice_prompt_path = None
+            entry = self.voice_index.lookup(voice_prompt_filename)
             if voice_prompt_filename:
                 requested_voice_prompt_path = os.path.join(self.voice_prompt_dir, voice_prompt_filename)
-            
-            # Smart Fallback: If file is missing, list the dir and try to find ANY .pt file
-            if requested_voice_prompt_path is None or not os.path.exists(requested_voice_prompt_path):
-                clog.log("warning", f"Voice prompt '{voice_prompt_filename}' not found. Searching in {self.voice_prompt_dir}...")
-                
-                # List files for debugging (visible in RunPod logs)
-                all_files = []
-                for root, dirs, files in os.walk(self.voice_prompt_dir):
-                    for f in files:
-                        all_files.append(os.path.join(root, f))
-                
-                clog.log("info", f"Files found: {all_files[:10]}...") # Log first 10
-                
-                # Try to find any .pt file
-                fallback_path = next((f for f in all_files if f.endswith('.pt')), None)
-                
-                if fallback_path:
-                    clog.log("info", f"Falling back to: {fallback_path}")
-                    voice_prompt_path = fallback_path
-                else:
-                    raise FileNotFoundError(f"No .pt voice prompts found in {self.voice_prompt_dir}")
-            else:
-                voice_prompt_path = requested_voice_prompt_path
-                
-        if self.lm_gen.voice_prompt != voice_prompt_path:
-            if voice_prompt_path.endswith('.pt'):
-                # Load pre-saved voice prompt embeddings
-                self.lm_gen.load_voice_prompt_embeddings(voice_prompt_path)
+            if entry is not None:
+                voice_prompt_path = entry.path
+                if entry.kind == "wav" and entry.has_embeddings:
+                    # Precomputed when the voice prompt was uploaded.
+                    voice_prompt_path = os.path.splitext(entry.path)[0] + ".pt"
             else:
-                self.lm_gen.load_voice_prompt(voice_prompt_path)
-        seed = int(request.query["seed"]) if "seed" in request.query else None
+                # Smart Fallback: If file is missing, use the first .pt file of the index
+                clog.log("warning", f"Voice prompt '{voice_prompt_filename}' not found in {self.voice_prompt_dir} "
+                                    f"({len(self.voice_index.entries)} voices indexed)")
+                fallback = self.voice_index.fallback()
+                if fallback is None:
+                    raise FileNotFoundError(f"No .pt voice prompts found in {self.voice_prompt_dir}")
+                clog.log("info", f"Falling back to: {fallback.path}")
+                voice_prompt_path = fallback.path
+
+        seed = int(request.query["seed"]) if "seed" in request.query and not shared_sampling else None
+        codec = request.query.get("codec", "pcm")
+        if codec not in _STREAM_CODECS:
+            clog.log("warning", f"Unknown codec {codec}, falling back to pcm")
+            codec = "pcm"
 
+        # Single reader of the websocket for the whole connection, so that disconnects are noticed
+        # without polling and no message is lost while waiting in the queue or for the system prompts.
         async def recv_loop():
-            nonlocal close
             try:
                 async for message in ws:
                     if message.type == aiohttp.WSMsgType.ERROR:
@@ -356,128 +1322,117 @@ class ServerState:
                         continue
                     kind = message[0]
                     if kind == 1:  # audio
+                        if slot is None:
+                            # Still waiting for a slot, there is no conversation to buffer it for.
+                            continue
                         payload = message[1:]
                         opus_reader.append_bytes(payload)
                     else:
                         clog.log("warning", f"unknown message kind {kind}")
             finally:
-                close = True
+                disconnected.set()
                 clog.log("info", "connection closed")
 
-        async def opus_loop():
-            all_pcm_data = None
-
-            while True:
-                if close:
-                    return
-                await asyncio.sleep(0.001)
-                pcm = opus_reader.read_pcm()
-                if pcm is None: # Fix: Check for None before accessing shape
-                    continue
-                if pcm.shape[-1] == 0:
-                    continue
-                if all_pcm_data is None:
-                    all_pcm_data = pcm
-                else:
-                    all_pcm_data = np.concatenate((all_pcm_data, pcm), axis=1)
-                while all_pcm_data.shape[-1] >= self.frame_size:
-                    be = time.time()
-                    chunk = all_pcm_data[:, : self.frame_size]
-                    all_pcm_data = all_pcm_data[:, self.frame_size:]
-                    chunk = torch.from_numpy(chunk)
-                    chunk = chunk.to(device=self.device).unsqueeze(0)
-                    codes = self.mimi.encode(chunk)
-                    _ = self.other_mimi.encode(chunk)
-                    for c in range(codes.shape[-1]):
-                        tokens = self.lm_gen.step(codes[:, :, c: c + 1])
-                        if tokens is None:
-                            continue
-                        assert tokens.shape[1] == self.lm_gen.lm_model.dep_q + 1
-                        main_pcm = self.mimi.decode(tokens[:, 1:9])
-                        _ = self.other_mimi.decode(tokens[:, 1:9])
-                        main_pcm = main_pcm.cpu()
-                        opus_writer.append_pcm(main_pcm[0, 0].numpy())
-                        text_token = tokens[0, 0, 0].item()
-                        if text_token not in (0, 3):
-                            _text = self.text_tokenizer.id_to_piece(text_token)  # type: ignore
-                            _text = _text.replace("▁", " ")
-                            msg = b"\x02" + bytes(_text, encoding="utf8")
-                            await ws.send_bytes(msg)
-                        else:
-                            text_token_map = ['EPAD', 'BOS', 'EOS', 'PAD']
-
         async def send_loop():
             while True:
-                if close:
+                if disconnected.is_set():
                     return
-                await asyncio.sleep(0.001)
-                msg = opus_writer.read_bytes()
-                if len(msg) > 0:
-                    await ws.send_bytes(b"\x01" + msg)
-
-        clog.log("info", "accepted connection")
+                # Decoded audio and text are produced together by the engine, wake up once for both.
+                msg = await opus_writer.wait_message()
+                while slot.text_messages:
+                    await ws.send_bytes(slot.text_messages.popleft())
+                if len(msg) > 1:
+                    with self.send_time.time():
+                        await ws.send_bytes(msg)
+
+        clog.log("info", f"accepted connection, codec: {codec}")
         text_prompt = request.query.get("text_prompt", "")
         if len(text_prompt) > 0:
             clog.log("info", f"text prompt: {text_prompt}")
         voice_prompt_requested = request.query.get("voice_prompt", "")
         if len(voice_prompt_requested) > 0:
             clog.log("info", f"voice prompt: {voice_prompt_path} (requested: {requested_voice_prompt_path})")
-        close = False
-        async with self.lock:
-            if seed is not None and seed != -1:
-                seed_all(seed)
-
-            # Ensure text prompt tokens are set (empty list if not provided).
-            if text_prompt:
-                self.lm_gen.text_prompt_tokens = self.text_tokenizer.encode(wrap_with_system_tags(text_prompt))  # type: ignore
-            else:
-                self.lm_gen.text_prompt_tokens = []
 
-            opus_writer = PcmStreamWriter(self.mimi.sample_rate) # Switched to PCM Writer
-            opus_reader = PcmStreamReader(self.mimi.sample_rate) # Switched to PCM Reader
-            self.mimi.reset_streaming()
-            self.other_mimi.reset_streaming()
-            self.lm_gen.reset_streaming()
-            async def is_alive():
-                if close or ws.closed:
-                    return False
+        # Ensure text prompt tokens are set (empty list if not provided).
+        if text_prompt:
+            text_prompt_tokens = self.text_tokenizer.encode(wrap_with_system_tags(text_prompt))  # type: ignore
+        else:
+            text_prompt_tokens = []
+
+        # Raw PCM16 by default, Ogg/Opus in both directions with `codec=opus`.
+        opus_reader_cls, opus_writer_cls = _STREAM_CODECS[codec]
+        opus_writer = opus_writer_cls(self.mimi.sample_rate)
+        opus_reader = opus_reader_cls(self.mimi.sample_rate, self.frame_size)
+        slot: Optional[_Slot] = None
+        disconnected = asyncio.Event()
+        recv_task = asyncio.create_task(recv_loop())
+        try:
+            # Wait for a free slot, keeping the caller posted of its position in the queue.
+            waiter = self._enqueue()
+            enqueued = time.time()
+            try:
+                last_status = None
+                while not waiter.done() and not disconnected.is_set():
+                    position = self.waiters.index(waiter) + 1
+                    status = {"queue_position": position, "eta_seconds": round(self._estimated_wait(position), 1)}
+                    if status != last_status:
+                        await ws.send_bytes(b"\x04" + json.dumps(status).encode())
+                        last_status = status
+                    await asyncio.wait([waiter, recv_task], timeout=1., return_when=asyncio.FIRST_COMPLETED)
+            except (asyncio.CancelledError, aiohttp.ClientConnectionError, ConnectionResetError):
+                self._cancel_waiter(waiter)
+                raise
+            if disconnected.is_set():
+                self._cancel_waiter(waiter)
+                clog.log("info", "disconnected while waiting for a slot")
+                return ws
+            self.admission_wait.observe(time.time() - enqueued)
+            slot = self._start_slot(
+                waiter.result(),
+                clog=clog,
+                reader=opus_reader,
+                writer=opus_writer,
+                text_prompt_tokens=text_prompt_tokens,
+                voice_prompt_path=voice_prompt_path,
+                seed=seed,
+            )
+            clog.log("info", f"assigned to slot {slot.index}")
+            # Complete frames go straight to the engine, which wakes up as soon as one is available.
+            opus_reader.on_frame = lambda: self._push_frame(slot)
+            try:
+                # The engine runs the system prompts of this slot in between the frames of the live slots,
+                # a disconnect closes the slot, which the engine skips.
+                await asyncio.wait([slot.prompt_done, recv_task], return_when=asyncio.FIRST_COMPLETED)
+                # Send the handshake.
+                if slot.prompt_done.done() and not slot.prompt_done.cancelled() and not disconnected.is_set():
+                    await ws.send_bytes(b"\x00")
+                    clog.log("info", "sent handshake bytes")
+                    send_task = asyncio.create_task(send_loop())
+                    await asyncio.wait([recv_task, send_task], return_when=asyncio.FIRST_COMPLETED)
+                    # Force-kill the sender if the client went away.
+                    if not send_task.done():
+                        send_task.cancel()
+                        try:
+                            await send_task
+                        except asyncio.CancelledError:
+                            pass
+                    await ws.close()
+                    clog.log("info", "session closed")
+            finally:
+                self._release_slot(slot)
+        finally:
+            if not recv_task.done():
+                recv_task.cancel()
                 try:
-                    # Check for disconnect without waiting too long
-                    msg = await asyncio.wait_for(ws.receive(), timeout=0.01)
-                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-                        return False
-                except asyncio.TimeoutError:
-                    # No messages → client probably still alive
-                    return True
-                except aiohttp.ClientConnectionError:
-                    return False
-                return True
-            # Reuse mimi for encoding voice prompt and then reset it before conversation starts
-            await self.lm_gen.step_system_prompts_async(self.mimi, is_alive=is_alive)
-            self.mimi.reset_streaming()
-            clog.log("info", "done with system prompts")
-            # Send the handshake.
-            if await is_alive():
-                await ws.send_bytes(b"\x00")
-                clog.log("info", "sent handshake bytes")
-                # Clean cancellation manager
-                tasks = [
-                    asyncio.create_task(recv_loop()),
-                    asyncio.create_task(opus_loop()),
-                    asyncio.create_task(send_loop()),
-                ]
-
-                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-                # Force-kill remaining tasks
-                for task in pending:
-                    task.cancel()
-                    try:
-                        await task
-                    except asyncio.CancelledError:
-                        pass
-                await ws.close()
-                clog.log("info", "session closed")
-                # await asyncio.gather(opus_loop(), recv_loop(), send_loop())
+                    await recv_task
+                except asyncio.CancelledError:
+                    pass
+        if slot.latency:
+            latency = np.array(slot.latency) * 1000
+            clog.log("info", f"frame latency over {len(latency)} frames: mean {latency.mean():.1f}ms, "
+                             f"p50 {np.percentile(latency, 50):.1f}ms, max {latency.max():.1f}ms")
+        if slot.dropped_frames:
+            clog.log("warning", f"dropped {slot.dropped_frames} input frames to keep up with real time")
         clog.log("info", "done with connection")
         return ws
 
@@ -561,6 +1516,7 @@ def _get_static_path(static: Optional[str]) -> Optional[str]:
     return None
 
 
+@torch.no_grad()
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--host", default="localhost", type=str)
@@ -580,6 +1536,43 @@ def main():
     parser.add_argument("--cpu-offload", action="store_true",
                         help="Offload LM model layers to CPU when GPU memory is insufficient. "
                              "Requires 'accelerate' package.")
+    parser.add_argument("--voice-rescan-interval", default=60., type=float,
+                        help="Seconds between rescans of the voice prompt directory, uploads are indexed "
+                             "immediately.")
+    parser.add_argument("--voice-prompt-cache-mb", default=256, type=int,
+                        help="Memory budget for the loaded voice prompts kept in memory, 0 to disable.")
+    parser.add_argument("--prompt-snapshot-cache-mb", default=1024, type=int,
+                        help="Memory budget for the model state snapshots taken after the system prompts, "
+                             "restored for connections using the same voice and text prompts. 0 to disable.")
+    parser.add_argument("--max-queue", default=8, type=int,
+                        help="Connections allowed to wait for a free slot, further ones are rejected with a 503.")
+    parser.add_argument("--max-input-backlog", default=12, type=int,
+                        help="Input frames a session can have pending when compute falls behind real time. "
+                             "With several sessions, also the frame periods the others wait for a session whose "
+                             "input stopped, before feeding it silence.")
+    parser.add_argument("--catch-up", default="drop", choices=["drop", "silence", "batch"],
+                        help="What to do with the input frames over the backlog: drop the oldest ones, "
+                             "drop the whole backlog and feed silence, or encode the backlog in one Mimi call.")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run the Mimi encoding, the LM step and the Mimi decoding on their own threads "
+                             "and CUDA streams, overlapping the stages of consecutive frames. Meant for CUDA, "
+                             "on a CPU the stages compete for the same cores.")
+    parser.add_argument("--other-mimi", default="sync", choices=["off", "sync", "async"],
+                        help="How to run the mirror Mimi codec, whose outputs are not used: not at all, "
+                             "with each frame, or on a background thread off the critical path.")
+    parser.add_argument("--depformer-codebooks", default=AUDIO_TOKENS_PER_STREAM, type=int,
+                        help="Codebooks sampled by the depformer at each step. Defaults to the 8 agent codebooks, "
+                             "the only ones decoded: the user stream ones are always overwritten by the user audio, "
+                             "so skipping them leaves the greedy outputs unchanged and halves the depformer time. "
+                             "16 samples them all, as before.")
+    parser.add_argument("--prefill-chunk", default=16, type=int,
+                        help="System prompt steps run through the transformer at once. Their tokens are all known "
+                             "in advance, which makes the prompts much faster. Other sessions get their frames "
+                             "between chunks. 1 runs the prompts step by step.")
+    parser.add_argument("--batch-size", default=1, type=int,
+                        help="Number of concurrent sessions served by the model, each one using "
+                             "one batch entry. Extra connections wait for a free slot. With more than one, the "
+                             "sampling parameters and seed of a connection are ignored, as they are shared.")
     parser.add_argument(
         "--voice-prompt-dir",
         type=str,
@@ -599,22 +1592,7 @@ def main():
     )
 
     args = parser.parse_args()
-    args.voice_prompt_dir = _resolve_voice_prompt_dir(
-        args.voice_prompt_dir,
-        args.hf_repo,
-    )
-    if args.voice_prompt_dir is not None:
-        os.makedirs(args.voice_prompt_dir, exist_ok=True)
-        assert os.path.exists(args.voice_prompt_dir), \
-            f"Directory missing: {args.voice_prompt_dir}"
-    logger.info(f"voice_prompt_dir = {args.voice_prompt_dir}")
-
-    static_path: None | str = _get_static_path(args.static)
-    assert static_path is None or os.path.exists(static_path), \
-        f"Static path does not exist: {static_path}."
-    logger.info(f"static_path = {static_path}")
     args.device = torch_auto_device(args.device)
-
     seed_all(42424242)
 
     setup_tunnel = None
@@ -632,46 +1610,142 @@ def main():
         else:
             tunnel_token = args.gradio_tunnel_token
 
+    # The assets are fetched and the models built concurrently. The HTTP listener starts as soon as the
+    # static content and the voice prompts are there, and reports the other phases until the models are ready.
+    timeline = BootTimeline()
+    boot = ThreadPoolExecutor(max_workers=6, thread_name_prefix="boot")
+
+    def load_moshi():
+        if args.moshi_weight is None:
+            args.moshi_weight = hf_hub_download(args.hf_repo, loaders.MOSHI_NAME)
+        lm = loaders.get_moshi_lm(args.moshi_weight, device=args.device, cpu_offload=args.cpu_offload)
+        lm.eval()
+        return lm
+
+    def load_mimi():
+        if args.mimi_weight is None:
+            args.mimi_weight = hf_hub_download(args.hf_repo, loaders.MIMI_NAME)
+        mimi = loaders.get_mimi(args.mimi_weight, args.device)
+        # Same weights, its own streaming state.
+        other_mimi = mimi.shared_copy() if args.other_mimi != "off" else None
+        return mimi, other_mimi
+
+    def load_tokenizer():
+        if args.tokenizer is None:
+            args.tokenizer = hf_hub_download(args.hf_repo, loaders.TEXT_TOKENIZER_NAME)
+        return sentencepiece.SentencePieceProcessor(args.tokenizer)  # type: ignore
+
+    moshi_future = boot.submit(timeline.run, "moshi", load_moshi)
+    mimi_future = boot.submit(timeline.run, "mimi", load_mimi)
+    tokenizer_future = boot.submit(timeline.run, "tokenizer", load_tokenizer)
     # Download config.json to increment download counter
     # No worries about double-counting since config.json will be cached the second time
-    hf_hub_download(args.hf_repo, "config.json")
-
-    logger.info("loading mimi")
-    if args.mimi_weight is None:
-        args.mimi_weight = hf_hub_download(args.hf_repo, loaders.MIMI_NAME)
-    mimi = loaders.get_mimi(args.mimi_weight, args.device)
-    other_mimi = loaders.get_mimi(args.mimi_weight, args.device)
-    logger.info("mimi loaded")
-
-    if args.tokenizer is None:
-        args.tokenizer = hf_hub_download(args.hf_repo, loaders.TEXT_TOKENIZER_NAME)
-    text_tokenizer = sentencepiece.SentencePieceProcessor(args.tokenizer)  # type: ignore
-
-    logger.info("loading moshi")
-    if args.moshi_weight is None:
-        args.moshi_weight = hf_hub_download(args.hf_repo, loaders.MOSHI_NAME)
-    lm = loaders.get_moshi_lm(args.moshi_weight, device=args.device, cpu_offload=args.cpu_offload)
-    lm.eval()
-    logger.info("moshi loaded")
-    state = ServerState(
-        mimi=mimi,
-        other_mimi=other_mimi,
-        text_tokenizer=text_tokenizer,
-        lm=lm,
-        device=args.device,
-        voice_prompt_dir=args.voice_prompt_dir,
-        save_voice_prompt_embeddings=False,
-    )
-    logger.info("warming up the model")
-    state.warmup()
+    boot.submit(timeline.run, "config", hf_hub_download, args.hf_repo, "config.json")
+    voice_future = boot.submit(timeline.run, "voice prompts", _resolve_voice_prompt_dir,
+                               args.voice_prompt_dir, args.hf_repo)
+    static_future = boot.submit(timeline.run, "static content", _get_static_path, args.static)
+
+    args.voice_prompt_dir = voice_future.result()
+    if args.voice_prompt_dir is not None:
+        os.makedirs(args.voice_prompt_dir, exist_ok=True)
+        assert os.path.exists(args.voice_prompt_dir), \
+            f"Directory missing: {args.voice_prompt_dir}"
+    logger.info(f"voice_prompt_dir = {args.voice_prompt_dir}")
+    voice_index = VoicePromptIndex(args.voice_prompt_dir) if args.voice_prompt_dir is not None else None
+
+    static_path: None | str = static_future.result()
+    assert static_path is None or os.path.exists(static_path), \
+        f"Static path does not exist: {static_path}."
+    logger.info(f"static_path = {static_path}")
+
+    def build_state() -> ServerState:
+        mimi, other_mimi = mimi_future.result()
+        state = ServerState(
+            mimi=mimi,
+            other_mimi=other_mimi,
+            text_tokenizer=tokenizer_future.result(),
+            lm=moshi_future.result(),
+            device=args.device,
+            voice_prompt_dir=args.voice_prompt_dir,
+            save_voice_prompt_embeddings=False,
+            batch_size=args.batch_size,
+            voice_prompt_cache_bytes=args.voice_prompt_cache_mb * 2**20,
+            prompt_snapshot_cache_bytes=args.prompt_snapshot_cache_mb * 2**20,
+            max_queue=args.max_queue,
+            max_input_backlog=args.max_input_backlog,
+            catch_up=args.catch_up,
+            pipeline=args.pipeline,
+            other_mimi_mode=args.other_mimi,
+            voice_index=voice_index,
+            depformer_codebooks=args.depformer_codebooks,
+            prefill_chunk_size=args.prefill_chunk,
+        )
+        timeline.run("warmup", state.warmup)
+        return state
+
+    # Filled in once the models are loaded and warmed up, until then the model routes answer with a 503.
+    ready: dict[str, ServerState] = {}
+    boot_failed = threading.Event()
+
+    def stop_server():
+        # Raised from a loop callback, like the signal handlers of `web.run_app`, which then returns.
+        raise web.GracefulExit()
+
+    async def finish_boot(app):
+        async def _finish():
+            loop = asyncio.get_running_loop()
+            try:
+                ready["state"] = await loop.run_in_executor(boot, build_state)
+            except Exception:
+                logger.exception("startup failed, stopping the server")
+                boot_failed.set()
+                loop.call_soon(stop_server)
+                return
+            logger.info(f"ready after {time.time() - timeline.started:.1f}s, startup timeline: {timeline.summary()}")
+
+        app["boot"] = asyncio.create_task(_finish())
+
+    def when_ready(name: str):
+        async def handler(request):
+            state = ready.get("state")
+            if state is None:
+                return _cors_json_response({"error": "Server is starting", "ready": False,
+                                            "phases": timeline.phases}, status=503)
+            return await getattr(state, name)(request)
+        return handler
+
+    async def handle_status(request):
+        state = ready.get("state")
+        if state is None:
+            return _cors_json_response({"ready": False, "phases": timeline.phases})
+        return await state.handle_status(request)
+
+    def submit_voice_job(path: str) -> Optional[_VoiceJob]:
+        state = ready.get("state")
+        return state.submit_voice_job(path) if state is not None else None
+
     upload_max_mb = int(os.getenv("UPLOAD_MAX_MB", "25"))
     upload_max_bytes = upload_max_mb * 1024 * 1024
     app = web.Application(client_max_size=upload_max_bytes)
     app["voice_prompt_dir"] = args.voice_prompt_dir
     app["upload_max_bytes"] = upload_max_bytes
-    app.router.add_get("/api/chat", state.handle_chat)
+    app["voice_index"] = voice_index
+    app["submit_voice_job"] = submit_voice_job
+    app.on_startup.append(finish_boot)
+    if voice_index is not None:
+        logger.info(f"indexed {len(voice_index.entries)} voice prompts")
+
+        async def start_voice_watch(app):
+            app["voice_watch"] = asyncio.create_task(voice_index.watch(args.voice_rescan_interval))
+
+        app.on_startup.append(start_voice_watch)
+    app.router.add_get("/api/chat", when_ready("handle_chat"))
+    app.router.add_get("/metrics", when_ready("handle_metrics"))
+    app.router.add_get("/api/status", handle_status)
     app.router.add_post("/api/voice_prompt", handle_voice_prompt_upload)
     app.router.add_options("/api/voice_prompt", handle_voice_prompt_options)
+    app.router.add_get("/api/voice_prompts", handle_voice_prompt_list)
+    app.router.add_get("/api/voice_prompt/jobs/{job_id}", when_ready("handle_voice_job"))
     if static_path is not None:
         async def handle_root(_):
             return web.FileResponse(os.path.join(static_path, "index.html"))
@@ -691,7 +1765,9 @@ def main():
         tunnel = setup_tunnel('localhost', args.port, tunnel_token, None)
         logger.info(f"Tunnel started, if executing on a remote GPU, you can use {tunnel}.")
     web.run_app(app, host='0.0.0.0', port=args.port, ssl_context=ssl_context)
+    if boot_failed.is_set():
+        sys.exit(1)
 
 
-with torch.no_grad():
+if __name__ == "__main__":
     main()
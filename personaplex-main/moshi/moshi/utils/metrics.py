@@ -0,0 +1,207 @@
+# SPDX-FileCopyrightText: Copyright (c) 2026 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+# SPDX-License-Identifier: MIT
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+"""Minimal Prometheus style metrics, rendered in the text exposition format.
+
+Metrics are updated from the compute threads and rendered from the event loop, so each metric guards its
+values with a lock. Observing a value is a couple of additions under that lock, cheap enough to be left on
+in production.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+import threading
+import time
+from typing import Callable, Optional
+
+import torch
+
+
+# Buckets in seconds, finer around the 80 ms budget of a frame.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.06, 0.08, 0.1, 0.15, 0.2, 0.35, 0.5, 1., 2.5, 5.)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Reads the value from `function` when rendering, for values already tracked elsewhere."""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, {}, self.function()
+            return
+        with self._lock:
+            value = self.value
+        yield self.name, {}, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self.value -= amount
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        # Per bucket counts, the cumulative counts are only computed when rendering.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        bucket = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - begin)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            yield self.name + "_bucket", {"le": _format_value(bound)}, cumulative
+        yield self.name + "_sum", {}, total
+        yield self.name + "_count", {}, count
+
+
+class Metrics:
+    """Registry of metrics, all names get the given prefix."""
+
+    def __init__(self, prefix: str = "moshi"):
+        self.prefix = prefix
+        self.metrics: list[Counter | Gauge | Histogram] = []
+
+    def _register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self._register(Counter(f"{self.prefix}_{name}", documentation))
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        return self._register(Gauge(f"{self.prefix}_{name}", documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(f"{self.prefix}_{name}", documentation, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class StageTimer:
+    """Times stages of the model compute into histograms.
+
+    On CUDA, stages are timed with events so that timing does not add any synchronization,
+    the durations are only read in `flush`, to be called once the results have been copied back.
+    Pending timings are kept per thread, each thread flushes the stages it ran.
+
+    Args:
+        histograms (dict): histogram to use for each stage name, other stages are not timed.
+        device (torch.device): device the stages run on.
+    """
+
+    def __init__(self, histograms: dict[str, Histogram], device: torch.device | str):
+        self.histograms = histograms
+        self.cuda = torch.device(device).type == "cuda"
+        self._local = threading.local()
+
+    @property
+    def pending(self) -> list[tuple[Histogram, torch.cuda.Event, torch.cuda.Event]]:
+        if not hasattr(self._local, "pending"):
+            self._local.pending = []
+        return self._local.pending
+
+    @contextmanager
+    def _time_cuda(self, histogram: Histogram):
+        begin = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        begin.record()
+        yield
+        end.record()
+        self.pending.append((histogram, begin, end))
+
+    def __call__(self, stage: str):
+        histogram: Optional[Histogram] = self.histograms.get(stage)
+        if histogram is None:
+            return nullcontext()
+        if self.cuda:
+            return self._time_cuda(histogram)
+        return histogram.time()
+
+    def flush(self):
+        for histogram, begin, end in self.pending:
+            end.synchronize()
+            histogram.observe(begin.elapsed_time(end) / 1000)
+        self.pending.clear()
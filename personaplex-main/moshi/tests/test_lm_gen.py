@@ -0,0 +1,363 @@
+"""Checks of `LMGen` against reference implementations of its previous versions."""
+import random
+
+import pytest
+import torch
+
+from moshi.models import loaders
+from moshi.models.lm import AUDIO_TOKENS_PER_STREAM, LMGen, LMModel
+
+
+def _small_lm_kwargs(**overrides) -> dict:
+    kwargs = dict(loaders._lm_kwargs)
+    kwargs.update(dim=64, num_heads=4, num_layers=2, depformer_dim=32, depformer_dim_feedforward=64,
+                  depformer_num_heads=2, depformer_num_layers=2, text_card=100, card=2048, context=50)
+    kwargs.update(overrides)
+    return kwargs
+
+
+def _small_lm(seed: int = 0, **overrides) -> LMModel:
+    torch.manual_seed(seed)
+    lm = LMModel(device="cpu", dtype=torch.float32, **_small_lm_kwargs(**overrides))
+    lm.eval()
+    return lm
+
+
+def _gen(cls, lm: LMModel, **kwargs) -> LMGen:
+    return cls(lm, device="cpu", use_sampling=False, audio_silence_frame_cnt=3, sample_rate=24000, frame_rate=12.5,
+               **kwargs)
+
+
+def _kv_state(lm: LMModel) -> list[torch.Tensor]:
+    """Streaming state of the main transformer: KV caches and offsets."""
+    tensors = [lm.transformer._streaming_state.offset]
+    for layer in lm.transformer.layers:
+        state = layer.self_attn._streaming_state
+        tensors += [state.kv_cache.cache, state.kv_cache.end_offset, state.offset, torch.tensor(state.offset_cpu)]
+    return [tensor.clone() for tensor in tensors]
+
+
+def _same(a, b) -> bool:
+    if isinstance(a, torch.Tensor):
+        return torch.equal(a, b)
+    if isinstance(a, (tuple, list)):
+        return len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same(a[key], b[key]) for key in a)
+    return a == b
+
+
+class _ReferenceLMGen(LMGen):
+    """`LMGen` writing the token cache one codebook at a time, as before `LMGen._write_stream`."""
+
+    @torch.no_grad()
+    def prepare_step_input(self,
+                           input_tokens: torch.Tensor=None,
+                           moshi_tokens:torch.Tensor=None,
+                           text_token:torch.Tensor=None,
+                           ):
+        state = self._streaming_state
+        if state is None:
+            raise RuntimeError(
+                "You should wrap those calls with a `with lm_gen.streaming(): ...`."
+            )
+        lm_model = self.lm_model
+        device = state.cache.device
+
+        # audio_tokens_per_stream = lm_model.dep_q//2
+        needed_tokens = lm_model.num_codebooks - AUDIO_TOKENS_PER_STREAM - 1
+        B, _, CT = state.cache.shape
+
+        # Only the batch entries in `exec_mask` are written to and advanced.
+        exec_rows = state.exec_mask.nonzero()[:, 0]
+        if len(exec_rows) == 0:
+            return None
+        offsets = state.offsets[exec_rows]
+        rows = exec_rows.to(device)
+
+        ####
+        # Fill Cache with provided tokens at state.offset (target) + delays
+
+        if input_tokens is not None:
+            assert input_tokens.dim() == 3, "Shape should be [B, K, T]."
+            _, Ki, S = input_tokens.shape
+            assert S == 1, "Only support being given steps one by one."
+            assert (
+                Ki == needed_tokens
+            ), f"We expect {needed_tokens} tokens from the user stream, got {Ki}."
+            input_tokens = self._batch_tokens(input_tokens, rows)
+
+            for q_other in range(input_tokens.shape[1]):
+                k = AUDIO_TOKENS_PER_STREAM + 1 + q_other
+                delay = lm_model.delays[k]
+                write_positions = ((offsets + delay) % CT).to(device)
+                state.cache[rows, k, write_positions] = input_tokens[:, q_other, 0]
+                state.provided[rows, k, write_positions] = True
+
+        if moshi_tokens is not None:
+            assert moshi_tokens.dim() == 3, "Shape should be [B, K, T]."
+            _, Ki, S = moshi_tokens.shape
+            assert S == 1, "Only support being given steps one by one."
+            assert (
+                Ki == needed_tokens
+            ), f"We expect {needed_tokens} tokens from the moshi stream, got {Ki}."
+            moshi_tokens = self._batch_tokens(moshi_tokens, rows)
+
+            for q_moshi in range(moshi_tokens.shape[1]):
+                k = 1 + q_moshi
+                delay = lm_model.delays[k]
+                write_positions = ((offsets + delay) % CT).to(device)
+                state.cache[rows, k, write_positions] = moshi_tokens[:, q_moshi, 0]
+                state.provided[rows, k, write_positions] = True
+
+        if text_token is not None:
+            if isinstance(text_token, torch.Tensor) and text_token.dim() > 0:
+                text_token = self._batch_tokens(text_token, rows)
+            write_positions = ((offsets + lm_model.delays[0]) % CT).to(device)
+            state.cache[rows, 0, write_positions] = text_token
+            state.provided[rows, 0, write_positions] = True
+
+        for k, delay in enumerate(lm_model.delays):
+            # Only for the very beginning, we extend the initial token for the acoustic
+            # token that are delayed, and thus have no good value to take.
+            starting = offsets <= delay
+            if starting.any():
+                starting_rows = exec_rows[starting].to(device)
+                positions = (offsets[starting] % CT).to(device)
+                state.cache[starting_rows, k, positions] = state.initial[0, k, 0]
+                state.provided[starting_rows, k, positions] = True
+
+        ####
+        # Perform inference at state.offset - 1 (model_input); forcing with tokens at state.offset (target) when provided
+
+        fresh = offsets == 0
+        if fresh.any():
+            # We can't report loss or force depth tranformer tokens until we're at step 2
+            # And we need to initialize the delay-0 cache where it's not provided for step 2
+            state.cache[exec_rows[fresh].to(device), :, 0] = state.initial[0, :, 0] # torch.where(state.provided[:, :, 0], state.cache[:, :, 0], state.initial[:, :, 0])
+            state.offsets[exec_rows[fresh]] += 1
+            exec_rows = exec_rows[~fresh]
+            if len(exec_rows) == 0:
+                return None
+            offsets = offsets[~fresh]
+            rows = exec_rows.to(device)
+
+        run_mask = torch.zeros(B, dtype=torch.bool)
+        run_mask[exec_rows] = True
+        if B > 1:
+            self._set_transformer_exec_mask(run_mask)
+
+        # Rows that are not executed read from their own (ignored) positions.
+        all_offsets = state.offsets.clone()
+        all_offsets[exec_rows] = offsets
+        model_input_position = ((all_offsets - 1) % CT).to(device)
+        target_position = (all_offsets % CT).to(device)
+        input_ = state.cache.gather(2, model_input_position.view(-1, 1, 1).expand(-1, lm_model.num_codebooks, 1))
+        target_ = state.cache.gather(2, target_position.view(-1, 1, 1).expand(-1, lm_model.num_codebooks, 1))
+        provided_ = state.provided.gather(2, target_position.view(-1, 1, 1).expand(-1, lm_model.num_codebooks, 1))
+
+        if self.check:
+            # Check that we are not feeding in any value that is not generated yet.
+            assert not (input_[rows] == lm_model.ungenerated_token_id).any(), (
+                state.offsets,
+                input_,
+            )
+            assert (input_[rows, lm_model.audio_offset :] <= lm_model.card).all(), input_
+            assert (input_[rows, :1] <= lm_model.text_card).all()
+        return input_, provided_, target_, model_input_position, target_position, run_mask
+
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_prepare_step_input_matches_reference(batch_size: int):
+    lm = _small_lm()
+    rng = random.Random(0)
+    reference, gen = _gen(_ReferenceLMGen, lm), _gen(LMGen, lm)
+    with reference.streaming(batch_size), gen.streaming(batch_size):
+        ref_state, state = reference._streaming_state, gen._streaming_state
+        # Long enough for the positions to wrap around the token cache.
+        for step in range(60):
+            if batch_size > 1 and step % 7 == 3:
+                exec_mask = torch.tensor([rng.random() < 0.6 for _ in range(batch_size)])
+                reference.set_exec_mask(exec_mask)
+                gen.set_exec_mask(exec_mask)
+            if step in (20, 41):
+                reset_mask = None
+                if batch_size > 1:
+                    reset_mask = torch.tensor([rng.random() < 0.5 for _ in range(batch_size)])
+                ref_state.reset(reset_mask)
+                state.reset(reset_mask)
+            # Tokens shared by all the rows or given per row, and every kind of text token.
+            rows = rng.choice([1, batch_size])
+            kwargs = {}
+            if rng.random() < 0.7:
+                kwargs["input_tokens"] = torch.randint(0, lm.card, (rows, AUDIO_TOKENS_PER_STREAM, 1))
+            if rng.random() < 0.5:
+                kwargs["moshi_tokens"] = torch.randint(0, lm.card, (rows, AUDIO_TOKENS_PER_STREAM, 1))
+            text = rng.random()
+            if text < 0.3:
+                kwargs["text_token"] = torch.randint(0, lm.text_card, (rows,)) if rows > 1 else rng.randint(0, 99)
+            elif text < 0.5:
+                kwargs["text_token"] = torch.tensor(rng.randint(0, 99))
+
+            expected = reference.prepare_step_input(**kwargs)
+            prepared = gen.prepare_step_input(**kwargs)
+            assert _same(expected, prepared), step
+            assert torch.equal(ref_state.cache, state.cache), step
+            assert torch.equal(ref_state.provided, state.provided), step
+            assert torch.equal(ref_state.offsets, state.offsets), step
+            if prepared is not None:
+                # Advance the executed rows, as `process_transformer_output` does.
+                run_mask = prepared[-1]
+                ref_state.offsets[run_mask] += 1
+                state.offsets[run_mask] += 1
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_step_matches_reference(batch_size: int):
+    lm = _small_lm()
+    outputs = []
+    for cls in (_ReferenceLMGen, LMGen):
+        gen = _gen(cls, lm)
+        generator = torch.Generator().manual_seed(1)
+        steps = []
+        with gen.streaming(batch_size):
+            for _ in range(30):
+                codes = torch.randint(0, lm.card, (batch_size, AUDIO_TOKENS_PER_STREAM, 1), generator=generator)
+                out = gen.step(codes)
+                steps.append(None if out is None else out.clone())
+        outputs.append(steps)
+    assert _same(outputs[0], outputs[1])
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_depformer_codebooks_matches_full_depformer(batch_size: int):
+    # Skipping the user stream codebooks in the depformer must not change the greedy output, nor the cache.
+    lm = _small_lm(dep_q=16)
+    outputs = []
+    for depformer_codebooks in (None, AUDIO_TOKENS_PER_STREAM):
+        gen = _gen(LMGen, lm, depformer_codebooks=depformer_codebooks)
+        gen.text_prompt_tokens = [5, 6, 7]
+        generator = torch.Generator().manual_seed(2)
+        steps = []
+        with gen.streaming(batch_size):
+            gen._step_audio_silence()
+            gen._step_text_prompt()
+            gen._step_audio_silence()
+            for _ in range(40):
+                codes = torch.randint(0, lm.card, (batch_size, AUDIO_TOKENS_PER_STREAM, 1), generator=generator)
+                out = gen.step(codes)
+                steps.append(None if out is None else out.clone())
+            steps.append(gen._streaming_state.cache.clone())
+        outputs.append(steps)
+    assert _same(outputs[0], outputs[1])
+
+
+def test_step_embeddings_without_executed_entry_raises():
+    lm = _small_lm()
+    gen = _gen(LMGen, lm, prefill_chunk_size=4)
+    embeddings = torch.randn(1, 1, lm.dim)
+    with gen.streaming(2):
+        gen.set_exec_mask(torch.tensor([True, False]))
+        # The fresh entry starts, then takes the embeddings.
+        gen.step_embeddings(embeddings)
+        assert gen._streaming_state.offsets.tolist() == [2, 0]
+        gen.set_exec_mask(torch.zeros(2, dtype=torch.bool))
+        with pytest.raises(RuntimeError):
+            gen.step_embeddings(embeddings)
+        with pytest.raises(RuntimeError):
+            list(gen._prefill_core([{**gen._dummy_step_tokens(), "embeddings": embeddings}]))
+
+
+class _UnforcedLMGen(LMGen):
+    """`LMGen` running the depformer and the cache writes even when all the tokens are provided."""
+
+    def _is_forced(self, provided_, run_mask) -> bool:
+        return False
+
+
+@pytest.mark.parametrize("batch_size", [1, 2])
+def test_forced_steps_match_full_steps(batch_size: int):
+    lm = _small_lm()
+    outputs = []
+    for cls in (_UnforcedLMGen, LMGen):
+        gen = _gen(cls, lm)
+        gen.text_prompt_tokens = [5, 6, 7, 8]
+        generator = torch.Generator().manual_seed(3)
+        with gen.streaming(batch_size):
+            for _ in gen.iter_system_prompts(mimi=None):
+                pass
+            state = gen._streaming_state
+            prompted = [state.cache.clone(), state.provided.clone(), state.offsets.clone(), _kv_state(lm)]
+            steps = []
+            for _ in range(20):
+                codes = torch.randint(0, lm.card, (batch_size, AUDIO_TOKENS_PER_STREAM, 1), generator=generator)
+                out = gen.step(codes)
+                steps.append(None if out is None else out.clone())
+        outputs.append((prompted, steps))
+    assert _same(outputs[0], outputs[1])
+
+
+def test_prefill_chunks_match_step_by_step():
+    lm = _small_lm()
+    results = []
+    for prefill_chunk_size in (1, 4, 16):
+        gen = _gen(LMGen, lm, prefill_chunk_size=prefill_chunk_size)
+        # Longer than the context, the chunks then have to go one step at a time once the KV cache is full.
+        gen.text_prompt_tokens = [5 + i % 90 for i in range(lm.context + 10)]
+        generator = torch.Generator().manual_seed(4)
+        with gen.streaming(2):
+            gen.set_exec_mask(torch.tensor([False, True]))
+            for _ in range(3):
+                gen.step(torch.randint(0, lm.card, (2, AUDIO_TOKENS_PER_STREAM, 1), generator=generator))
+            gen.reset_streaming(torch.tensor([True, False]))
+            gen.set_exec_mask(torch.tensor([True, False]))
+            for _ in gen.iter_system_prompts(mimi=None):
+                pass
+            state = gen._streaming_state
+            tokens = [state.cache.clone(), state.provided.clone(), state.offsets.clone()]
+            kv = _kv_state(lm)
+            gen.set_exec_mask(None)
+            steps = []
+            for _ in range(10):
+                codes = torch.randint(0, lm.card, (2, AUDIO_TOKENS_PER_STREAM, 1), generator=generator)
+                out = gen.step(codes)
+                steps.append(None if out is None else out.clone())
+        results.append((tokens, kv, steps))
+    ref_tokens, ref_kv, ref_steps = results[0]
+    for tokens, kv, steps in results[1:]:
+        assert _same(ref_tokens, tokens)
+        for ref_tensor, tensor in zip(ref_kv, kv):
+            if tensor.is_floating_point():
+                # The batched matmuls of a chunk round differently.
+                torch.testing.assert_close(tensor, ref_tensor, rtol=0, atol=1e-5)
+            else:
+                assert torch.equal(tensor, ref_tensor)
+        assert _same(ref_steps, steps)
+
+
+def test_restored_prompt_snapshot_matches_cold_prompts():
+    lm = _small_lm()
+    results = []
+    for prompt_snapshot_cache_bytes, rows in ((0, [0]), (1 << 30, [1, 0])):
+        gen = _gen(LMGen, lm, prompt_snapshot_cache_bytes=prompt_snapshot_cache_bytes)
+        gen.text_prompt_tokens = [5, 6, 7]
+        with gen.streaming(2):
+            # With the cache, the prompts of row 1 fill it and those of row 0 are restored from it.
+            for row in rows:
+                mask = torch.arange(2) == row
+                gen.reset_streaming(mask)
+                gen.set_exec_mask(mask)
+                for _ in gen.iter_system_prompts(mimi=None):
+                    pass
+            entry = gen.get_streaming_state_entry(0)
+            gen.set_exec_mask(torch.tensor([True, False]))
+            generator = torch.Generator().manual_seed(5)
+            steps = []
+            for _ in range(10):
+                codes = torch.randint(0, lm.card, (2, AUDIO_TOKENS_PER_STREAM, 1), generator=generator)
+                out = gen.step(codes)
+                steps.append(None if out is None else out[:1].clone())
+        results.append((entry, steps))
+    assert gen.prompt_snapshots.hits == 1
+    assert _same(results[0], results[1])
@@ -0,0 +1,84 @@
+"""Checks of the streamed loading of the LM checkpoints."""
+import subprocess
+import sys
+
+import pytest
+from safetensors.torch import load_file, save_file
+import torch
+
+from moshi.models import loaders
+from test_lm_gen import _small_lm
+
+
+def _save_released_checkpoint(path: str, **overrides):
+    """Save the weights of a LM with the 8 codebooks depformer of the released checkpoints."""
+    lm = _small_lm(dep_q=8, **overrides)
+    save_file({name: tensor.clone() for name, tensor in lm.state_dict().items()}, path)
+
+
+@pytest.mark.parametrize("copy_missing_weights", [False, True])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_stream_lm_state_dict_matches_load_file(tmp_path, copy_missing_weights: bool, dtype: torch.dtype):
+    path = str(tmp_path / "lm.safetensors")
+    _save_released_checkpoint(path)
+    model = _small_lm(seed=1, dep_q=16)
+    expected = load_file(path)
+    loaders._patch_lm_state_dict(model, expected, copy_missing_weights)
+    expected = {name: tensor.to(dtype=dtype) for name, tensor in expected.items()}
+    streamed = loaders._stream_lm_state_dict(model, path, copy_missing_weights, "cpu", dtype)
+    assert streamed.keys() == expected.keys()
+    for name, tensor in expected.items():
+        assert streamed[name].dtype == dtype
+        assert torch.equal(streamed[name], tensor), name
+    if copy_missing_weights:
+        # The weights filled by copy share the tensor of their source.
+        assert len(streamed) > len(load_file(path))
+        for name in streamed.keys() - load_file(path).keys():
+            source = loaders._missing_weight_source(name, streamed)
+            assert streamed[name] is streamed[source]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="reads the memory of the process from /proc")
+def test_stream_lm_state_dict_peak_memory(tmp_path):
+    path = str(tmp_path / "lm.safetensors")
+    kwargs = dict(dim=512, num_heads=8, num_layers=12, depformer_dim=256, depformer_dim_feedforward=512,
+                  depformer_num_heads=4)
+    _save_released_checkpoint(path, **kwargs)
+    # Run in a process of its own, sampling its memory while it loads.
+    script = f"""
+import threading
+import torch
+from moshi.models import loaders
+from moshi.models.lm import LMModel
+from test_lm_gen import _small_lm_kwargs
+
+def anonymous_rss():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("RssAnon:"))
+
+# The pages of the memory mapped checkpoint are not counted, only the memory actually allocated.
+done = threading.Event()
+peak = [0]
+
+def sample():
+    while not done.is_set():
+        peak[0] = max(peak[0], anonymous_rss())
+        done.wait(0.0005)
+
+model = LMModel(device="meta", dtype=torch.float32, **_small_lm_kwargs(dep_q=16, **{kwargs!r}))
+before = anonymous_rss()
+sampler = threading.Thread(target=sample)
+sampler.start()
+state_dict = loaders._stream_lm_state_dict(model, {path!r}, True, "cpu", torch.bfloat16)
+done.set()
+sampler.join()
+unique = {{tensor.data_ptr(): tensor.numel() * tensor.element_size() for tensor in state_dict.values()}}
+print(peak[0] - before, sum(unique.values()))
+"""
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            env={"PYTHONPATH": ":".join(sys.path)})
+    growth, loaded = map(int, result.stdout.split()[-2:])
+    # The float32 checkpoint is about twice the size of the bfloat16 weights, it is never held whole: at most
+    # one of its tensors is held on top of the loaded weights. Reading it all first peaks 20% higher here.
+    assert loaded > 100 * 2**20
+    assert growth < 1.1 * loaded
@@ -0,0 +1,33 @@
+"""Checks of the metrics updated from several threads."""
+import re
+import threading
+
+from moshi.utils.metrics import Metrics
+
+
+def test_histogram_render_is_consistent_under_concurrent_updates():
+    metrics = Metrics()
+    histogram = metrics.histogram("step_seconds", "Step time.")
+    counter = metrics.counter("steps_total", "Steps.")
+    stop = threading.Event()
+
+    def update():
+        while not stop.is_set():
+            histogram.observe(0.01)
+            counter.inc()
+
+    threads = [threading.Thread(target=update) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(200):
+            text = metrics.render()
+            inf_bucket = int(re.search(r'moshi_step_seconds_bucket\{le="\+Inf"\} (\d+)', text).group(1))
+            count = int(re.search(r"moshi_step_seconds_count (\d+)", text).group(1))
+            assert inf_bucket == count
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    text = metrics.render()
+    assert f"moshi_steps_total {histogram.count}" in text
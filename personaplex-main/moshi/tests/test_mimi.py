@@ -0,0 +1,82 @@
+"""Checks of the streaming Mimi encoder fed several frames at once."""
+import numpy as np
+import pytest
+import torch
+
+from moshi.models import loaders, MimiModel
+from moshi.models.lm import _iterate_audio, encode_from_sphn
+from moshi.modules import SEANetDecoder, SEANetEncoder, transformer
+from moshi.quantization import SplitResidualVectorQuantizer
+
+FRAME_SIZE = 1920
+
+
+def _small_mimi(seed: int = 0) -> MimiModel:
+    torch.manual_seed(seed)
+    seanet_kwargs = dict(loaders._seanet_kwargs)
+    seanet_kwargs.update(n_filters=8, dimension=32)
+    quantizer_kwargs = dict(loaders._quantizer_kwargs)
+    quantizer_kwargs.update(dimension=16, input_dimension=32, output_dimension=32)
+    transformer_kwargs = dict(loaders._transformer_kwargs)
+    transformer_kwargs.update(d_model=32, num_heads=2, num_layers=2, dim_feedforward=64, input_dimension=32,
+                              output_dimensions=[32])
+    encoder = SEANetEncoder(**seanet_kwargs)
+    mimi = MimiModel(
+        encoder,
+        SEANetDecoder(**seanet_kwargs),
+        SplitResidualVectorQuantizer(**quantizer_kwargs),
+        channels=1,
+        sample_rate=24000,
+        frame_rate=12.5,
+        encoder_frame_rate=24000 / encoder.hop_length,
+        causal=True,
+        resample_method="conv",
+        encoder_transformer=transformer.ProjectedTransformer(**transformer_kwargs),
+        decoder_transformer=transformer.ProjectedTransformer(**transformer_kwargs),
+    )
+    # The biases are initialized to zero, random ones check they are applied once per frame.
+    for name, param in mimi.named_parameters():
+        if name.endswith("bias"):
+            param.data.normal_(0, 0.1)
+    mimi.eval()
+    mimi.set_num_codebooks(8)
+    return mimi
+
+
+def _audio(seconds: float) -> np.ndarray:
+    return (np.random.RandomState(0).randn(1, int(24000 * seconds)) * 0.1).astype(np.float32)
+
+
+@pytest.mark.parametrize("max_batch", [4, 16])
+def test_encode_from_sphn_matches_per_frame(max_batch: int):
+    # Longer than the context of the encoder transformer, so that its KV cache wraps around.
+    pcm = _audio(12.3)
+    mimi = _small_mimi()
+    codes = []
+    with torch.no_grad():
+        for batch in (1, max_batch):
+            mimi.streaming_forever(1)
+            mimi.reset_streaming()
+            frames = list(encode_from_sphn(mimi, _iterate_audio(pcm, FRAME_SIZE, pad=True), max_batch=batch))
+            assert {frame.shape for frame in frames} == {(1, 8, 1)}
+            codes.append(torch.cat(frames, dim=-1))
+    assert torch.equal(codes[0], codes[1])
+
+
+def test_streaming_encode_of_several_frames_matches_per_frame():
+    pcm = torch.from_numpy(_audio(12.3)[:, :FRAME_SIZE * 150])[None]
+    mimi = _small_mimi()
+    codes, latents = [], []
+    with torch.no_grad():
+        for frames in (1, 3, 10):
+            chunks = pcm.split(FRAME_SIZE * frames, dim=-1)
+            mimi.streaming_forever(1)
+            mimi.reset_streaming()
+            codes.append(torch.cat([mimi.encode(chunk) for chunk in chunks], dim=-1))
+            mimi.reset_streaming()
+            latents.append(torch.cat([mimi._encode_to_unquantized_latent(chunk) for chunk in chunks], dim=-1))
+    assert codes[0].shape == (1, 8, 150)
+    for other_codes, other_latent in zip(codes[1:], latents[1:]):
+        assert torch.equal(codes[0], other_codes)
+        # The convolutions of several frames round differently, the transformer must see the same context.
+        torch.testing.assert_close(other_latent, latents[0], rtol=0, atol=1e-6)
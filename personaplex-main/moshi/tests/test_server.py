@@ -0,0 +1,325 @@
+"""Checks of the audio streams and the batch engine of the server."""
+import asyncio
+import time
+
+import numpy as np
+import pytest
+import sphn
+
+from moshi.server import (OpusStreamReader, OpusStreamWriter, PcmStreamReader, PcmStreamWriter, ServerState,
+                          _Slot)
+from moshi.utils.logging import ColorizedLog
+from test_lm_gen import _small_lm
+from test_mimi import _small_mimi
+
+FRAME_SIZE = 1920
+
+
+class _Tokenizer:
+    def id_to_piece(self, token: int) -> str:
+        return f"▁t{token}"
+
+
+def _server_state(batch_size: int = 1, **kwargs) -> ServerState:
+    mimi = _small_mimi()
+    state = ServerState(mimi, mimi.shared_copy(), _Tokenizer(), _small_lm(), "cpu", batch_size=batch_size, **kwargs)
+    state.lm_gen.use_sampling = False
+    return state
+
+
+def _live_slot(state: ServerState, index: int) -> _Slot:
+    """A slot of `state` that skipped the system prompts, its input frames are pushed to the engine."""
+    slot = _Slot(index=index, clog=ColorizedLog.randomize(), reader=PcmStreamReader(24000, FRAME_SIZE),
+                 writer=PcmStreamWriter(24000), text_prompt_tokens=[], voice_prompt_path=None, seed=None,
+                 prompt_done=asyncio.get_running_loop().create_future(), live=True)
+    slot.reader.on_frame = lambda: state._push_frame(slot)
+    state.slots[index] = slot
+    state.free_slots.remove(index)
+    return slot
+
+
+def _speech(batch_size: int, frame_count: int) -> np.ndarray:
+    return (np.random.RandomState(1).randn(batch_size, frame_count * FRAME_SIZE) * 3000).astype(np.int16)
+
+
+def _frame_bytes(audio: np.ndarray, index: int, frame: int) -> bytes:
+    return audio[index, frame * FRAME_SIZE: (frame + 1) * FRAME_SIZE].tobytes()
+
+
+def _message_sizes(rng: np.random.RandomState, total: int) -> list[int]:
+    # Odd sizes split samples across messages, large ones outgrow the ring.
+    sizes = []
+    while sum(sizes) < total:
+        sizes.append(int(rng.choice([1, 3, 640, 1921, 3840, 7 * FRAME_SIZE, 20 * FRAME_SIZE + 5])))
+    return sizes
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_pcm_reader_matches_concatenated_input(seed: int):
+    rng = np.random.RandomState(seed)
+    data = rng.randint(-32768, 32768, size=60 * FRAME_SIZE, dtype=np.int16).tobytes()
+    frames_ready = []
+    reader = PcmStreamReader(24000, FRAME_SIZE, on_frame=lambda: frames_ready.append(1))
+    frames = []
+    position = 0
+    for size in _message_sizes(rng, len(data)):
+        reader.append_bytes(memoryview(data)[position: position + size])
+        position += size
+        assert len(frames_ready) == len(frames) + reader.pending_frames
+        # Only some of the frames are read at once, so that the ring wraps around.
+        for _ in range(rng.randint(0, reader.pending_frames + 1)):
+            frame = np.empty(FRAME_SIZE, dtype=np.float32)
+            reader.read_frame(frame)
+            frames.append(frame)
+    while reader.pending_frames:
+        frame = np.empty(FRAME_SIZE, dtype=np.float32)
+        reader.read_frame(frame)
+        frames.append(frame)
+    # Previous path: all the bytes converted at once, then cut into frames.
+    expected = np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+    assert len(frames) == len(expected) // FRAME_SIZE
+    np.testing.assert_array_equal(np.concatenate(frames), expected[: len(frames) * FRAME_SIZE])
+
+
+def test_pcm_reader_keeps_its_ring_in_steady_state():
+    reader = PcmStreamReader(24000, FRAME_SIZE)
+    ring = reader.ring
+    frame = np.empty(FRAME_SIZE, dtype=np.float32)
+    data = np.zeros(FRAME_SIZE // 3, dtype=np.int16).tobytes()
+    for _ in range(300):
+        reader.append_bytes(data)
+        while reader.pending_frames:
+            reader.read_frame(frame)
+    assert reader.ring is ring
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_pcm_writer_matches_clipped_conversion(seed: int):
+    rng = np.random.RandomState(seed)
+    writer = PcmStreamWriter(24000)
+    chunks, received = [], []
+    for _ in range(100):
+        # Out of range samples are clipped.
+        chunk = (rng.randn(int(rng.choice([1, 480, FRAME_SIZE, 5 * FRAME_SIZE, 10 * FRAME_SIZE]))) * 0.7)
+        chunks.append(chunk.astype(np.float32))
+        writer.append_pcm(chunks[-1])
+        if rng.rand() < 0.3:
+            message = writer.read_message()
+            assert message[0] == 1
+            received.append(bytes(message[1:]))
+    received.append(bytes(writer.read_message()[1:]))
+    # Previous path: each chunk converted on its own, then the bytes concatenated.
+    expected = b"".join((np.clip(chunk, -1.0, 1.0) * 32767).astype(np.int16).tobytes() for chunk in chunks)
+    assert b"".join(received) == expected
+
+
+def test_pcm_writer_reuses_its_messages():
+    writer = PcmStreamWriter(24000)
+    pcm = np.zeros(FRAME_SIZE, dtype=np.float32)
+    messages = None
+    for _ in range(50):
+        writer.append_pcm(pcm)
+        assert len(writer.read_message()) == 1 + 2 * FRAME_SIZE
+        if messages is None:
+            messages = list(writer.messages)
+    assert all(message is expected for message, expected in zip(writer.messages, messages))
+
+
+def _chirp(frames: int) -> np.ndarray:
+    t = np.arange(frames * FRAME_SIZE) / 24000
+    return (np.sin(2 * np.pi * (200 * t + 400 * t ** 2)) * 0.4).astype(np.float32)
+
+
+@pytest.mark.parametrize("codec", ["pcm", "opus"])
+def test_stream_loopback(codec: str):
+    reader_cls, writer_cls = {"pcm": (PcmStreamReader, PcmStreamWriter),
+                              "opus": (OpusStreamReader, OpusStreamWriter)}[codec]
+    frame_count = 50
+    audio = _chirp(frame_count)
+    writer = writer_cls(24000)
+    reader = reader_cls(24000, FRAME_SIZE)
+    wire_bytes = 0
+    for index in range(frame_count):
+        writer.append_pcm(audio[index * FRAME_SIZE: (index + 1) * FRAME_SIZE])
+        message = writer.read_message()
+        assert message[0] == 1
+        wire_bytes += len(message)
+        reader.append_bytes(message[1:])
+    # sphn decodes Opus on a background thread.
+    deadline = time.monotonic() + 10
+    while reader.pending_frames < frame_count - 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+        reader.append_bytes(b"")
+    frames = []
+    while reader.pending_frames:
+        frame = np.empty(FRAME_SIZE, dtype=np.float32)
+        reader.read_frame(frame)
+        frames.append(frame)
+    decoded = np.concatenate(frames)
+
+    def delay(begin: int) -> int:
+        # Shift of the decoded audio against the input, from their correlation over 20 frames.
+        span = audio[begin: begin + 20 * FRAME_SIZE]
+        return int(np.argmax([np.dot(decoded[begin + shift: begin + shift + len(span)], span)
+                              for shift in range(FRAME_SIZE)]))
+
+    codec_delay = delay(25 * FRAME_SIZE)
+    # The frames are not shifted along the stream, up to the precision of the correlation of lossy audio.
+    assert abs(delay(5 * FRAME_SIZE) - codec_delay) <= 2
+    error = decoded[codec_delay: codec_delay + 40 * FRAME_SIZE] - audio[:40 * FRAME_SIZE]
+    if codec == "pcm":
+        assert wire_bytes == frame_count * (1 + 2 * FRAME_SIZE)
+        assert len(frames) == frame_count and codec_delay == 0
+        assert np.abs(error).max() < 1e-4
+    else:
+        # About 30 kbit/s, against 384 kbit/s for PCM16.
+        assert wire_bytes < frame_count * 2 * FRAME_SIZE / 10
+        # The encoder holds back the last 2 frames, the Opus look ahead is 6.5 ms.
+        assert len(frames) == frame_count - 2
+        assert codec_delay == 156
+        assert np.sqrt(np.mean(error ** 2)) < 0.1
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_other_mimi_modes_give_the_same_audio(pipeline: bool):
+    batch_size, frame_count = 2, 12
+    audio = _speech(batch_size, frame_count)
+    outputs = {}
+    for mode in ("off", "sync", "async"):
+        state = _server_state(batch_size, other_mimi_mode=mode, pipeline=pipeline)
+
+        async def run():
+            slots = [_live_slot(state, index) for index in range(batch_size)]
+            for frame in range(frame_count):
+                for slot in slots:
+                    slot.reader.append_bytes(_frame_bytes(audio, slot.index, frame))
+                await state._step_frame(slots)
+            await state._drain()
+            assert state.frames_total.value == batch_size * frame_count
+            # Wait for the mirror codec, the async mode must not have skipped any frame.
+            state.mirror_executor.submit(lambda: None).result()
+            assert state.mirror_skipped.value == 0
+            return [bytes(slot.writer.read_message()) for slot in slots]
+
+        outputs[mode] = asyncio.run(run())
+    # The agent audio of the frames stepped so far, for each slot.
+    assert len(outputs["off"][0]) > 1 + 2 * FRAME_SIZE
+    assert outputs["off"] == outputs["sync"] == outputs["async"]
+
+
+async def _wait_frames(state: ServerState, count: int):
+    while state.frames_total.value < count:
+        await asyncio.sleep(0.005)
+
+
+@pytest.mark.parametrize("late", [False, True])
+def test_slot_late_by_one_frame_is_waited_for(late: bool):
+    frame_count = 6
+    audio = _speech(2, frame_count)
+    state = _server_state(2)
+    frame_period = 1 / state.mimi.frame_rate
+
+    async def run():
+        slots = [_live_slot(state, index) for index in range(2)]
+        state.engine_task = asyncio.create_task(state._engine_loop())
+        for frame in range(frame_count):
+            for slot in slots:
+                if late and slot.index == 1 and frame == 2:
+                    # The first slot gets its frame alone, then waits for the second one.
+                    await asyncio.sleep(frame_period)
+                    assert state.frames_total.value == 2 * frame
+                    assert 0 < state._frame_wait(slots) <= state.max_input_backlog * frame_period
+                slot.reader.append_bytes(_frame_bytes(audio, slot.index, frame))
+            await _wait_frames(state, 2 * (frame + 1))
+        outputs = [bytes(slot.writer.read_message()) for slot in slots]
+        for slot in slots:
+            state._release_slot(slot)
+        await state.engine_task
+        return outputs
+
+    outputs = asyncio.run(run())
+    # Same output as when the frames of both slots arrive together: the late frame was not replaced by silence.
+    reference = _server_state(2)
+
+    async def run_reference():
+        slots = [_live_slot(reference, index) for index in range(2)]
+        for frame in range(frame_count):
+            for slot in slots:
+                slot.reader.append_bytes(_frame_bytes(audio, slot.index, frame))
+            await reference._step_frame(slots)
+        return [bytes(slot.writer.read_message()) for slot in slots]
+
+    assert outputs == asyncio.run(run_reference())
+
+
+def test_slot_with_stopped_input_is_fed_silence():
+    state = _server_state(2)
+
+    async def run():
+        slots = [_live_slot(state, index) for index in range(2)]
+        slots[0].reader.append_bytes(_speech(1, 1)[0].tobytes())
+        assert state._frame_wait(slots) > 0
+        slots[1].last_frame_at -= state.max_input_backlog / state.mimi.frame_rate
+        assert state._frame_wait(slots) == 0
+
+    asyncio.run(run())
+
+
+def test_queue_eta_counts_the_remaining_steps_of_a_voice_job(tmp_path):
+    path = str(tmp_path / "voice.wav")
+    sphn.write_wav(path, (np.random.RandomState(2).randn(1, 24000 * 2) * 0.1).astype(np.float32), 24000)
+    state = _server_state(1)
+    frame_period = 1 / state.mimi.frame_rate
+
+    async def run():
+        job = state.submit_voice_job(path)
+        # One step per frame of the 2 s of audio, and one to save the embeddings.
+        assert job.steps == 26
+        while job.index < 0:
+            await asyncio.sleep(0)
+        while job.status == "queued" or job.steps_done == 0:
+            # The only slot is held by the job, until it starts the steps go at the pace of the frames.
+            assert state.queue_status()["eta_seconds"] == round(job.steps * frame_period, 1)
+            await asyncio.sleep(0.001)
+        # Then at the pace of the steps done so far.
+        now = time.time()
+        pace = (now - job.prompt_started) / job.steps_done
+        assert state._estimated_wait(1) == pytest.approx((job.steps - job.steps_done) * pace, rel=0.1)
+        await asyncio.gather(*state.voice_tasks)
+        assert job.status == "done" and job.steps_done == job.steps
+        assert state.queue_status()["eta_seconds"] == 0
+
+    asyncio.run(run())
+
+
+def test_engine_loop_only_wakes_up_for_work():
+    frame_count = 8
+    audio = _speech(2, frame_count)
+    state = _server_state(2)
+    iterations = []
+    frame_wait = state._frame_wait
+
+    def counting_frame_wait(live):
+        iterations.append(len(live))
+        return frame_wait(live)
+
+    state._frame_wait = counting_frame_wait
+
+    async def run():
+        slots = [_live_slot(state, index) for index in range(2)]
+        state.engine_task = asyncio.create_task(state._engine_loop())
+        # Idle live slots: one iteration, then the engine waits for a frame.
+        await asyncio.sleep(0.3)
+        assert len(iterations) == 1
+        for frame in range(frame_count):
+            for slot in slots:
+                slot.reader.append_bytes(_frame_bytes(audio, slot.index, frame))
+            await _wait_frames(state, 2 * (frame + 1))
+        await asyncio.sleep(0.1)
+        # One iteration to step each frame and one to go back to waiting, whatever the time spent.
+        assert len(iterations) <= 1 + 2 * frame_count
+        for slot in slots:
+            state._release_slot(slot)
+        await state.engine_task
+
+    asyncio.run(run())